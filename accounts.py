@@ -0,0 +1,60 @@
+import json
+import os
+import re
+
+# Account registry. Each account is a dict of:
+#   name          - shown on the dashboard, must be unique
+#   trades        - path to the account's TradeHistory.csv
+#   transactions  - path to the account's TransactionHistory.csv
+#   transfer_out  - optional, MarketName text of cash transferred out to another of our accounts
+#   transfer_in   - optional, MarketName text of cash transferred in from another of our accounts
+#   matching      - optional, how sells are matched with buys to work out profit: "fifo" (the default), "lifo", "hifo",
+#                   "average", or "hmrc" for UK capital gains rules (same day, then the next 30 days, then the Section 104 pool)
+
+ACCOUNTS_FILE = "./accounts.json"
+
+DEFAULT_ACCOUNTS = [
+    {"name": "Share Dealing",
+     "trades": "./TradeHistory (Share Dealing).csv",
+     "transactions": "./TransactionHistory (Share Dealing).csv",
+     "transfer_out": "Funds Transfer to ISA"},
+    {"name": "ISA",
+     "trades": "./TradeHistory (ISA).csv",
+     "transactions": "./TransactionHistory (ISA).csv",
+     "transfer_in": "Funds Transfer from Share dealing"},
+]
+
+
+def load_accounts(path=ACCOUNTS_FILE):
+    """ Reads the account registry, {"accounts": [...]}, from a JSON file.
+    Without one, the Share Dealing and ISA exports in the current folder are used """
+    if path is None or not os.path.exists(path):
+        return DEFAULT_ACCOUNTS
+
+    with open(path) as f:
+        accounts = json.load(f)["accounts"]
+
+    # Paths are relative to the registry file
+    folder = os.path.dirname(os.path.abspath(path))
+    for account in accounts:
+        for key in ("trades", "transactions"):
+            account[key] = os.path.join(folder, account[key])
+
+    names = [account["name"] for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Account names must be unique: {names}")
+    return accounts
+
+
+def account_id(name):
+    """ Account name as used in Dash component ids, e.g. "Share Dealing" -> "share-dealing" """
+    return re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+
+
+def account_files(accounts):
+    """ Every input file, by a name unique to the account and file """
+    files = {}
+    for account in accounts:
+        files[account["name"] + " trades"] = account["trades"]
+        files[account["name"] + " transactions"] = account["transactions"]
+    return files
@@ -0,0 +1,240 @@
+import argparse
+import csv
+import html
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pandas as pd
+
+import process_data
+import summary_index
+from accounts import account_id, load_accounts
+
+# Tax year summaries for many portfolios without starting the dashboard, e.g.
+#   python batch_report.py clients/*/accounts.json --tax-years 2020 2021 --out reports
+# Each portfolio is an account registry (accounts.json), named after the folder it's in.
+# Portfolios are processed in parallel, one per process. Within a process the exports are cleaned and
+# FIFO matched once, and every tax year is totalled from the same frames.
+
+FORMATS = ["html", "csv", "json"]
+
+
+def portfolio_name(path):
+    """ A portfolio's name, from the folder its accounts.json is in """
+    return os.path.basename(os.path.dirname(os.path.abspath(path)))
+
+
+def _number(value):
+    """ JSON has no NaN (e.g. % profit with nothing sold) """
+    return None if value is None or (isinstance(value, float) and math.isnan(value)) else round(float(value), 2)
+
+
+def data_tax_years(data):
+    """ Every tax year with any trades or transactions in it """
+    dates = [table["Date"] for table in list(data["trades"].values()) + list(data["transactions"].values()) if len(table)]
+    if not dates:
+        return []
+    first = min(d.min() for d in dates)
+    last = max(d.max() for d in dates)
+    return list(range(process_data.tax_year_of(first), process_data.tax_year_of(last) + 1))
+
+
+def year_report(index, accounts, year):
+    """ Totals of trades, dividends, fees and cash flow for one tax year """
+    start, end = process_data.tax_year_dates(year)
+    names = [account["name"] for account in accounts]
+
+    trades = {name: summary_index.trades_summary(index, name, start, end) for name in names}
+    initial = sum(t["ic"] for t in trades.values())
+    final = sum(t["fc"] for t in trades.values())
+    trades_total = {"invested": initial,
+                    "sold": sum(t["sold_pos"] for t in trades.values()),
+                    "fees": sum(t["fees"] for t in trades.values()),
+                    "net_profit": sum(t["net_profit"] for t in trades.values()),
+                    "net_profit_per": (final / initial - 1) * 100 if initial else float("nan")}
+
+    dividends = summary_index.dividends_summary(index, start, end)
+    fees = summary_index.fees_summary(index, start, end)
+    cash_flow = summary_index.cashflow_summary(index, start, end)
+
+    return {
+        "tax_year": process_data.tax_year_label(year),
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "trades": dict({name: {"invested": _number(t["ic"]),
+                               "sold": _number(t["sold_pos"]),
+                               "fees": _number(t["fees"]),
+                               "net_profit": _number(t["net_profit"]),
+                               "net_profit_per": _number(t["net_profit_per"])} for name, t in trades.items()},
+                       Total={key: _number(value) for key, value in trades_total.items()}),
+        "dividends": dict({name: _number(dividends.get(name, 0.0)) for name in names},
+                          Total=_number(sum(dividends.values()))),
+        "fees": dict({fee_type: _number(total) for fee_type, total in fees.items()},
+                     Total=_number(sum(fees.values()))),
+        "cash_flow": {"cash_in": {name: _number(total) for name, total in cash_flow["cash_in"].items()},
+                      "cash_out": _number(cash_flow["cash_out"]),
+                      "transfers_out": _number(cash_flow["transfers_out"]),
+                      "transfers_in": _number(cash_flow["transfers_in"])},
+    }
+
+
+def matching_report(comparisons, year):
+    """ Profit on each account's trades in a tax year under every lot matching method """
+    start, end = process_data.tax_year_dates(year)
+    report = {}
+    for name, comparison in comparisons.items():
+        summaries = process_data.matching_summary(process_data.date_filter(start, end, comparison))
+        report[name] = {method: {"invested": _number(summary["ic"]),
+                                 "fees": _number(summary["fees"]),
+                                 "net_profit": _number(summary["net_profit"]),
+                                 "net_profit_per": _number(summary["net_profit_per"])} for method, summary in summaries.items()}
+    return report
+
+
+def portfolio_reports(path, tax_years=None, compare_matching=False):
+    """ Processes one portfolio's exports and returns (name, [report for each tax year]).
+    With compare_matching, each report also has the profit every lot matching method would give.
+    Runs in a worker process. Accounts are processed one after another here, the pool is already busy """
+    accounts = load_accounts(path)
+    data = process_data.process_files(accounts, workers=1, compare=compare_matching)
+    index = summary_index.build_summary_index(data["trades"], data["dividends"], data["fees"], data["transactions"], accounts)
+    years = tax_years or data_tax_years(data)
+    reports = [year_report(index, accounts, year) for year in years]
+
+    if compare_matching:
+        # Matched in one extra pass over the trades already cleaned for the report, covering every method
+        for report, year in zip(reports, years):
+            report["matching"] = matching_report(data["comparisons"], year)
+    return portfolio_name(path), reports
+
+
+def report_rows(report):
+    """ A report flattened to (section, item, account, value) rows """
+    rows = []
+    for account, totals in report["trades"].items():
+        for item, value in totals.items():
+            rows.append(("trades", item, account, value))
+    for account, value in report["dividends"].items():
+        rows.append(("dividends", "total", account, value))
+    for fee_type, value in report["fees"].items():
+        rows.append(("fees", fee_type, "", value))
+    for account, value in report["cash_flow"]["cash_in"].items():
+        rows.append(("cash_flow", "cash_in", account, value))
+    rows.append(("cash_flow", "cash_out", "", report["cash_flow"]["cash_out"]))
+    rows.append(("cash_flow", "transfers_out", "", report["cash_flow"]["transfers_out"]))
+    rows.append(("cash_flow", "transfers_in", "", report["cash_flow"]["transfers_in"]))
+    for account, methods in report.get("matching", {}).items():
+        for method, totals in methods.items():
+            for item, value in totals.items():
+                rows.append(("matching", f"{method}_{item}", account, value))
+    return rows
+
+
+def _money(value):
+    return "" if value is None else f"£ {value:,.2f}"
+
+
+def _html_table(header, rows):
+    cells = "".join(f"<th>{html.escape(str(h))}</th>" for h in header)
+    body = "".join("<tr>" + "".join(f"<td>{html.escape(str(c))}</td>" for c in row) + "</tr>" for row in rows)
+    return f'<table class="table"><tr>{cells}</tr>{body}</table>'
+
+
+def render_html(name, report):
+    """ A standalone HTML page of one portfolio's tax year """
+    accounts = list(report["trades"])
+    labels = [("Initially Invested", "invested"), ("Total Sold", "sold"), ("Fees Associated", "fees"), ("Net Profit", "net_profit")]
+    trades = [[label] + [_money(report["trades"][a][key]) for a in accounts] for label, key in labels]
+    trades.append(["Net Profit (%)"] + ["N/A" if report["trades"][a]["net_profit_per"] is None
+                                        else f'{report["trades"][a]["net_profit_per"]:,.2f} %' for a in accounts])
+    fee_labels = {"commission": "Commission Fees", "section_31": "Section 31 Fees", "custody": "Custody Fees", "Total": "Total"}
+    cash_flow = ([[f"Cash to {a}", _money(v)] for a, v in report["cash_flow"]["cash_in"].items()]
+                 + [["Transferred Out to Our Accounts", _money(report["cash_flow"]["transfers_out"])],
+                    ["Transferred In from Our Accounts", _money(report["cash_flow"]["transfers_in"])],
+                    ["Cash Withdrawn", _money(report["cash_flow"]["cash_out"])]])
+
+    matching = []
+    for account, methods in report.get("matching", {}).items():
+        matching += [f"<h3>{html.escape(account)}</h3>", _html_table(
+            ["", "Initially Invested", "Fees Associated", "Net Profit", "Net Profit (%)"],
+            [[process_data.MATCHING_LABELS[method], _money(t["invested"]), _money(t["fees"]), _money(t["net_profit"]),
+              "N/A" if t["net_profit_per"] is None else f'{t["net_profit_per"]:,.2f} %'] for method, t in methods.items()])]
+    if matching:
+        matching.insert(0, "<h2>Profit by Lot Matching Method</h2>")
+
+    title = html.escape(f"{name} - tax year {report['tax_year']}")
+    return "\n".join([
+        f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>{title}</title></head><body>",
+        f"<h1>{title}</h1><p>{report['start']} to {report['end']}</p>",
+        "<h2>Summary of Closed Positions</h2>", _html_table([""] + accounts, trades),
+        "<h2>Dividends</h2>", _html_table(["", "Total"], [[a, _money(v)] for a, v in report["dividends"].items()]),
+        "<h2>Fees</h2>", _html_table(["", "Total"], [[fee_labels[f], _money(v)] for f, v in report["fees"].items()]),
+        "<h2>Cash Flow</h2>", _html_table(["", "Cash Transferred"], cash_flow),
+        *matching,
+        "</body></html>",
+    ])
+
+
+def write_reports(out_dir, name, reports, formats=FORMATS):
+    """ out_dir/<portfolio>/<tax year>.<format> for each report """
+    folder = os.path.join(out_dir, account_id(name))
+    os.makedirs(folder, exist_ok=True)
+    for report in reports:
+        stem = os.path.join(folder, report["tax_year"].replace("/", "-"))
+        if "json" in formats:
+            with open(stem + ".json", "w") as f:
+                json.dump(dict(report, portfolio=name), f, indent=4)
+        if "csv" in formats:
+            with open(stem + ".csv", "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["section", "item", "account", "value"])
+                writer.writerows(report_rows(report))
+        if "html" in formats:
+            with open(stem + ".html", "w", encoding="utf-8") as f:
+                f.write(render_html(name, report))
+
+
+def run(paths, tax_years=None, out_dir="reports", formats=FORMATS, workers=None, compare_matching=False):
+    """ Reports for every portfolio, written to out_dir along with summary.csv covering all of them.
+    Returns {portfolio: [reports]} """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = dict(pool.map(partial(portfolio_reports, tax_years=tax_years, compare_matching=compare_matching), paths))
+
+    summary = []
+    for name, reports in results.items():
+        write_reports(out_dir, name, reports, formats)
+        for report in reports:
+            summary += [(name, report["tax_year"]) + row for row in report_rows(report)]
+
+    pd.DataFrame(summary, columns=["portfolio", "tax_year", "section", "item", "account", "value"]).to_csv(
+        os.path.join(out_dir, "summary.csv"), index=False)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Writes tax year reports for IG.com portfolios without starting the dashboard")
+    parser.add_argument("portfolios", nargs="+", help="accounts.json of each portfolio")
+    parser.add_argument("--tax-years", type=int, nargs="+", help="e.g. 2020 for 2020/21. Defaults to every year with data")
+    parser.add_argument("--out", default="reports")
+    parser.add_argument("--format", nargs="+", choices=FORMATS, default=FORMATS)
+    parser.add_argument("--workers", type=int, help="processes to use, one per CPU by default")
+    parser.add_argument("--compare-matching", action="store_true",
+                        help="also show the profit FIFO, LIFO, HIFO and average cost matching would give")
+    args = parser.parse_args(argv)
+
+    names = [account_id(portfolio_name(path)) for path in args.portfolios]
+    if len(set(names)) != len(names):
+        parser.error("each portfolio's accounts.json must be in a differently named folder")
+
+    os.makedirs(args.out, exist_ok=True)
+    results = run(args.portfolios, args.tax_years, args.out, args.format, args.workers, args.compare_matching)
+    print(f"Wrote {sum(len(r) for r in results.values())} reports for {len(results)} portfolios to {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
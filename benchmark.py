@@ -0,0 +1,150 @@
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+import ingest
+import process_data
+import synthetic_exports
+
+# Times every stage of process_data on synthetic exports of different sizes, e.g.
+#   python benchmark.py --sizes 1000 100000 --save baseline.json
+#   python benchmark.py --sizes 1000 100000 --compare baseline.json
+# Wall time is the best of --repeat runs. Peak memory is measured in a separate run with tracemalloc
+# (which slows things down) and only counts what the stage allocates, not its inputs.
+
+BENCHMARK_DIR = "./.benchmark"
+DATE_FILTER_RANGES = 1000
+
+
+def _date_filter_ranges(table, count, seed=0):
+    """ Random (start, end) date ranges within the table """
+    rnd = random.Random(seed)
+    dates = table["Date"].to_numpy()
+    ranges = []
+    for _ in range(count):
+        first, last = sorted(rnd.randrange(len(dates)) for _ in range(2))
+        ranges.append((pd.Timestamp(dates[first]), pd.Timestamp(dates[last])))
+    return ranges
+
+
+def _date_filter_many(table, ranges):
+    for start, end in ranges:
+        process_data.date_filter(start, end, table)
+
+
+def stages(account):
+    """ (stage, arguments, function, result name) for every stage, in pipeline order.
+    arguments(results) gives fresh arguments for each run, the clean_* functions change their input in place """
+    name = account["name"]
+    return [
+        ("read_trades", lambda r: (account["trades"],), ingest.read_trades, "raw_trades"),
+        ("clean_trades", lambda r: (r["raw_trades"].copy(),), process_data.clean_trades, "trades"),
+        ("trade_history_report", lambda r: (r["trades"],), process_data.trade_history_report, "report"),
+        ("read_transactions", lambda r: (account["transactions"],), ingest.read_transactions, "raw_transactions"),
+        ("clean_transactions", lambda r: (r["raw_transactions"].copy(),), process_data.clean_transactions, "transactions"),
+        ("format_dividends_datatable", lambda r: ({name: r["transactions"]},), process_data.format_dividends_datatable, "dividends"),
+        ("format_fees_datatable", lambda r: ({name: r["transactions"]},), process_data.format_fees_datatable, "fees"),
+        ("calculate_trades_summary", lambda r: (r["report"],), process_data.calculate_trades_summary, None),
+        ("calculate_dividends_summary", lambda r: (r["dividends"]["df"],), process_data.calculate_dividends_summary, None),
+        ("calculate_fees_summary", lambda r: (r["fees"]["df"],), process_data.calculate_fees_summary, None),
+        # One account on its own, so without the other side of its transfers
+        ("calculate_cashflow_summary", lambda r: ({name: r["transactions"]}, [{"name": name}]), process_data.calculate_cashflow_summary, None),
+        (f"date_filter x{DATE_FILTER_RANGES}", lambda r: (r["report"], _date_filter_ranges(r["report"], DATE_FILTER_RANGES)), _date_filter_many, None),
+    ]
+
+
+def measure(function, arguments, repeat):
+    """ Returns (result, best wall time in seconds, peak bytes allocated) """
+    times = []
+    for _ in range(repeat):
+        args = arguments()
+        gc.collect()
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+
+    args = arguments()
+    gc.collect()
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, min(times), peak
+
+
+def exports(rows, seed=0, benchmark_dir=BENCHMARK_DIR):
+    """ The synthetic Share Dealing account with rows trades and transactions, generated the first time it's asked for """
+    folder = os.path.join(benchmark_dir, f"{rows}-{seed}")
+    account = {"name": "Share Dealing",
+               "trades": os.path.join(folder, "TradeHistory (Share Dealing).csv"),
+               "transactions": os.path.join(folder, "TransactionHistory (Share Dealing).csv")}
+    if not os.path.exists(os.path.join(folder, "accounts.json")):
+        synthetic_exports.generate_accounts(folder, rows, seed)
+    return account
+
+
+def run(sizes, repeat=3, seed=0, benchmark_dir=BENCHMARK_DIR):
+    """ Yields (rows, stage, {"seconds": ..., "peak_bytes": ...}) as each stage is measured """
+    for rows in sizes:
+        account = exports(rows, seed, benchmark_dir)
+        outputs = {}
+        for stage, arguments, function, output in stages(account):
+            result, seconds, peak = measure(function, lambda: arguments(outputs), repeat)
+            if output is not None:
+                outputs[output] = result
+            yield rows, stage, {"seconds": seconds, "peak_bytes": peak}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks every process_data stage on synthetic IG.com exports")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="rows per export")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", default=BENCHMARK_DIR, help="where the generated exports are kept")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slow down (as a fraction) counted as a regression")
+    args = parser.parse_args(argv)
+    pd.set_option("mode.chained_assignment", None) # clean_trades works on a reversed view, don't warn about it on every run
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"{'rows':>9}  {'stage':<30} {'time':>11} {'peak mem':>11}" + ("  vs baseline" if baseline else ""))
+    for rows, stage, result in run(args.sizes, args.repeat, args.seed, args.dir):
+        results.setdefault(str(rows), {})[stage] = result
+        line = f"{rows:>9}  {stage:<30} {result['seconds'] * 1000:>8.1f} ms {result['peak_bytes'] / 2**20:>7.1f} MiB"
+
+        before = baseline.get(str(rows), {}).get(stage)
+        if before:
+            ratio = result["seconds"] / before["seconds"] if before["seconds"] else 1.0
+            memory_ratio = result["peak_bytes"] / before["peak_bytes"] if before["peak_bytes"] else 1.0
+            line += f"  time x{ratio:.2f}  mem x{memory_ratio:.2f}"
+            if ratio > 1 + args.tolerance or memory_ratio > 1 + args.tolerance:
+                regressions.append((rows, stage))
+                line += "  REGRESSION"
+        print(line, flush=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if regressions:
+        print(f"{len(regressions)} stage(s) slower or bigger than the baseline by more than {args.tolerance:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
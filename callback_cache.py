@@ -0,0 +1,75 @@
+import json
+import pickle
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+# Memoisation for Dash callbacks. The same few date ranges (tax years, all time...) are asked for over and over.
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class LRUCache:
+    """ Least recently used cache, limited by the total (pickled) size of its values in bytes """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key: (value, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns (True, value) if key is cached, (False, None) otherwise """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key][0]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return # would evict everything else and still not fit
+
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+
+            # Evict least recently used until we're back under budget
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "bytes": self.bytes,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+def memoize(cache, name):
+    """ Decorator caching a callback's result by name and its arguments.
+    Callbacks take the version of the data they show as an argument (the data-version Store), so results for
+    data that has since been reloaded are never reused, they're just left to be evicted """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args):
+            key = (name, json.dumps(args, sort_keys=True, default=str))
+            found, value = cache.get(key)
+            if not found:
+                value = function(*args)
+                cache.put(key, value)
+            return value
+        return wrapper
+    return decorator
@@ -0,0 +1,51 @@
+import pandas as pd
+
+# Compact storage for the tables kept in memory while the dashboard is running.
+# Repeated strings (and trade times, which repeat a lot) are held as categoricals and money as whole pence in the
+# smallest integer type that holds it, only turned back into £ for display. Money columns with blanks (rows which don't
+# close a position have no profit) use the nullable integer of that size, which needs a byte per row for the blanks.
+# Dates stay datetime64[ns], normalised to midnight: pandas 1.x only stores datetimes in ns (datetime64[D] is converted
+# back), and the date range filters search them as they are.
+
+CATEGORY_COLUMNS = ["Market", "Share Name", "Summary", "Account", "Activity", "Direction", "Time"]
+MONEY_COLUMNS = ["Consideration (£)", "Initial Consideration (£)", "Fees (£)", "Net Profit (£)", "PL Amount"]
+
+
+def to_pence(values):
+    """ £ floats to whole pence, in the smallest integer type that fits. Columns with blanks are nullable, e.g. Int32 """
+    pence = (values * 100).round()
+    smallest = pd.to_numeric(pence.dropna().astype("int64"), downcast="integer").dtype
+    if pence.isna().any():
+        return pence.astype(smallest.name.capitalize()) # int32 -> Int32
+    return pence.astype(smallest)
+
+
+def compact_table(table):
+    """ A copy of a processed table using categoricals and pence """
+    columns = {}
+    for column in table.columns:
+        if column in CATEGORY_COLUMNS:
+            columns[column] = table[column].astype("category")
+        elif column in MONEY_COLUMNS:
+            columns[column] = to_pence(table[column])
+    return table.assign(**columns)
+
+
+def expand_table(table):
+    """ Money columns of a compact table back in £. Tables that aren't compact are returned as they are """
+    money = {column: table[column].astype(float) / 100
+             for column in MONEY_COLUMNS if column in table.columns and pd.api.types.is_integer_dtype(table[column])}
+    return table.assign(**money) if money else table
+
+
+def table_bytes(table):
+    """ Memory used by a table, including the strings it points to """
+    return int(table.memory_usage(index=True, deep=True).sum())
+
+
+def memory_report(before, after):
+    """ Bytes used by each table (by name) before and after compacting """
+    report = {name: {"before": table_bytes(before[name]), "after": table_bytes(after[name])} for name in before}
+    report["total"] = {"before": sum(r["before"] for r in report.values()),
+                       "after": sum(r["after"] for r in report.values())}
+    return report
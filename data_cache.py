@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from functools import partial
+
+import pandas as pd
+
+import process_data
+from accounts import account_files
+
+# Parquet if pyarrow is installed, pickle otherwise
+try:
+    import pyarrow # noqa: F401
+    CACHE_FORMAT = "parquet"
+except ImportError:
+    CACHE_FORMAT = "pickle"
+
+CACHE_DIR = "./.cache"
+
+# Changes to any of these invalidate the cache
+CODE_FILES = ["process_data.py", "ingest.py", "lot_matching.py", "fx.py"]
+
+
+def file_hash(path):
+    """ sha256 of a file's contents """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def code_version():
+    """ Hash of the processing code, so the cache is rebuilt whenever it changes """
+    here = os.path.dirname(os.path.abspath(__file__))
+    sha = hashlib.sha256()
+    for name in CODE_FILES:
+        with open(os.path.join(here, name), "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def cache_key(files, settings=None):
+    """ Key for a set of input files: their contents plus the processing code version, and any settings that change the result """
+    sha = hashlib.sha256(code_version().encode())
+    sha.update(json.dumps(settings, sort_keys=True).encode())
+    for name in sorted(files):
+        sha.update(name.encode())
+        sha.update(file_hash(files[name]).encode())
+    return sha.hexdigest()[:32]
+
+
+def write_frame(df, path):
+    if CACHE_FORMAT == "parquet":
+        df.to_parquet(path + ".parquet")
+    else:
+        df.to_pickle(path + ".pkl")
+
+
+def read_frame(path, cache_format=CACHE_FORMAT):
+    if cache_format == "parquet":
+        return pd.read_parquet(path + ".parquet")
+    return pd.read_pickle(path + ".pkl")
+
+
+def read_tables(entry):
+    """ Reads a folder written by write_tables. Returns (frames, extra), or None if it doesn't exist or is unreadable """
+    try:
+        with open(os.path.join(entry, "manifest.json")) as f:
+            manifest = json.load(f)
+        frames = {}
+        for i, (group, name) in enumerate(manifest["tables"]):
+            df = read_frame(os.path.join(entry, str(i)), manifest["format"])
+            if group is None:
+                frames[name] = df
+            else:
+                frames.setdefault(group, {})[name] = df
+        return frames, manifest.get("extra")
+    except (OSError, ValueError, KeyError, pickle.UnpicklingError):
+        return None
+
+
+def write_tables(entry, frames, extra=None):
+    """ Saves a dict of frames (plus any JSON-able extra data) to the folder entry, replacing it.
+    Values can also be dicts of frames, e.g. {"trades": {account name: df}} """
+    parent = os.path.dirname(os.path.abspath(entry))
+    os.makedirs(parent, exist_ok=True)
+
+    # Flatten to a list of (group, name). Files are numbered, so names can be anything
+    tables = []
+    for name, value in frames.items():
+        if isinstance(value, dict):
+            tables += [(name, sub_name, df) for sub_name, df in value.items()]
+        else:
+            tables.append((None, name, value))
+
+    # Write to a temporary folder first so a half written entry is never read
+    tmp = tempfile.mkdtemp(dir=parent)
+    for i, (_, _, df) in enumerate(tables):
+        write_frame(df, os.path.join(tmp, str(i)))
+    with open(os.path.join(tmp, "manifest.json"), "w") as f:
+        json.dump({"format": CACHE_FORMAT, "tables": [[group, name] for group, name, _ in tables], "extra": extra}, f)
+
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp, entry)
+
+
+# The frames process_data.process_account returns, in order
+ACCOUNT_FRAMES = ["trades", "transactions", "lots", "rates"]
+
+
+def account_entry(account, chunked=False):
+    """ Cache entry name for one account: which files it reads (so older entries for them can be removed),
+    then the key of their contents, the account's matching and whether the exports were read in chunks.
+    Read in chunks, only the transactions the dashboard uses are kept, so the frames aren't the same """
+    files = account_files([account])
+    identity = hashlib.sha256(json.dumps(sorted(files.values())).encode()).hexdigest()[:16]
+    settings = {"matching": account.get("matching", "fifo"), "chunked": chunked}
+    return f"{identity}-{cache_key(files, settings)}"
+
+
+def read_cache(key, cache_dir=CACHE_DIR):
+    """ Returns the cached frames for this key, or None if there aren't any """
+    cached = read_tables(os.path.join(cache_dir, key))
+    return None if cached is None else cached[0]
+
+
+def write_cache(key, frames, cache_dir=CACHE_DIR):
+    """ Saves the frames under this key and removes any older entries for the same files """
+    write_tables(os.path.join(cache_dir, key), frames)
+
+    # Old entries are never valid again. Entries from before accounts were cached one by one are a 32 character key
+    identity = key.split("-")[0]
+    for name in os.listdir(cache_dir):
+        if name != key and (name.split("-")[0] == identity or len(name) == 32):
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+
+def load_data(accounts, cache_dir=CACHE_DIR, workers=None, chunksize=None):
+    """ Same as process_data.process_files, but each account's frames are loaded from disk if its files haven't changed.
+    Only accounts with new exports are processed again """
+    entries = [account_entry(account, chunked=bool(chunksize)) for account in accounts]
+    results = [read_cache(entry, cache_dir) for entry in entries]
+    stale = [i for i, frames in enumerate(results) if frames is None]
+
+    processed = process_data.map_accounts(partial(process_data.process_account, chunksize=chunksize),
+                                          [accounts[i] for i in stale], workers)
+    for i, result in zip(stale, processed):
+        results[i] = dict(zip(ACCOUNT_FRAMES, result))
+        try:
+            write_cache(entries[i], results[i], cache_dir)
+        except OSError as e:
+            print(f"Couldn't write data cache: {e}")
+
+    return process_data.combine_accounts(accounts, [[frames[name] for name in ACCOUNT_FRAMES] for frames in results])
@@ -0,0 +1,145 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Exchange rates, and showing the processed data in a currency other than £.
+# IG accounts are in £: every trade in another currency has the rate it was converted at, and dividends paid in another
+# currency say "converted at ..." in their description. Those rates, plus any from a local rates file, make a table
+# of £ per unit of each currency by date. A rate for any date is the latest one on or before it (an as-of join,
+# done for a whole column at once with merge_asof), or the earliest one known for dates before that.
+# Everything is processed and cached in £, so changing the currency shown only converts the processed tables.
+
+BASE_CURRENCY = "GBP"
+
+# Optional extra rates: a CSV with Date (YYYY-MM-DD), Currency and Rate (£ per unit) columns.
+# Needed to show a currency that none of the exports were ever converted from, e.g. EUR
+RATES_FILE = "rates.csv"
+
+RATE_COLUMNS = ["Date", "Currency", "Rate"]
+
+# Export rates are kept once per market and day
+EXPORT_RATE_KEY = ["Date", "Market", "Currency"]
+
+# Currencies whose trades are already in £ (pence prices have £ considerations), so their conversion rate is 1
+POUND_CURRENCIES = ["GBP", "GBX"]
+
+# Currencies whose prices are in a minor unit: pence, and cents for US shares (IG changed to cents recently).
+# Prices in any other currency are in whole units
+MINOR_UNITS = {"GBX": 100, "USD": 100}
+
+SYMBOLS = {"GBP": "£", "USD": "$", "EUR": "€", "JPY": "¥", "CHF": "CHF", "CAD": "C$", "AUD": "A$"}
+
+# Processed columns holding £ amounts, and the date column the rate is taken from.
+# Amounts are converted at the rate on the day of each row, so a sell's profit is the £ profit at the rate on the day it was sold
+TRADES_AMOUNTS = ["Consideration (£)", "Initial Consideration (£)", "Fees (£)", "Net Profit (£)"]
+TRANSACTIONS_AMOUNTS = ["PL Amount"]
+LOTS_AMOUNTS = ["Price (£)"] # at the rate on the day the lot was bought
+
+
+def symbol(currency):
+    return SYMBOLS.get(currency, currency)
+
+
+def price_units(currencies):
+    """ How many of each row's price units make one unit of its currency: 1 unless it's listed in MINOR_UNITS """
+    return currencies.map(MINOR_UNITS).fillna(1).to_numpy(dtype=float)
+
+
+def export_rates(trades_df):
+    """ The rates trades were converted at: Date, Market, Currency and Rate (£ per unit), one row per market and day.
+    Expects a raw trade export, in the export's order. Trades in £ and missing rates are left out """
+    foreign = ~trades_df["Currency"].isin(POUND_CURRENCIES) & (trades_df["Conversion rate"] > 0)
+    rates = pd.DataFrame({"Date": pd.to_datetime(trades_df.loc[foreign, "Date"], dayfirst=True).dt.normalize(),
+                          "Market": trades_df.loc[foreign, "Market"].str.replace(" (All Sessions)", "", regex=False),
+                          "Currency": trades_df.loc[foreign, "Currency"],
+                          "Rate": trades_df.loc[foreign, "Conversion rate"].astype(float)})
+    return rates.drop_duplicates(EXPORT_RATE_KEY, keep="last").reset_index(drop=True)
+
+
+def as_of(dates, currencies, table):
+    """ £ per unit of each row's currency on each row's date, from a rate table (see rate_table) for whole columns at once.
+    Rows in £ get 1, rows in a currency the table has no rates for get NaN """
+    query = pd.DataFrame({"Date": pd.to_datetime(np.asarray(dates)).normalize(),
+                          "Currency": np.asarray(currencies, dtype=object),
+                          "Row": np.arange(len(dates))})
+    query = query.sort_values(by="Date", kind="mergesort")
+    query = query[query["Date"].notna()]
+
+    rates = table.sort_values(by="Date", kind="mergesort")
+    merged = pd.merge_asof(query, rates[["Date", "Currency", "Rate"]], on="Date", by="Currency", direction="backward")
+
+    # Dates before a currency's first rate use that first rate
+    first = rates.groupby("Currency", sort=False)["Rate"].first()
+    merged["Rate"] = merged["Rate"].fillna(merged["Currency"].map(first))
+
+    result = np.full(len(dates), np.nan)
+    result[merged["Row"].to_numpy()] = merged["Rate"].to_numpy(dtype=float)
+    result[np.isin(np.asarray(currencies, dtype=object), POUND_CURRENCIES)] = 1.0
+    return result
+
+
+def fill_rates(trades_df, rates=None):
+    """ A trade export's "Conversion rate" column with missing (or 0) rates filled in: 1 for trades in £,
+    otherwise the rate of the nearest earlier trade in the same currency.
+    rates is export_rates of the whole export, for when trades_df is only part of it (a chunk, or new rows).
+    Without it, the rates in trades_df are used """
+    rate = trades_df["Conversion rate"].to_numpy(dtype=float)
+    missing = ~(rate > 0)
+    if not missing.any():
+        return trades_df["Conversion rate"]
+    if rates is None:
+        rates = export_rates(trades_df)
+    filled = as_of(trades_df["Date"].to_numpy()[missing], trades_df["Currency"].to_numpy()[missing],
+                   rates.drop(columns="Market"))
+    rate = rate.copy()
+    rate[missing] = filled
+    return pd.Series(rate, index=trades_df.index)
+
+
+def read_rates(path=RATES_FILE):
+    """ The local rates file, or an empty table if there isn't one """
+    if not path or not os.path.isfile(path):
+        return pd.DataFrame({"Date": pd.Series(dtype="datetime64[ns]"), "Currency": pd.Series(dtype=object),
+                             "Rate": pd.Series(dtype=float)})
+    rates = pd.read_csv(path, usecols=RATE_COLUMNS, parse_dates=["Date"])
+    rates["Date"] = rates["Date"].dt.normalize()
+    return rates
+
+
+def rate_table(rates, dividends, local_rates=None):
+    """ Date sorted table of Date, Currency, Rate (£ per unit) from every rate seen in the exports and the local rates file.
+    Expects the processed "rates" (export_rates of every account) and dividends.
+    Dividends are in the currency of the shares they were paid on. Where rates disagree on a day, the local file wins """
+    currencies = rates.drop_duplicates("Market", keep="last").set_index("Market")["Currency"]
+    dividend_rates = pd.DataFrame({"Date": dividends["Date"],
+                                   "Currency": dividends["Share Name"].map(currencies),
+                                   "Rate": pd.to_numeric(dividends["Conversion Rate"], errors="coerce")})
+    table = pd.concat([rates[RATE_COLUMNS], dividend_rates, local_rates if local_rates is not None else None],
+                      ignore_index=True)
+    table = table[table["Currency"].notna() & (table["Rate"] > 0)]
+    table = table.drop_duplicates(["Date", "Currency"], keep="last")
+    return table.sort_values(by="Date", kind="mergesort").reset_index(drop=True)
+
+
+def _converted(df, amounts, date_column, currency, table):
+    """ A copy of df with the amounts columns divided by the £ value of one unit of currency on each row's date """
+    rate = as_of(df[date_column].to_numpy(), np.full(len(df), currency, dtype=object), table)
+    return df.assign(**{column: df[column].to_numpy(dtype=float) / rate for column in amounts})
+
+
+def to_currency(data, currency, table):
+    """ Processed data (see process_data.process_files) with every £ amount converted to currency, at the rate on the
+    day of each row. Column names are kept as they are. Returns data itself when currency is £ """
+    if currency == BASE_CURRENCY:
+        return data
+    if not (table["Currency"] == currency).any():
+        raise ValueError(f"No {currency} rates in the exports or {RATES_FILE}, can't show amounts in {currency}")
+
+    return dict(data,
+                trades={name: _converted(df, TRADES_AMOUNTS, "Date", currency, table) for name, df in data["trades"].items()},
+                transactions={name: _converted(df, TRANSACTIONS_AMOUNTS, "Date", currency, table)
+                              for name, df in data["transactions"].items()},
+                lots={name: _converted(df, LOTS_AMOUNTS, "Bought", currency, table) for name, df in data["lots"].items()},
+                dividends=_converted(data["dividends"], TRANSACTIONS_AMOUNTS, "Date", currency, table),
+                fees=_converted(data["fees"], TRANSACTIONS_AMOUNTS, "Date", currency, table))
@@ -1,69 +1,312 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+from dash.dependencies import ALL, MATCH, Input, Output, State
+from dash.exceptions import PreventUpdate
 from dash_table import DataTable
-
+import flask
 import pandas as pd
-from datetime import date, timedelta
-import json
 
+from datetime import date, timedelta
+import os
+
+import callback_cache
+import compact
+import data_cache
+import fx
+import holdings
+import incremental
+import instrumentation
+import portfolio_store
 import process_data
+import summary_index
+import table_query
+import timeseries
+import watcher
+from accounts import ACCOUNTS_FILE, account_files, account_id, load_accounts
+
+# Settings. Override any of these by passing a dict to create_app
+DEFAULT_CONFIG = {
+    # Accounts and their exports. See accounts.example.json. Without the file, the Share Dealing and ISA exports in this folder are used
+    "accounts_file": ACCOUNTS_FILE,
 
-# Files
-trades_sd_raw = pd.read_csv("./TradeHistory (Share Dealing).csv")
-trades_isa_raw = pd.read_csv("./TradeHistory (ISA).csv")
-transactions_sd_raw = pd.read_csv("./TransactionHistory (Share Dealing).csv")
-transactions_isa_raw = pd.read_csv("./TransactionHistory (ISA).csv")
-
-# Tidy up raw data
-trades_sd = process_data.clean_trades(trades_sd_raw)
-trades_isa = process_data.clean_trades(trades_isa_raw)
-transactions_sd = process_data.clean_transactions(transactions_sd_raw)
-transactions_isa = process_data.clean_transactions(transactions_isa_raw)
-
-# Process trades and generate profit per position etc.
-trades_sd = process_data.trade_history_report(trades_sd)
-trades_isa = process_data.trade_history_report(trades_isa)
-
-# Process relevant Tables
-trades_column_layout = process_data.format_trades_columns(trades_sd) # we can pass either sd or isa here, same layout.
-dividends = process_data.format_dividends_datatable(transactions_sd, transactions_isa)
-fees = process_data.format_fees_datatable(transactions_sd, transactions_isa)
-cash_flow = process_data.calculate_cashflow_summary(transactions_sd, transactions_isa)
-
-# Get current tax year
-this_year = date.today().year
-if date.today() >= date(this_year, 4, 6):
-    previous_tax_year = [date(this_year-1, 4, 6), date(this_year, 4, 5)]
-else:
-    previous_tax_year = [date(this_year-2, 4, 6), date(this_year-1, 4, 5)]
-
-# Filter all dataframes by the Date.
-date_filters = [
-    trades_sd["Date"] >= previous_tax_year[0],
-    trades_sd["Date"] < previous_tax_year[1] + timedelta(days=1), # we want our date selector to include final day
-    trades_isa["Date"] >= previous_tax_year[0],
-    trades_isa["Date"] < previous_tax_year[1] + timedelta(days=1),
-    dividends["df"]["Date"] >= previous_tax_year[0],
-    dividends["df"]["Date"] < previous_tax_year[1] + timedelta(days=1),
-    fees["df"]["Date"] >= previous_tax_year[0],
-    fees["df"]["Date"] < previous_tax_year[1] + timedelta(days=1),
-]
-
-# Calculate totals - will need to be recalculated when using date range picker
-sd_trades_summary = process_data.calculate_trades_summary(trades_sd[date_filters[0] & date_filters[1]])
-isa_trades_summary = process_data.calculate_trades_summary(trades_isa[date_filters[2] & date_filters[3]])
-dividends_summary = process_data.calculate_dividends_summary(dividends["df"][date_filters[4] & date_filters[5]])
-fees_summary = process_data.calculate_fees_summary(fees["df"][date_filters[6] & date_filters[7]])
-
-# Calculate %age profit
-initial_cons = sd_trades_summary["ic"] + isa_trades_summary["ic"]
-final_cons = sd_trades_summary["fc"] + isa_trades_summary["fc"]
-net_profit_per = (final_cons/initial_cons - 1)*100
-
-app = dash.Dash(__name__)
-
-app.layout = html.Div([
+    # To serve many portfolios, a folder of them: each subfolder with an accounts.json is one, shown at /<subfolder>.
+    # None serves the accounts_file portfolio at /
+    "portfolios_dir": None,
+
+    # Most portfolios kept loaded at once. The least recently used is dropped (and reloaded when next needed)
+    "max_portfolios": portfolio_store.DEFAULT_MAX_PORTFOLIOS,
+
+    # Monthly exports overlap. When True, history is kept in ./.incremental and only rows new to each export are processed
+    "incremental": False,
+
+    # Processes used to load accounts in parallel. None for one per CPU
+    "workers": None,
+
+    # For very large exports: read this many rows at a time, keeping only what the dashboard shows. None reads whole files
+    "chunksize": None,
+
+    # Currency amounts are shown in. Exports are in £, and other currencies are converted at the rate on each row's day
+    # from the rates in the exports and rates_file (see fx). Processed data is cached in £, so changing this doesn't reprocess the exports
+    "base_currency": fx.BASE_CURRENCY,
+    "rates_file": fx.RATES_FILE,
+
+    # Keep tables in memory with categoricals and integer pence. Useful with many or very large portfolios
+    "compact": False,
+
+    # Time processing stages, callbacks and requests, shown on /metrics. ?profile=1 on a request profiles it with cProfile
+    "instrumentation": False,
+
+    # Watch the exports (and accounts files) for changes. Loaded portfolios are processed again in the background,
+    # only accounts whose exports changed, and open pages refresh once the new data is ready. Checked every watch_interval seconds
+    "watch": False,
+    "watch_interval": watcher.DEFAULT_INTERVAL,
+
+    # Memory allowed for remembering callback results (tables and summaries for date ranges already looked at)
+    "callback_cache_bytes": 64 * 1024 * 1024,
+}
+
+LOADING = "..."
+
+# Rows of the closed positions summary: (label, cell id suffix)
+TRADES_SUMMARY_ROWS = [("Initially Invested", "positions-invested"),
+                       ("Total Sold", "positions-sold"),
+                       ("Fees Associated", "fees"),
+                       ("Net Profit", "net-profit"),
+                       ("Net Profit (%)", "net-per")]
+
+FEES_SUMMARY_ROWS = [("Commission Fees", "commission-fees"),
+                     ("Section 31 Fees", "section31-fees"),
+                     ("Custody Fees", "custody-fees")]
+
+
+def positions_table_id(name):
+    return f"{account_id(name)}-positions-table"
+
+
+def component_id(kind, name):
+    """ Pattern matching id, so one callback serves the tables/cells of whichever accounts a portfolio has """
+    return {"type": kind, "name": name}
+
+
+def find_portfolios(config):
+    """ {name: accounts file} of every portfolio the server can show """
+    if config["portfolios_dir"] is None:
+        return {"": config["accounts_file"]}
+    portfolios = {}
+    for name in sorted(os.listdir(config["portfolios_dir"])):
+        path = os.path.join(config["portfolios_dir"], name, "accounts.json")
+        if os.path.isfile(path):
+            portfolios[name] = path
+    return portfolios
+
+
+def portfolio_files(config):
+    """ {portfolio: every file its data is read from}, for watching """
+    files = {}
+    for name, path in find_portfolios(config).items():
+        try:
+            accounts = load_accounts(path)
+        except (OSError, ValueError, KeyError):
+            accounts = [] # half written, its exports are watched again once it's readable
+        files[name] = [path, config["rates_file"]] + sorted(account_files(accounts).values())
+    return files
+
+
+def load_dashboard_data(config, accounts):
+    """ Reads and processes everything the dashboard shows. This is the slow part, create_app runs it in the background """
+
+    # Tidy up raw data and process trades. Loaded from ./.cache if the files haven't changed
+    if config["incremental"]:
+        data = incremental.load_data(accounts, workers=config["workers"])
+    else:
+        data = data_cache.load_data(accounts, workers=config["workers"], chunksize=config["chunksize"])
+
+    # Transfers between our accounts must add up in £. Once converted they needn't, each side is at its own day's rate
+    summary_index.check_transfers(data["transactions"], accounts)
+
+    # Everything is processed in £, then converted if shown in another currency
+    if config["base_currency"] != fx.BASE_CURRENCY:
+        rates = fx.rate_table(data["rates"], data["dividends"], fx.read_rates(config["rates_file"]))
+        data = fx.to_currency(data, config["base_currency"], rates)
+    symbol = fx.symbol(config["base_currency"])
+
+    # Running totals for the summary tables, so any date range can be totalled without re-filtering
+    summaries = summary_index.build_summary_index(data["trades"], data["dividends"], data["fees"], data["transactions"], accounts)
+
+    # The frame behind each DataTable, and its column layout
+    tables = {positions_table_id(name): trades_df for name, trades_df in data["trades"].items()}
+    columns = {table_id: process_data.format_trades_columns(trades_df, symbol) for table_id, trades_df in tables.items()}
+    tables["dividends-table"] = data["dividends"]
+    columns["dividends-table"] = process_data.format_dividends_columns(data["dividends"], symbol)
+    tables["fees-table"] = data["fees"]
+    columns["fees-table"] = process_data.format_fees_columns(data["fees"], symbol)
+
+    # Summaries are already built, so only the tables shown page by page are compacted
+    if config["compact"]:
+        compact_tables = {table_id: compact.compact_table(table) for table_id, table in tables.items()}
+    else:
+        compact_tables = tables
+
+    return {
+        "accounts": accounts,
+        "symbol": symbol,
+        "tables": compact_tables,
+        "memory": compact.memory_report(tables, compact_tables),
+        "columns": columns,
+        "summaries": summaries,
+        "cash_flow": summary_index.cashflow_summary(summaries),
+        "tax_years": summary_index.tax_years(summaries),
+        # What was held on any date, from each account's lot ledger
+        "holdings": holdings.build_holdings_index(data["lots"]),
+        # Running totals for the charts, mostly the summary tables' own
+        "series": timeseries.build_series_index(summaries, data["lots"]),
+    }
+
+
+def get_previous_tax_year():
+    """ First and last day of the last complete tax year """
+    return list(process_data.tax_year_dates(process_data.tax_year_of(date.today()) - 1))
+
+
+def money(value, symbol):
+    """ An amount as shown in the summary tables, e.g. £ 1,234.50 """
+    return f'{symbol} {value:,.2f}'
+
+def summary_cells(data, accounts, start_date, end_date):
+    """ Text for every cell of the summary tables (by id) for a date range.
+    Totals are recalculated in one go whenever the date range picker changes """
+    trades_summaries = {account["name"]: summary_index.trades_summary(data["summaries"], account["name"], start_date, end_date)
+                        for account in accounts}
+    dividends_summary = summary_index.dividends_summary(data["summaries"], start_date, end_date)
+    fees_summary = summary_index.fees_summary(data["summaries"], start_date, end_date)
+    symbol = data["symbol"]
+
+    cells = {}
+
+    # Trades
+    for account in accounts:
+        trades_summary = trades_summaries[account["name"]]
+        prefix = account_id(account["name"])
+        cells[f"{prefix}-positions-invested"] = money(trades_summary["ic"], symbol)
+        cells[f"{prefix}-positions-sold"] = money(trades_summary["sold_pos"], symbol)
+        cells[f"{prefix}-fees"] = money(trades_summary["fees"], symbol)
+        cells[f"{prefix}-net-profit"] = money(trades_summary["net_profit"], symbol)
+        cells[f"{prefix}-net-per"] = f'{trades_summary["net_profit_per"]:,.2f} %'
+
+    # Calculate %age profit
+    initial_cons = sum(summary["ic"] for summary in trades_summaries.values())
+    final_cons = sum(summary["fc"] for summary in trades_summaries.values())
+    try:
+        net_profit_per = f'{(final_cons/initial_cons - 1)*100:,.2f} %'
+    except ZeroDivisionError:
+        net_profit_per = 'N/A'
+
+    cells["trades-total-positions-invested"] = money(initial_cons, symbol)
+    cells["trades-total-positions-sold"] = money(sum(summary["sold_pos"] for summary in trades_summaries.values()), symbol)
+    cells["trades-total-fees"] = money(sum(summary["fees"] for summary in trades_summaries.values()), symbol)
+    cells["trades-total-net-profit"] = money(sum(summary["net_profit"] for summary in trades_summaries.values()), symbol)
+    cells["trades-total-net-per"] = net_profit_per
+
+    # Dividends. Accounts without any dividends have no entry
+    for account in accounts:
+        cells[f"dividends-{account_id(account['name'])}-total"] = money(dividends_summary.get(account["name"], 0.0), symbol)
+    cells["dividends-total"] = money(sum(dividends_summary.values()), symbol)
+
+    # Fees
+    cells["commission-fees"] = money(fees_summary["commission"], symbol)
+    cells["section31-fees"] = money(fees_summary["section_31"], symbol)
+    cells["custody-fees"] = money(fees_summary["custody"], symbol)
+    cells["total-fees"] = money(fees_summary["custody"] + fees_summary["section_31"] + fees_summary["commission"], symbol)
+    return cells
+
+def tax_year_options(data):
+    """ Quick-select entries for every tax year with data, latest first """
+    return [{"label": process_data.tax_year_label(year), "value": year} for year in reversed(data["tax_years"])]
+
+def to_day_number(day):
+    """ Days since 1970, as used by the holdings slider """
+    return (pd.Timestamp(day) - pd.Timestamp(0)) // pd.Timedelta(days=1)
+
+def from_day_number(days):
+    return (pd.Timestamp(0) + pd.Timedelta(days=days)).date()
+
+def holdings_slider(data):
+    """ (min, max, marks) of the holdings date slider, from the first trade to today. The start of each tax year is marked """
+    dates = holdings.holdings_dates(data["holdings"])
+    if dates is None:
+        return 0, 0, {}
+    last = max(dates[1].date(), date.today())
+    marks = {to_day_number(process_data.tax_year_dates(year)[0]): process_data.tax_year_label(year)
+             for year in range(process_data.tax_year_of(dates[0]) + 1, process_data.tax_year_of(last) + 1)}
+    return to_day_number(dates[0]), to_day_number(last), marks
+
+def cash_flow_cells(data, accounts):
+    """ Text for the cash flow table (all time), by cell id """
+    cash_flow = data["cash_flow"]
+    symbol = data["symbol"]
+    cells = {f"cf-{account_id(account['name'])}-cash-in": money(cash_flow["cash_in"][account["name"]], symbol) for account in accounts}
+    cells["cf-transfers"] = money(cash_flow["transfers"], symbol)
+    cells["cf-cash-out"] = money(cash_flow["cash_out"], symbol)
+    return cells
+
+
+def data_table(table_id):
+    """ An empty DataTable, filled in page by page by its callback, and a line for filters it can't apply """
+    return html.Div([html.P(id=component_id("table-filter-error", table_id)), DataTable(
+        id=component_id("table", table_id),
+        columns=[],
+        data=[], # "records" specifies a structure of [{column1: row1 value, column2, row2 value} {column1: row2 value...}]
+        page_count=1,
+        page_action="custom", # paging, filtering and sorting are done on the server
+        page_current=0,
+        page_size=table_query.PAGE_SIZE,
+        filter_action="custom", # add filters
+        filter_query="",
+        sort_action="custom", # column header sort buttons
+        sort_mode="multi",
+        sort_by=[],
+        style_cell={
+            "whiteSpace":"normal",
+            "height":"auto" # word wrap
+            },
+    )])
+
+
+def summary_cell(cell_id, bold=False):
+    if bold:
+        return html.Td(html.B(LOADING, id=component_id("summary-cell", cell_id)))
+    return html.Td(LOADING, id=component_id("summary-cell", cell_id))
+
+
+def cash_flow_cell(cell_id):
+    return html.Td(LOADING, id=component_id("cash-flow-cell", cell_id))
+
+
+def serve_index(portfolios):
+    """ Links to every portfolio """
+    return html.Div([
+        html.H1("Portfolios"),
+        html.Ul([html.Li(dcc.Link(name, href=f"/{name}")) for name in portfolios]),
+    ], className="partition")
+
+
+def serve_layout(accounts, portfolio="", symbol="£"):
+    """ Page skeleton for a portfolio. Tables and totals are empty until the data has loaded, then filled in by callbacks """
+    previous_tax_year = get_previous_tax_year()
+    names = [account["name"] for account in accounts]
+    prefixes = [account_id(name) for name in names]
+
+    positions = [html.H1("Positions")]
+    for account in accounts:
+        title = account["name"] + (" (HMRC share matching)" if account.get("matching") == "hmrc" else "")
+        positions += [html.H2(title), data_table(positions_table_id(account["name"]))]
+
+    return html.Div([
+                html.P("Loading data...", id="loading-message"),
+                dcc.Store(id="portfolio", data=portfolio),
+                dcc.Interval(id="data-ready-poll", interval=500), # checks whether the data has loaded yet
+                dcc.Store(id="data-version"),
                 html.Div([
                     html.H1("Date Range"),
                     dcc.DatePickerRange(
@@ -75,407 +318,348 @@ app.layout = html.Div([
                         end_date=previous_tax_year[1],
                         display_format='DD/MM/YYYY',
                     ),
+                    # Tax years are totalled when the data is loaded, so picking one here is instant
+                    dcc.Dropdown(id="tax-year", options=[], placeholder="Tax year", searchable=False,
+                                 style={"width": "200px", "display": "inline-block", "vertical-align": "middle", "margin-left": "10px"}),
                 ], className="partition"),
-                html.Div([
-                    html.H1("Positions"),
-                    html.H2("Share Dealing"),
-                    DataTable(
-                        id='sd-positions-table',
-                        columns=trades_column_layout,
-                        data=trades_sd[date_filters[0] & date_filters[1]].to_dict('records'), # "records" specifies a structure of [{column1: row1 value, column2, row2 value} {column1: row2 value...}]
-                        filter_action="native", # add filters
-                        sort_action="native", # column header sort buttons
-                        style_cell={
-                            "whiteSpace":"normal",
-                            "height":"auto" # word wrap
-                            },
-                    ),
-                    html.H2("Stocks & Shares ISA"),
-                    DataTable(
-                        id='isa-positions-table',
-                        columns=trades_column_layout,
-                        data=trades_isa[date_filters[2] & date_filters[3]].to_dict('records'), # "records" specifies a structure of [{column1: row1 value, column2, row2 value} {column1: row2 value...}]
-                        filter_action="native", # add filters
-                        sort_action="native", # column header sort buttons
-                        style_cell={
-                            "whiteSpace":"normal",
-                            "height":"auto"
-                            },
-                    ),
+                html.Div(positions + [
                     html.H2("Summary of Closed Positions"),
                         html.Table([
-                            html.Tr([
-                                html.Th(),
-                                html.Th("Share Dealing"),
-                                html.Th("ISA"),
-                                html.Th("Total"),
-                            ]),
-                            html.Tr([
-                                html.Td("Initially Invested"),
-                                html.Td(f'£ {sd_trades_summary["ic"]:,.2f}', id="sd-positions-invested"),
-                                html.Td(f'£ {isa_trades_summary["ic"]:,.2f}', id="isa-positions-invested"),
-                                html.Td(f'£ {(sd_trades_summary["ic"]+isa_trades_summary["ic"]):,.2f}', id="trades-total-invested"),
-                            ]),
-                            html.Tr([
-                                html.Td("Total Sold"),
-                                html.Td(f'£ {sd_trades_summary["sold_pos"]:,.2f}', id="sd-positions-sold"),
-                                html.Td(f'£ {isa_trades_summary["sold_pos"]:,.2f}', id="isa-positions-sold"),
-                                html.Td(f'£ {(sd_trades_summary["sold_pos"]+isa_trades_summary["sold_pos"]):,.2f}', id="trades-total-sold"),
-                            ]),
-                            html.Tr([
-                                html.Td("Fees Associated"),
-                                html.Td(f'£ {sd_trades_summary["fees"]:,.2f}', id="sd-fees"),
-                                html.Td(f'£ {isa_trades_summary["fees"]:,.2f}', id="isa-fees"),
-                                html.Td(f'£ {(sd_trades_summary["fees"]+isa_trades_summary["sold_pos"]):,.2f}', id="trades-total-fees"),
-                            ]),
-                            html.Tr([
-                                html.Td("Net Profit"),
-                                html.Td(f'£ {sd_trades_summary["net_profit"]:,.2f}', id="sd-net-profit"),
-                                html.Td(f'£ {isa_trades_summary["net_profit"]:,.2f}', id="isa-net-profit"),
-                                html.Td(f'£ {(sd_trades_summary["net_profit"]+isa_trades_summary["net_profit"]):,.2f}', id="trades-net-profit"),
-                            ]),
-                            html.Tr([
-                                html.Td("Net Profit (%)"),
-                                html.Td(f'{sd_trades_summary["net_profit_per"]:,.2f}%', id="sd-net-per"),
-                                html.Td(f'{isa_trades_summary["net_profit_per"]:,.2f}%', id="isa-net-per"),
-                                html.Td(f'{net_profit_per:,.2f}%', id="trades-net-per"),
-                            ]),
+                            html.Tr([html.Th()] + [html.Th(name) for name in names] + [html.Th("Total")]),
+                        ] + [
+                            html.Tr([html.Td(label)]
+                                    + [summary_cell(f"{prefix}-{suffix}") for prefix in prefixes]
+                                    + [summary_cell(f"trades-total-{suffix}")])
+                            for label, suffix in TRADES_SUMMARY_ROWS
                     ], className="table"),
 
                 ], className="partition"),
+
+                html.Div([
+                    html.H1("Over Time"),
+                    dcc.RadioItems(id="series-kind", value="net_profit", labelStyle={"display": "inline-block", "margin-right": "15px"},
+                                   options=[{"label": label, "value": kind} for kind, (label, _) in timeseries.SERIES.items()]),
+                    dcc.Graph(id="series-chart", config={"displayModeBar": False}),
+                ], className="partition"),
+
+                html.Div([
+                    html.H1("Holdings"),
+                    html.P(LOADING, id="holdings-date-label"),
+                    dcc.Slider(id="holdings-date", min=0, max=0, value=0, step=1, updatemode="drag"),
+                    dcc.Graph(id="holdings-chart", config={"displayModeBar": False}),
+                    DataTable(id="holdings-table", columns=holdings.format_holdings_columns(symbol), data=[], sort_action="native"),
+                ], className="partition"),
                 
                 html.Div([
                     html.H1("Dividends"),
-                    DataTable(
-                        id="dividends-table",
-                        columns=dividends["column_layout"],
-                        data=dividends["df"][date_filters[4] & date_filters[5]].to_dict("records"),
-                        filter_action="native", # add filters
-                        sort_action="native", # column header sort buttons
-                        style_cell={
-                            "whiteSpace":"normal",
-                            "height":"auto"
-                            },
-                    ),
+                    data_table("dividends-table"),
                     html.H3("Dividends Summary"),
                     html.Table([
-                        #html.Th(["", "Total"]),
                         html.Tr([
-                            html.Td("Share Dealing"),
-                            html.Td(f'£ {dividends_summary["sd_total"]:,.2f}', id="dividends-sd-total"),
-                        ]),
-                        html.Tr([
-                            html.Td("ISA"),
-                            html.Td(f'£ {dividends_summary["isa_total"]:,.2f}', id="dividends-isa-total"),
-                        ]),
+                            html.Td(name),
+                            summary_cell(f"dividends-{prefix}-total"),
+                        ]) for name, prefix in zip(names, prefixes)
+                    ] + [
                         html.Tr([
                             html.Td(html.B("Total")),
-                            html.Td(html.B(f'£ {(dividends_summary["sd_total"] + dividends_summary["isa_total"]):,.2f}', id="dividends-total")),
+                            summary_cell("dividends-total", bold=True),
                         ]),
                     ], className="table"),
                 ], className="partition"),
                 html.Div([
                     html.H1("Fees"),
-                    DataTable(
-                        id="fees-table",
-                        columns=fees["column_layout"],
-                        data=fees["df"][date_filters[6] & date_filters[7]].to_dict("records"),
-                        filter_action="native", # add filters
-                        sort_action="native", # column header sort buttons
-                        style_cell={
-                            "whiteSpace":"normal",
-                            "height":"auto"
-                            },
-                    ),
+                    data_table("fees-table"),
                     html.H3("Fees Summary"),
                     html.Table([
                         html.Tr([
-                            html.Td("Commission Fees"),
-                            html.Td(f'£ {fees_summary["commission"]:,.2f}', id="commission-fees"),
-                        ]),
-                        html.Tr([
-                            html.Td("Section 31 Fees"),
-                            html.Td(f'£ {fees_summary["section_31"]:,.2f}', id="section31-fees"),
-                        ]),
-                        html.Tr([
-                            html.Td("Custody Fees"),
-                            html.Td(f'£ {fees_summary["custody"]:,.2f}', id="custody-fees"),
-                        ]),
+                            html.Td(label),
+                            summary_cell(cell_id),
+                        ]) for label, cell_id in FEES_SUMMARY_ROWS
+                    ] + [
                         html.Tr([
                             html.Td(html.B("Total")),
-                            html.Td(html.B(f'£ {(fees_summary["commission"]+fees_summary["section_31"]+fees_summary["custody"]):,.2f}', id="total-fees")),
+                            summary_cell("total-fees", bold=True),
                         ]),
                     ], className="table"),
                 ], className="partition"),
 
                 html.Div([
                     html.H1("Summary of Cash Flow (All Time)"),
-                        html.P(["Describes all cash flow invested into Share Dealing and ISA accounts, money transferred between those accounts, and money withdrawn."]),
+                        html.P(["Describes all cash flow invested into each account, money transferred between accounts, and money withdrawn."]),
                         html.Table([
                             html.Tr([
                                 html.Th(),
                                 html.Th("Cash Transferred"),
                             ]),
+                        ] + [
                             html.Tr([
-                                html.Td("Cash to Share Dealing"),
-                                html.Td(f'£ {cash_flow["sd_cash_in"]:,.2f}', id="cf-sd-cash-in"),
-                            ]),
-                            html.Tr([
-                                html.Td("Cash To ISA"),
-                                html.Td(f'£ {cash_flow["isa_cash_in"]:,.2f}', id="isa-sd-cash-in"),
-                            ]),
+                                html.Td(f"Cash to {name}"),
+                                cash_flow_cell(f"cf-{prefix}-cash-in"),
+                            ]) for name, prefix in zip(names, prefixes)
+                        ] + [
                             html.Tr([
-                                html.Td("Share Dealing to ISA"),
-                                html.Td(f'£ {cash_flow["sd_to_isa"]:,.2f}', id="cf-sd-to-isa"),
+                                html.Td("Transfers Between Accounts"),
+                                cash_flow_cell("cf-transfers"),
                             ]),
                             html.Tr([
                                 html.Td("Cash Withdrawn"),
-                                html.Td(f'£ {cash_flow["cash_out"]:,.2f}', id="cf-cash-out"),
+                                cash_flow_cell("cf-cash-out"),
                             ]),
                     ], className="table"),
                 
                 ], className="partition"),
                 
-                dcc.Store(id='trades-summary-data'), # we use this to store values for summary tables
-                dcc.Store(id='summary-data'),
-
 ], style={"margin":"auto", "width":"100%", "max-width":"1200px", "min-width":"900px"})
 
-
-# Share Dealing Table
-@app.callback(
-    dash.dependencies.Output('sd-positions-table', 'data'),
-    [dash.dependencies.Input('date-picker-range', 'start_date'),
-     dash.dependencies.Input('date-picker-range', 'end_date')])
-def update_sd_table(start_date, end_date):
-    new_df = process_data.date_filter(start_date, end_date, trades_sd)
-    return new_df.to_dict('records')
-
-# ISA Table
-@app.callback(
-    dash.dependencies.Output('isa-positions-table', 'data'),
-    [dash.dependencies.Input('date-picker-range', 'start_date'),
-     dash.dependencies.Input('date-picker-range', 'end_date')])
-def update_isa_table(start_date, end_date):
-    new_df = process_data.date_filter(start_date, end_date, trades_isa)
-    return new_df.to_dict('records')
-
-# Dividends Table
-@app.callback(
-    dash.dependencies.Output('dividends-table', 'data'),
-    [dash.dependencies.Input('date-picker-range', 'start_date'),
-     dash.dependencies.Input('date-picker-range', 'end_date')])
-def update_dividends_table(start_date, end_date):
-    new_df = process_data.date_filter(start_date, end_date, dividends["df"])
-    return new_df.to_dict('records')
-
-# Fees Table
-@app.callback(
-    dash.dependencies.Output('fees-table', 'data'),
-    [dash.dependencies.Input('date-picker-range', 'start_date'),
-     dash.dependencies.Input('date-picker-range', 'end_date')])
-def update_fees_table(start_date, end_date):
-    new_df = process_data.date_filter(start_date, end_date, fees["df"])
-    return new_df.to_dict('records')
-
-# Update Summary HTML tables
-# This is achieved by first updating the Dataframes, getting the relevant data and storing it as JSON in a Dash data object
-
-# Trades HTML tables
-@app.callback(
-    dash.dependencies.Output('trades-summary-data', 'data'), # we first update a hidden data cell
-    [dash.dependencies.Input('date-picker-range', 'start_date'),
-     dash.dependencies.Input('date-picker-range', 'end_date')])
-def update_trades_summary(start_date, end_date):
-    sd_df = process_data.date_filter(start_date, end_date, trades_sd)
-    isa_df = process_data.date_filter(start_date, end_date, trades_isa)
-    sd_summary = process_data.calculate_trades_summary(sd_df)
-    isa_summary = process_data.calculate_trades_summary(isa_df)
-
-    data = {"sd": sd_summary, "isa": isa_summary}
-    return json.dumps(data)
-
-@app.callback(
-    dash.dependencies.Output('sd-positions-invested', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_1(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["sd"]["ic"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('isa-positions-invested', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_2(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["isa"]["ic"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('trades-total-invested', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_3(data):
-    summary_data = json.loads(data)
-    return f'£ {(summary_data["sd"]["ic"] + summary_data["isa"]["ic"]):,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('sd-positions-sold', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_1(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["sd"]["sold_pos"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('isa-positions-sold', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_2(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["isa"]["sold_pos"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('trades-total-sold', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_3(data):
-    summary_data = json.loads(data)
-    return f'£ {(summary_data["sd"]["sold_pos"] + summary_data["isa"]["sold_pos"]):,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('sd-fees', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_4(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["sd"]["fees"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('isa-fees', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_5(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["isa"]["fees"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('trades-total-fees', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_6(data):
-    summary_data = json.loads(data)
-    return f'£ {(summary_data["sd"]["fees"] + summary_data["isa"]["fees"]):,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('sd-net-profit', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_7(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["sd"]["net_profit"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('isa-net-profit', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_8(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["isa"]["net_profit"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('trades-net-profit', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_9(data):
-    summary_data = json.loads(data)
-    return f'£ {(summary_data["sd"]["net_profit"] + summary_data["isa"]["net_profit"]):,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('sd-net-per', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_10(data):
-    summary_data = json.loads(data)
-    return f'{summary_data["sd"]["net_profit_per"]:,.2f} %'
-
-@app.callback(
-    dash.dependencies.Output('isa-net-per', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_11(data):
-    summary_data = json.loads(data)
-    return f'{summary_data["isa"]["net_profit_per"]:,.2f} %'
-
-@app.callback(
-    dash.dependencies.Output('trades-net-per', 'children'),
-    [dash.dependencies.Input('trades-summary-data', 'data')])
-def update_trades_12(data):
-    summary_data = json.loads(data)
-
-    initial_cons = summary_data["sd"]["ic"] + summary_data["isa"]["ic"]
-    final_cons = summary_data["sd"]["fc"] + summary_data["isa"]["fc"]
-    try:
-        net_profit_per = (final_cons/initial_cons - 1)*100
-        return f'{net_profit_per:,.2f} %'
-    except ZeroDivisionError:
-        return 'N/A'
-
-
-# Fees and Dividends HTML tables
-@app.callback(
-    dash.dependencies.Output('summary-data', 'data'), # we first update a hidden data cell
-    [dash.dependencies.Input('date-picker-range', 'start_date'),
-     dash.dependencies.Input('date-picker-range', 'end_date')])
-def update_summary(start_date, end_date):
-    new_df1 = process_data.date_filter(start_date, end_date, dividends["df"])
-    new_df2 = process_data.date_filter(start_date, end_date, fees["df"])
-    dividends_summary = process_data.calculate_dividends_summary(new_df1)
-    fees_summary = process_data.calculate_fees_summary(new_df2)
-
-    data = {"sd_total": dividends_summary["sd_total"], "isa_total": dividends_summary["isa_total"],
-    "section_31": fees_summary["section_31"], "custody": fees_summary["custody"], "commission": fees_summary["commission"]}
-
-    return json.dumps(data)
-
-@app.callback(
-    dash.dependencies.Output('dividends-sd-total', 'children'),
-    [dash.dependencies.Input('summary-data', 'data')])
-def update_dividends1(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["sd_total"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('dividends-isa-total', 'children'),
-    [dash.dependencies.Input('summary-data', 'data')])
-def update_dividends2(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["isa_total"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('dividends-total', 'children'),
-    [dash.dependencies.Input('summary-data', 'data')])
-def update_dividends3(data):
-    summary_data = json.loads(data)
-    return f'£ {(summary_data["sd_total"] + summary_data["isa_total"]):,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('commission-fees', 'children'),
-    [dash.dependencies.Input('summary-data', 'data')])
-def update_fees1(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["commission"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('section31-fees', 'children'),
-    [dash.dependencies.Input('summary-data', 'data')])
-def update_fees2(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["section_31"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('custody-fees', 'children'),
-    [dash.dependencies.Input('summary-data', 'data')])
-def update_fees3(data):
-    summary_data = json.loads(data)
-    return f'£ {summary_data["custody"]:,.2f}'
-
-@app.callback(
-    dash.dependencies.Output('total-fees', 'children'),
-    [dash.dependencies.Input('summary-data', 'data')])
-def update_fees4(data):
-    summary_data = json.loads(data)
-    return f'£ {(summary_data["custody"] + summary_data["section_31"] + summary_data["commission"]):,.2f}'
+def create_app(config=None):
+    """ Builds the Dash app. Pages are served straight away, and each portfolio's data is loaded in the background
+    the first time it's looked at (or at start up when there's only one) """
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    many = config["portfolios_dir"] is not None
+
+    app = dash.Dash(__name__)
+    # The page is built for the portfolio in the URL, so its components aren't in the initial layout
+    app.config.suppress_callback_exceptions = True
+    app.layout = html.Div([dcc.Location(id="url"), html.Div(id="page")])
+    if config["instrumentation"]:
+        instrumentation.enable()
+        instrumentation.instrument_server(app.server)
+
+    def load_portfolio(name):
+        portfolios = find_portfolios(config)
+        if name not in portfolios:
+            raise KeyError(f"No portfolio called {name!r}")
+        return load_dashboard_data(config, load_accounts(portfolios[name]))
+
+    # Loaded portfolios. Each one's data is replaced as a whole when (re)loaded, never modified
+    store = portfolio_store.PortfolioStore(load_portfolio, config["max_portfolios"])
+    callback_results = callback_cache.LRUCache(config["callback_cache_bytes"])
+    app.dashboard = {"store": store, "callback_results": callback_results, "config": config}
+
+    def get_data(portfolio, version):
+        """ A portfolio's data, once the page has been told it's loaded. Loads it again if it has been dropped since """
+        if version is None:
+            raise PreventUpdate
+        try:
+            return store.get(portfolio)[0]
+        except Exception:
+            raise PreventUpdate
+
+    # Process is up
+    @app.server.route("/health")
+    def health():
+        return flask.jsonify({"status": "ok"})
+
+    # Data is loaded and the dashboard can be used. With many portfolios, ?portfolio=name checks one of them
+    @app.server.route("/ready")
+    def ready():
+        portfolio = flask.request.args.get("portfolio", None if many else "")
+        if portfolio is None:
+            return flask.jsonify({"ready": True, "portfolios": store.stats()["resident"]})
+        loaded = store.peek(portfolio)
+        body = {"ready": loaded is not None, "version": loaded[1] if loaded else None, "error": store.error(portfolio)}
+        return flask.jsonify(body), 200 if body["ready"] else 503
+
+    # Cache hit/miss counters
+    @app.server.route("/cache-stats")
+    def cache_stats():
+        return flask.jsonify(callback_results.stats())
+
+    # Portfolio loads and evictions
+    @app.server.route("/store-stats")
+    def store_stats():
+        return flask.jsonify(store.stats())
+
+    # Prometheus metrics. Histograms are empty unless instrumentation is on
+    @app.server.route("/metrics")
+    def metrics():
+        lines = [instrumentation.REGISTRY.exposition()]
+        for name, value in callback_results.stats().items():
+            lines.append(f"# TYPE ig_callback_cache_{name} gauge\nig_callback_cache_{name} {value}\n")
+        stats = store.stats()
+        stats["resident"] = len(stats["resident"])
+        stats["loading"] = len(stats["loading"])
+        for name, value in stats.items():
+            lines.append(f"# TYPE ig_portfolio_store_{name} gauge\nig_portfolio_store_{name} {value}\n")
+        return flask.Response("".join(lines), mimetype="text/plain; version=0.0.4")
+
+    # Bytes used by each table, before and after compacting
+    @app.server.route("/memory-report")
+    def memory_report():
+        loaded = store.peek(flask.request.args.get("portfolio", ""))
+        if loaded is None:
+            return flask.jsonify({"ready": False}), 503
+        return flask.jsonify(loaded[0]["memory"])
+
+    # The page for the portfolio in the URL
+    @app.callback(Output("page", "children"), [Input("url", "pathname")])
+    @instrumentation.callback("render_page")
+    def render_page(pathname):
+        name = (pathname or "/").strip("/")
+        portfolios = find_portfolios(config)
+        if many and name == "":
+            return serve_index(portfolios)
+        if name not in portfolios:
+            return html.P(f"There's no portfolio called {name}")
+        store.get(name, wait=False) # start loading it now
+        return serve_layout(load_accounts(portfolios[name]), name, fx.symbol(config["base_currency"]))
+
+    # Fill in the page once the data has loaded
+    @app.callback(
+        [Output("data-version", "data"),
+         Output("data-ready-poll", "disabled"),
+         Output("data-ready-poll", "interval"),
+         Output("loading-message", "children"),
+         Output("tax-year", "options"),
+         Output(component_id("table", ALL), "columns"),
+         Output(component_id("cash-flow-cell", ALL), "children")],
+        [Input("data-ready-poll", "n_intervals")],
+        [State("portfolio", "data"),
+         State("data-version", "data")])
+    @instrumentation.callback("check_data_ready")
+    def check_data_ready(n_intervals, portfolio, current_version):
+        tables, cells = dash.callback_context.outputs_list[5:]
+        loaded = store.peek(portfolio)
+        if loaded is None:
+            if store.is_loading(portfolio):
+                raise PreventUpdate
+            error = store.error(portfolio)
+            if error is not None:
+                return [dash.no_update, True, dash.no_update, f"Couldn't load data: {error}", dash.no_update,
+                        [dash.no_update] * len(tables), [dash.no_update] * len(cells)]
+            store.get(portfolio, wait=False)
+            raise PreventUpdate
+
+        data, version = loaded
+        if version == current_version:
+            raise PreventUpdate
+        # When watching, keep polling (more slowly) so the page refreshes when the data is loaded again.
+        # Accounts added to or removed from the page's portfolio only show once the page is reloaded
+        cash_flow = cash_flow_cells(data, data["accounts"])
+        return [version, not config["watch"], config["watch_interval"] * 1000, "", tax_year_options(data),
+                [data["columns"].get(output["id"]["name"], dash.no_update) for output in tables],
+                [cash_flow.get(output["id"]["name"], dash.no_update) for output in cells]]
+
+    # Tax year quick-select sets the date range
+    @app.callback(
+        [Output('date-picker-range', 'start_date'),
+         Output('date-picker-range', 'end_date')],
+        [Input('tax-year', 'value')])
+    @instrumentation.callback("select_tax_year")
+    def select_tax_year(year):
+        if year is None:
+            raise PreventUpdate
+        return list(process_data.tax_year_dates(year))
+
+    # Running totals over the date range. Sliced from arrays built at load time, and thinned out to a few hundred points
+    @app.callback(
+        Output("series-chart", "figure"),
+        [Input('date-picker-range', 'start_date'),
+         Input('date-picker-range', 'end_date'),
+         Input("series-kind", "value"),
+         Input('data-version', 'data')],
+        [State("portfolio", "data")])
+    @instrumentation.callback("series")
+    @callback_cache.memoize(callback_results, "series")
+    def update_series(start_date, end_date, kind, version, portfolio):
+        data = get_data(portfolio, version)
+        return timeseries.series_figure(data["series"], kind, start_date, end_date, symbol=data["symbol"])
+
+    # Holdings slider runs from the first trade to today, and starts at today
+    @app.callback(
+        [Output("holdings-date", "min"),
+         Output("holdings-date", "max"),
+         Output("holdings-date", "marks"),
+         Output("holdings-date", "value")],
+        [Input("data-version", "data")],
+        [State("portfolio", "data")])
+    @instrumentation.callback("holdings_slider")
+    def setup_holdings_slider(version, portfolio):
+        first, last, marks = holdings_slider(get_data(portfolio, version))
+        return first, last, marks, last
+
+    # Holdings as of the slider's date. Answered from the holdings index, so it keeps up while the slider is dragged
+    @app.callback(
+        [Output("holdings-table", "data"),
+         Output("holdings-chart", "figure"),
+         Output("holdings-date-label", "children")],
+        [Input("holdings-date", "value"),
+         Input("data-version", "data")],
+        [State("portfolio", "data")])
+    @instrumentation.callback("holdings")
+    @callback_cache.memoize(callback_results, "holdings")
+    def update_holdings(day_number, version, portfolio):
+        day = from_day_number(day_number)
+        data = get_data(portfolio, version)
+        held = holdings.holdings_at(data["holdings"], day)
+        return held.to_dict("records"), holdings.holdings_figure(held, data["symbol"]), f"Held at the end of {day:%d/%m/%Y}"
+
+    # DataTables. Only the current page of the date range, filtered and sorted on the server, is sent back
+    @app.callback(
+        [Output(component_id("table", MATCH), 'data'),
+         Output(component_id("table", MATCH), 'page_count'),
+         Output(component_id("table-filter-error", MATCH), 'children')],
+        [Input('date-picker-range', 'start_date'),
+         Input('date-picker-range', 'end_date'),
+         Input(component_id("table", MATCH), 'page_current'),
+         Input(component_id("table", MATCH), 'page_size'),
+         Input(component_id("table", MATCH), 'sort_by'),
+         Input(component_id("table", MATCH), 'filter_query'),
+         Input('data-version', 'data')],
+        [State(component_id("table", MATCH), 'id'),
+         State("portfolio", "data")])
+    @instrumentation.callback("table")
+    @callback_cache.memoize(callback_results, "table")
+    def update_table(start_date, end_date, page_current, page_size, sort_by, filter_query, version, table_id, portfolio):
+        # An account removed since the page was loaded keeps what it shows until the page is reloaded
+        table = get_data(portfolio, version)["tables"].get(table_id["name"])
+        if table is None:
+            raise PreventUpdate
+        try:
+            records, page_count = table_query.query_table(table, start_date, end_date, page_current, page_size, sort_by,
+                                                          filter_query)
+        except ValueError as error:
+            return [], 1, str(error)
+        return records, page_count, ""
+
+    # Update Summary HTML tables
+    # Every cell is updated by a single callback, so one date change is one request
+    @callback_cache.memoize(callback_results, "summary")
+    def cached_summary_cells(start_date, end_date, version, portfolio):
+        data = get_data(portfolio, version)
+        return summary_cells(data, data["accounts"], start_date, end_date)
+
+    @app.callback(
+        Output(component_id("summary-cell", ALL), 'children'),
+        [Input('date-picker-range', 'start_date'),
+         Input('date-picker-range', 'end_date'),
+         Input('data-version', 'data')],
+        [State("portfolio", "data")])
+    @instrumentation.callback("summary")
+    def update_summary(start_date, end_date, version, portfolio):
+        cells = cached_summary_cells(start_date, end_date, version, portfolio)
+        return [cells.get(output["id"]["name"], dash.no_update) for output in dash.callback_context.outputs_list]
+
+    # Portfolios whose files change are loaded again, if they're loaded. Otherwise they'll be read as they are when they're next needed
+    def files_changed(name):
+        if store.peek(name) is None:
+            return not store.is_loading(name) # a load already under way may have read the old files
+        return store.refresh(name)
+
+    if config["watch"]:
+        app.dashboard["watcher"] = watcher.Watcher(lambda: portfolio_files(config), files_changed, config["watch_interval"])
+        app.dashboard["watcher"].start()
+
+    # With a single portfolio, start loading it straight away
+    if not many:
+        store.get("", wait=False)
+    return app
+
+
+def create_server(config=None):
+    """ The underlying Flask server, for running under a WSGI server e.g. gunicorn "generate_report:create_server()" """
+    return create_app(config).server
 
 
 if __name__ == "__main__":
-    app.run_server()
-
-
-
+    create_app().run_server()
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import process_data
+
+# What was held on any date, from the lot ledger.
+# Each lot adds its quantity and cost on the day it was opened and takes them away on the day it was closed.
+# Those changes are summed up once per market when the data is loaded, so the holdings on any date are one
+# binary search per market rather than a replay of the trade history.
+
+HOLDINGS_COLUMNS = ["Account", "Market", "Quantity", "Average Cost (£)", "Cost (£)"]
+
+# Quantities left over from adding and taking away the same lots
+EPSILON = 1e-6
+
+
+def _changes(ledger):
+    """ Quantity and cost added when each lot was opened and taken away when it was closed, in date order """
+    cost = ledger["Quantity"] * ledger["Price (£)"]
+    changes = pd.DataFrame({"Market": pd.concat([ledger["Market"], ledger["Market"]], ignore_index=True),
+                            "Date": pd.concat([ledger["Opened"], ledger["Closed"]], ignore_index=True),
+                            "qty": pd.concat([ledger["Quantity"], -ledger["Quantity"]], ignore_index=True),
+                            "cost": pd.concat([cost, -cost], ignore_index=True)})
+    return changes[changes["Date"].notna()].sort_values(by="Date", kind="mergesort")
+
+
+@instrumentation.stage("build_holdings_index")
+def build_holdings_index(lots):
+    """ Expects {account name: lot ledger} (see process_data.lot_ledger).
+    Returns {(account, market): {"dates", "qty", "cost"}}: the sorted dates of every change, and the quantity and cost
+    held after each, with a leading 0 for before the first """
+    index = {}
+    for account, ledger in lots.items():
+        for market, rows in _changes(ledger).groupby("Market", sort=False):
+            index[(account, market)] = {"dates": rows["Date"].to_numpy(),
+                                        "qty": np.concatenate([[0.0], np.cumsum(rows["qty"].to_numpy(dtype=float))]),
+                                        "cost": np.concatenate([[0.0], np.cumsum(rows["cost"].to_numpy(dtype=float))])}
+    return index
+
+
+def cost_over_time(ledger):
+    """ (dates, cost of everything held after each) for one account's lot ledger, with a leading 0 like the index """
+    changes = _changes(ledger)
+    return changes["Date"].to_numpy(), np.concatenate([[0.0], np.cumsum(changes["cost"].to_numpy(dtype=float))])
+
+
+def holdings_dates(index):
+    """ (first, last) date anything was bought or sold, or None if nothing ever was """
+    dates = [sums["dates"] for sums in index.values() if len(sums["dates"])]
+    if not dates:
+        return None
+    return pd.Timestamp(min(d[0] for d in dates)), pd.Timestamp(max(d[-1] for d in dates))
+
+
+def holdings_at(index, day):
+    """ What each account held at the end of day: quantity, average cost per share and total cost of each market.
+    Largest holdings first """
+    rows = []
+    for (account, market), sums in index.items():
+        _, i = process_data.date_bounds(sums["dates"], None, day)
+        qty = sums["qty"][i]
+        if qty > EPSILON:
+            rows.append((account, market, round(qty, 4), round(sums["cost"][i] / qty, 4), round(sums["cost"][i], 2)))
+    holdings = pd.DataFrame(rows, columns=HOLDINGS_COLUMNS)
+    return holdings.sort_values(by=["Account", "Cost (£)"], ascending=[True, False], kind="mergesort")
+
+
+def format_holdings_columns(symbol="£"):
+    """ Column layout for the holdings DataTable, with amounts in symbol's currency """
+    column_layout = [{"name": i.replace("£", symbol), "id": i} for i in HOLDINGS_COLUMNS]
+    column_layout[2]["type"] = "numeric"
+    for i in range(3, 5):
+        column_layout[i]["type"] = "numeric"
+        column_layout[i]["format"] = process_data.money_format(symbol)
+    return column_layout
+
+
+def holdings_figure(holdings, symbol="£"):
+    """ Bar chart of the cost of each holding, a bar per market for each account """
+    return {"data": [{"type": "bar", "name": account, "x": rows["Market"].tolist(), "y": rows["Cost (£)"].tolist()}
+                     for account, rows in holdings.groupby("Account", sort=False)],
+            "layout": {"barmode": "group", "yaxis": {"title": f"Cost ({symbol})"}, "margin": {"t": 20}}}
@@ -0,0 +1,137 @@
+import os
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import data_cache
+import fx
+import ingest
+import instrumentation
+import process_data
+from accounts import account_id
+
+# Everything seen so far is kept here, one folder per export
+INCREMENTAL_DIR = "./.incremental"
+
+
+def fingerprint(raw_df):
+    """ A uint64 fingerprint per row, so the same row can be recognised in overlapping exports.
+    Identical rows within an export (e.g. two identical trades in the same second) are told apart by how many came before """
+    row_hash = pd.util.hash_pandas_object(raw_df, index=False)
+    occurrence = row_hash.groupby(row_hash).cumcount()
+    return pd.util.hash_pandas_object(pd.DataFrame({"row": row_hash, "n": occurrence}), index=False).to_numpy()
+
+
+def _new_rows(raw_df, stored_raw):
+    """ Rows of raw_df not already in stored_raw. Both are in export order (newest first) """
+    raw_df = raw_df.copy()
+    raw_df["Fingerprint"] = fingerprint(raw_df)
+    if stored_raw is None:
+        return raw_df
+    return raw_df[~np.isin(raw_df["Fingerprint"].to_numpy(), stored_raw["Fingerprint"].to_numpy())]
+
+
+def _read_entry(entry):
+    """ Previously stored frames and state for an export, or None if there aren't any or the processing code has changed since """
+    stored = data_cache.read_tables(entry)
+    if stored is None or stored[1] is None or stored[1].get("code_version") != data_cache.code_version():
+        return None
+    return stored
+
+
+def _previous_raw(entry, columns):
+    """ Raw rows kept by an earlier run, or None if there aren't any.
+    Rows read with different columns (by an older version) can't be recognised again, so they aren't kept either """
+    previous = data_cache.read_tables(entry)
+    if previous is None or set(previous[0]["raw"].columns) != set(columns) | {"Fingerprint"}:
+        return None
+    return previous[0]["raw"]
+
+
+def update_trades(path, entry, matching="fifo"):
+    """ Processes only the trades in the export at path that haven't been seen before,
+    carrying on the lot matching from the open positions left by the previous run.
+    HMRC matching can change for trades up to 30 days before new ones, so all trades are matched again.
+    Returns the full processed trade history, lot ledger and conversion rates """
+    stored = _read_entry(entry)
+    if stored is not None and stored[1].get("matching", "fifo") != matching:
+        stored = None
+    if stored is None:
+        # Start again from whatever raw rows we've kept, if any
+        stored_raw = _previous_raw(entry, ingest.TRADES_COLUMNS)
+        new_raw = _new_rows(ingest.read_trades(path), stored_raw)
+        rebuild = True
+    else:
+        frames, state = stored
+        open_lots = {market: process_data.lots_for(matching).from_state(lots) for market, lots in state["open_lots"].items()}
+        stored_raw, processed, closed_lots = frames["raw"], frames["processed"], frames["closed_lots"]
+        new_raw = _new_rows(ingest.read_trades(path), stored_raw)
+        if new_raw.empty:
+            return (processed, pd.concat([closed_lots, process_data.ledger_frame(process_data.open_lot_rows(open_lots))], ignore_index=True),
+                    fx.export_rates(stored_raw))
+        # Missing rates of new trades are filled in from the whole stored history, as if it had all been read at once
+        rates = fx.export_rates(pd.concat([new_raw, stored_raw]))
+        new_trades = process_data.clean_trades(new_raw.drop(columns="Fingerprint"), rates)
+        # Trades older than ones we've already matched mean positions have to be matched again from the start
+        rebuild = new_trades["Date"].min() < pd.Timestamp(state["last_date"]) or matching == "hmrc"
+
+    all_raw = pd.concat([new_raw, stored_raw]) if stored_raw is not None else new_raw
+    rates = fx.export_rates(all_raw)
+    ledger = []
+    if rebuild:
+        open_lots = {}
+        processed = process_data.trade_history_report(process_data.clean_trades(all_raw.drop(columns="Fingerprint"), rates), open_lots, ledger, matching)
+        closed_lots = process_data.ledger_frame(ledger)
+    else:
+        processed = pd.concat([processed, process_data.trade_history_report(new_trades, open_lots, ledger, matching)])
+        closed_lots = pd.concat([closed_lots, process_data.ledger_frame(ledger)])
+
+    processed = processed.reset_index(drop=True)
+    closed_lots = closed_lots.reset_index(drop=True)
+    state = {"code_version": data_cache.code_version(),
+             "open_lots": {market: book.state() for market, book in open_lots.items()},
+             "matching": matching,
+             "last_date": str(processed["Date"].max())}
+    data_cache.write_tables(entry, {"raw": all_raw.reset_index(drop=True), "processed": processed, "closed_lots": closed_lots}, state)
+    return (processed, pd.concat([closed_lots, process_data.ledger_frame(process_data.open_lot_rows(open_lots))], ignore_index=True),
+            rates)
+
+
+def update_transactions(path, entry):
+    """ Cleans only the transactions in the export at path that haven't been seen before.
+    Returns the full cleaned transaction history """
+    stored = _read_entry(entry)
+    if stored is None:
+        stored_raw = _previous_raw(entry, ingest.TRANSACTIONS_COLUMNS)
+        new_raw = _new_rows(ingest.read_transactions(path), stored_raw)
+        all_raw = pd.concat([new_raw, stored_raw]) if stored_raw is not None else new_raw
+        cleaned = process_data.clean_transactions(all_raw.drop(columns="Fingerprint"))
+    else:
+        stored_raw, cleaned = stored[0]["raw"], stored[0]["cleaned"]
+        new_raw = _new_rows(ingest.read_transactions(path), stored_raw)
+        if new_raw.empty:
+            return cleaned
+        all_raw = pd.concat([new_raw, stored_raw])
+        cleaned = pd.concat([process_data.clean_transactions(new_raw.drop(columns="Fingerprint")), cleaned])
+
+    cleaned = cleaned.reset_index(drop=True)
+    data_cache.write_tables(entry, {"raw": all_raw.reset_index(drop=True), "cleaned": cleaned},
+                            {"code_version": data_cache.code_version()})
+    return cleaned
+
+
+@instrumentation.stage("update_account")
+def update_account(account, incremental_dir=INCREMENTAL_DIR):
+    """ Brings one account's stored history up to date with its latest exports.
+    Returns (trades, transactions, lot ledger, conversion rates) """
+    folder = os.path.join(incremental_dir, account_id(account["name"]))
+    trades_df, lots_df, rates_df = update_trades(account["trades"], os.path.join(folder, "trades"), account.get("matching", "fifo"))
+    transactions_df = update_transactions(account["transactions"], os.path.join(folder, "transactions"))
+    return trades_df, transactions_df, lots_df, rates_df
+
+
+def load_data(accounts, incremental_dir=INCREMENTAL_DIR, workers=None):
+    """ Same as process_data.process_files, but only processes rows that weren't in previous exports """
+    results = process_data.map_accounts(partial(update_account, incremental_dir=incremental_dir), accounts, workers)
+    return process_data.combine_accounts(accounts, results)
@@ -0,0 +1,71 @@
+import pandas as pd
+
+import instrumentation
+
+# IG.com export schemas
+# Only the columns we actually use are read, with their types declared up front so
+# pandas can do all of the parsing in C rather than us fixing things up row by row.
+
+TRADES_COLUMNS = {
+    "Date": str,
+    "Time": str,
+    "Activity": str,
+    "Market": str,
+    "Direction": str,
+    "Quantity": float,
+    "Price": float,
+    "Currency": str,
+    "Consideration": float,
+    "Commission": float,
+    "Charges": float,
+    "Conversion rate": float,
+}
+TRADES_DATE_FORMAT = "%d-%m-%Y"
+
+TRANSACTIONS_COLUMNS = {
+    "Date": str,
+    "Summary": str,
+    "MarketName": str,
+    "PL Amount": float, # IG writes these as "1,234.56", handled by thousands=","
+}
+TRANSACTIONS_DATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+
+
+def parse_dates(dates, date_format):
+    """ Vectorised date parse using the export's date format.
+    Anything that doesn't match the format (IG isn't always consistent) falls back to a day first parse """
+    parsed = pd.to_datetime(dates, format=date_format, errors="coerce")
+    unparsed = parsed.isna() & dates.notna()
+    if unparsed.any():
+        parsed[unparsed] = pd.to_datetime(dates[unparsed], dayfirst=True)
+    return parsed
+
+
+def read_export(path, columns, date_format, chunksize=None):
+    """ Reads an IG.com csv export using the given column schema.
+    With a chunksize, returns an iterator of DataFrames of up to chunksize rows instead, so the whole file is never in memory """
+    reader = pd.read_csv(path,
+                        usecols=list(columns),
+                        dtype=columns,
+                        thousands=",",
+                        chunksize=chunksize)
+    if chunksize is None:
+        return _with_dates(reader, date_format)
+    return (_with_dates(chunk, date_format) for chunk in reader)
+
+
+def _with_dates(df, date_format):
+    df["Date"] = parse_dates(df["Date"], date_format)
+    return df
+
+
+@instrumentation.stage("read_trades")
+def read_trades(path, chunksize=None):
+    """ Reads a TradeHistory.csv export """
+    return read_export(path, TRADES_COLUMNS, TRADES_DATE_FORMAT, chunksize)
+
+
+@instrumentation.stage("read_transactions")
+def read_transactions(path, chunksize=None):
+    """ Reads a TransactionHistory.csv export """
+    return read_export(path, TRANSACTIONS_COLUMNS, TRANSACTIONS_DATE_FORMAT, chunksize)
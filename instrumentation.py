@@ -0,0 +1,235 @@
+import bisect
+import cProfile
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+import dash
+import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
+
+# Optional timing of the processing stages and Dash callbacks, exposed as Prometheus histograms.
+# Switched off by default. When off, each instrumented function costs one extra check of ENABLED.
+
+ENABLED = False
+PROFILE_DIR = "./.profiles"
+PROFILE_ON = ("1", "true") # values of ?profile= or the X-Profile header that profile a request
+
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+ROWS_BUCKETS = [10, 100, 1000, 10000, 100000, 1000000, 10000000]
+BYTES_BUCKETS = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+class Histogram:
+    """ Cumulative bucket counts, sum and count of observed values, as in Prometheus """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+
+class Registry:
+    """ Histograms by metric name and label value """
+
+    def __init__(self):
+        self.metrics = {} # name: (help, label name, buckets, {label value: Histogram})
+        self.lock = threading.Lock()
+
+    def register(self, name, help, label, buckets):
+        self.metrics.setdefault(name, (help, label, buckets, {}))
+
+    def observe(self, name, label_value, value):
+        with self.lock:
+            _, _, buckets, histograms = self.metrics[name]
+            if label_value not in histograms:
+                histograms[label_value] = Histogram(buckets)
+            histograms[label_value].observe(value)
+
+    def reset(self):
+        with self.lock:
+            for _, _, _, histograms in self.metrics.values():
+                histograms.clear()
+
+    def snapshot(self):
+        """ Picklable copy of every histogram, to send back from a worker process """
+        with self.lock:
+            return {name: dict(histograms) for name, (_, _, _, histograms) in self.metrics.items()}
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, histograms in snapshot.items():
+                ours = self.metrics[name][3]
+                for label_value, histogram in histograms.items():
+                    if label_value in ours:
+                        ours[label_value].merge(histogram)
+                    else:
+                        ours[label_value] = histogram
+
+    def exposition(self):
+        """ Every metric in the Prometheus text format """
+        lines = []
+        with self.lock:
+            for name, (help, label, buckets, histograms) in sorted(self.metrics.items()):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} histogram")
+                for label_value, histogram in sorted(histograms.items()):
+                    labels = f'{label}="{_escape(label_value)}"'
+                    cumulative = 0
+                    for bound, count in zip(buckets + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = Registry()
+REGISTRY.register("ig_stage_seconds", "Time spent in each processing stage", "stage", SECONDS_BUCKETS)
+REGISTRY.register("ig_stage_rows", "Rows returned by each processing stage", "stage", ROWS_BUCKETS)
+REGISTRY.register("ig_callback_seconds", "Time spent in each Dash callback", "callback", SECONDS_BUCKETS)
+REGISTRY.register("ig_callback_payload_bytes", "JSON size of each Dash callback's result", "callback", BYTES_BUCKETS)
+REGISTRY.register("ig_callback_rows", "Table rows returned by each Dash callback", "callback", ROWS_BUCKETS)
+REGISTRY.register("ig_http_request_seconds", "Time to handle each request, including serialisation", "path", SECONDS_BUCKETS)
+REGISTRY.register("ig_http_response_bytes", "Size of each response", "path", BYTES_BUCKETS)
+
+
+def _rows(result):
+    """ Number of rows in a stage's result, if it has any """
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, dict) and isinstance(result.get("df"), pd.DataFrame):
+        return len(result["df"])
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple) and result and all(isinstance(r, pd.DataFrame) for r in result):
+        return sum(len(r) for r in result)
+    if isinstance(result, tuple) and result and isinstance(result[0], list): # (records, page_count)
+        return len(result[0])
+    return None
+
+
+def stage(name):
+    """ Decorator timing a processing stage and counting the rows it returns """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            REGISTRY.observe("ig_stage_seconds", name, time.perf_counter() - start)
+            rows = _rows(result)
+            if rows is not None:
+                REGISTRY.observe("ig_stage_rows", name, rows)
+            return result
+        return wrapper
+    return decorator
+
+
+class PayloadEncoder(PlotlyJSONEncoder):
+    """ Encodes a callback's result the way Dash sends it, so page layouts and figures are measured too.
+    Outputs left as they are (dash.no_update) aren't sent """
+
+    def default(self, obj):
+        if isinstance(obj, type(dash.no_update)):
+            return None
+        return super().default(obj)
+
+
+def callback(name):
+    """ Decorator timing a Dash callback and measuring what it sends back """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args):
+            if not ENABLED:
+                return function(*args)
+            start = time.perf_counter()
+            result = function(*args)
+            REGISTRY.observe("ig_callback_seconds", name, time.perf_counter() - start)
+            REGISTRY.observe("ig_callback_payload_bytes", name, len(json.dumps(result, cls=PayloadEncoder)))
+            # Table callbacks return (records, page_count)
+            if isinstance(result, (list, tuple)) and result and isinstance(result[0], list):
+                REGISTRY.observe("ig_callback_rows", name, len(result[0]))
+            return result
+        return wrapper
+    return decorator
+
+
+def collected(function, account):
+    """ Runs function(account) in a worker process with instrumentation on.
+    Returns (result, metrics snapshot) so the parent can merge the worker's timings with its own """
+    enable()
+    REGISTRY.reset() # a forked worker starts with a copy of the parent's
+    result = function(account)
+    return result, REGISTRY.snapshot()
+
+
+def instrument_server(server, profile_dir=PROFILE_DIR):
+    """ Times every request to a Flask server, and profiles a request with cProfile when asked to.
+    Add ?profile=1 or an "X-Profile: 1" header to profile that request, or GET /profile-next to profile
+    the next Dash callback request (which the browser makes, so can't be given a flag).
+    Profiles are written to profile_dir, named in the response's X-Profile-File header """
+    import flask
+
+    armed = {"next": False}
+
+    @server.route("/profile-next")
+    def profile_next():
+        armed["next"] = True
+        return flask.jsonify({"profiling": "next callback request"})
+
+    @server.before_request
+    def start_request():
+        if not ENABLED:
+            return
+        flask.g.instrumentation_start = time.perf_counter()
+        flag = flask.request.args.get("profile") or flask.request.headers.get("X-Profile") or ""
+        wanted = flag.strip().lower() in PROFILE_ON
+        if not wanted and armed["next"] and flask.request.path.startswith("/_dash-update-component"):
+            armed["next"] = False
+            wanted = True
+        if wanted:
+            flask.g.profiler = cProfile.Profile()
+            flask.g.profiler.enable()
+
+    @server.after_request
+    def end_request(response):
+        if not ENABLED or "instrumentation_start" not in flask.g:
+            return response
+
+        profiler = flask.g.pop("profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            path = os.path.join(profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{time.perf_counter_ns()}.prof")
+            profiler.dump_stats(path)
+            response.headers["X-Profile-File"] = path
+
+        request_path = flask.request.path
+        REGISTRY.observe("ig_http_request_seconds", request_path, time.perf_counter() - flask.g.instrumentation_start)
+        if not response.direct_passthrough:
+            REGISTRY.observe("ig_http_response_bytes", request_path, response.calculate_content_length() or 0)
+        return response
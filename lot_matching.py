@@ -0,0 +1,238 @@
+import heapq
+from abc import ABC, abstractmethod
+from collections import deque
+
+import numpy as np
+
+# Ways of matching each sell with the buys it closes. Each account's profit is worked out with its own method, and
+# match_market can also run any number of them side by side in one pass over a market's trades, so prices, share splits
+# and fees are only worked out once. To add a method, subclass OrderedLots (or Lots) and add it to METHODS.
+# The lots also keep the ledger of what was held when (see process_data.lot_ledger): a row of
+# (bought, opened, closed, quantity, price) for every lot, or part of one, that's closed. A lot is closed when it's sold,
+# and closed and opened again when a share split changes its quantity and price, so they're constant over each row.
+
+
+class Lots(ABC):
+    """ A market's open buy lots, and how a sell is matched with them. Subclasses must implement every abstract method,
+    so an incomplete one fails when it's created rather than part way through matching.
+    Lots carry over from one batch of trades to the next, including a share split whose rows are split between them """
+
+    share_split = None # shares held before a split, between its sell and buy rows
+
+    @abstractmethod
+    def buy(self, qty, price, fees, day, ledger=None):
+        """ Adds a lot of qty shares at price (£ per share) with its buy fees, bought on day """
+
+    @abstractmethod
+    def sell(self, qty, fees, day, ledger=None):
+        """ Closes qty shares on day. Returns (cost, fees plus the buy fees of lots closed), or None if there weren't enough shares.
+        Closed lots are added to the ledger list, if given """
+
+    @abstractmethod
+    def split(self, ratio, day, ledger=None):
+        """ Share split on day. Every open lot has ratio times the shares at 1/ratio the price """
+
+    @abstractmethod
+    def open_rows(self):
+        """ (bought, opened, quantity, price) of every open lot """
+
+    def state(self):
+        """ The open lots as JSON-able data, to carry on from in another run (see from_state) """
+        return {name: list(value) if isinstance(value, deque) else value for name, value in vars(self).items()}
+
+    @classmethod
+    def from_state(cls, state):
+        """ Lots saved by state """
+        book = cls()
+        for name, value in state.items():
+            setattr(book, name, deque(value) if isinstance(getattr(book, name, None), deque) else value)
+        return book
+
+
+class OrderedLots(Lots):
+    """ Lots kept separately, each [quantity, price (£ per share), fees, bought, opened]. Subclasses choose which lot
+    a sell closes next. A lot's buy fees go to the sell that closes the last of it """
+
+    @abstractmethod
+    def next_lot(self):
+        """ The lot the next share sold comes from """
+
+    @abstractmethod
+    def close_lot(self):
+        """ Removes the lot returned by next_lot, which has been sold """
+
+    @abstractmethod
+    def open_lots(self):
+        """ Every open lot """
+
+    def __len__(self):
+        return len(self.open_lots())
+
+    def split(self, ratio, day, ledger=None):
+        for lot in self.open_lots():
+            if ledger is not None:
+                ledger.append((lot[3], lot[4], day, lot[0], lot[1]))
+            lot[0] *= ratio
+            lot[1] /= ratio
+            lot[4] = day
+
+    def sell(self, qty, fees, day, ledger=None):
+        cost = 0
+        while qty > 0 and len(self):
+            lot = self.next_lot()
+            if qty >= lot[0]:
+                if ledger is not None:
+                    ledger.append((lot[3], lot[4], day, lot[0], lot[1]))
+                cost += lot[0] * lot[1]
+                fees += lot[2]
+                qty -= lot[0]
+                self.close_lot()
+            else:
+                if ledger is not None:
+                    ledger.append((lot[3], lot[4], day, qty, lot[1]))
+                cost += qty * lot[1]
+                lot[0] -= qty
+                qty = 0
+        return (cost, fees) if qty == 0 else None
+
+    def open_rows(self):
+        return [(bought, opened, qty, price) for qty, price, _, bought, opened in self.open_lots() if qty != 0]
+
+
+class FifoLots(OrderedLots):
+    """ First in, first out """
+
+    def __init__(self):
+        self.lots = deque()
+
+    def buy(self, qty, price, fees, day, ledger=None):
+        self.lots.append([qty, price, fees, day, day])
+
+    def next_lot(self):
+        return self.lots[0]
+
+    def close_lot(self):
+        self.lots.popleft()
+
+    def open_lots(self):
+        return self.lots
+
+
+class LifoLots(FifoLots):
+    """ Last in, first out """
+
+    def next_lot(self):
+        return self.lots[-1]
+
+    def close_lot(self):
+        self.lots.pop()
+
+
+class HifoLots(OrderedLots):
+    """ Highest price first, which keeps realised gains lowest. A heap by price, ties oldest first """
+
+    def __init__(self):
+        self.heap = [] # (-price, order bought, lot)
+        self.bought = 0
+
+    def buy(self, qty, price, fees, day, ledger=None):
+        heapq.heappush(self.heap, (-price, self.bought, [qty, price, fees, day, day]))
+        self.bought += 1
+
+    def next_lot(self):
+        return self.heap[0][2]
+
+    def close_lot(self):
+        heapq.heappop(self.heap)
+
+    def open_lots(self):
+        return [lot for _, _, lot in self.heap]
+
+    def __len__(self):
+        return len(self.heap)
+
+    def split(self, ratio, day, ledger=None):
+        # Every price is divided by the same ratio, so the heap is still in order
+        super().split(ratio, day, ledger)
+        self.heap = [(-lot[1], bought, lot) for _, bought, lot in self.heap]
+
+
+class AverageCost(Lots):
+    """ One pool at its average cost per share. Each sell takes its share of the pool's cost and buy fees.
+    In the ledger the pool is one lot, bought when it was last empty, closed and opened again whenever it changes """
+
+    def __init__(self):
+        self.qty = self.cost = self.fees = 0.0
+        self.bought = self.opened = None
+
+    def _reopen(self, day, ledger):
+        """ Closes the pool as it was before a change on day """
+        if ledger is not None and self.qty:
+            ledger.append((self.bought, self.opened, day, self.qty, self.cost / self.qty))
+        self.opened = day
+
+    def buy(self, qty, price, fees, day, ledger=None):
+        self._reopen(day, ledger)
+        if not self.qty:
+            self.bought = day
+        self.qty += qty
+        self.cost += qty * price
+        self.fees += fees
+
+    def split(self, ratio, day, ledger=None):
+        self._reopen(day, ledger)
+        self.qty *= ratio
+
+    def sell(self, qty, fees, day, ledger=None):
+        self._reopen(day, ledger)
+        if qty > self.qty:
+            self.qty = self.cost = self.fees = 0.0
+            return None
+        share = qty / self.qty if self.qty else 0.0
+        cost, buy_fees = self.cost * share, self.fees * share
+        self.qty -= qty
+        self.cost -= cost
+        self.fees -= buy_fees
+        return cost, fees + buy_fees
+
+    def open_rows(self):
+        return [(self.bought, self.opened, self.qty, self.cost / self.qty)] if self.qty else []
+
+
+METHODS = {"fifo": FifoLots, "lifo": LifoLots, "hifo": HifoLots, "average": AverageCost}
+
+
+def match_market(activity, direction, quantity, price, rate, fees, dates, books, ledgers=None):
+    """ Matches the trades of a single market (in date order) with every book of lots in books ({method: Lots}), in one pass.
+    Books carry on from the market's earlier trades, if any, and are updated in place. ledgers ({method: list}) has the
+    ledger rows of any method in it added.
+    Returns {method: (initial consideration, final consideration, fees)}: arrays with a value for each sell,
+    NaN for any row which doesn't close a position """
+    n = len(quantity)
+    ledgers = ledgers or {}
+    results = {method: (np.full(n, np.nan), np.full(n, np.nan), np.full(n, np.nan)) for method in books}
+
+    for i in range(n):
+        if activity[i] == "CORPORATE ACTION": # Share split, shown as selling everything and buying the new number back
+            for method, book in books.items():
+                if direction[i] == "SELL":
+                    book.share_split = abs(quantity[i])
+                else:
+                    book.split(abs(quantity[i]) / book.share_split, dates[i], ledgers.get(method))
+            continue
+
+        if direction[i] == "BUY":
+            for method, book in books.items():
+                book.buy(quantity[i], price[i] * rate[i], fees[i], dates[i], ledgers.get(method))
+            continue
+
+        sell_qty = abs(quantity[i])
+        final_consideration = sell_qty * price[i] * rate[i]
+        for method, book in books.items():
+            matched = book.sell(sell_qty, fees[i], dates[i], ledgers.get(method))
+            if matched is not None:
+                initial_out, final_out, fees_out = results[method]
+                initial_out[i], fees_out[i] = matched
+                final_out[i] = final_consideration
+
+    return results
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+import instrumentation
+
+# Processed data for many portfolios in one server. Portfolios are loaded the first time they're asked for,
+# and only the most recently used few are kept in memory.
+
+DEFAULT_MAX_PORTFOLIOS = 8
+
+instrumentation.REGISTRY.register("ig_portfolio_load_seconds", "Time to load each portfolio", "portfolio", instrumentation.SECONDS_BUCKETS)
+
+
+class PortfolioStore:
+    """ Least recently used store of loaded portfolios, limited to max_portfolios of them.
+    load(name) does the loading. When several requests ask for the same portfolio before it has loaded,
+    it is only loaded once and they all get the result """
+
+    def __init__(self, load, max_portfolios=DEFAULT_MAX_PORTFOLIOS):
+        self.load = load
+        self.max_portfolios = max_portfolios
+        self.entries = OrderedDict() # name: (data, version)
+        self.loading = {} # name: {"done": Event, "data", "version", "error"}
+        self.errors = {} # name: why the last load failed
+        self.versions = count(1) # every load gets a new version, so results from an earlier load aren't reused
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "shared_loads": 0, "loads": 0, "refreshes": 0,
+                         "load_failures": 0, "evictions": 0, "load_seconds": 0.0}
+
+    def get(self, name, wait=True):
+        """ (data, version) for a portfolio, loading it if needed.
+        With wait=False, returns None straight away if the portfolio isn't loaded, and loads it in the background """
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.counters["hits"] += 1
+                return self.entries[name]
+
+            flight = self.loading.get(name)
+            leader = flight is None
+            if leader:
+                flight = {"done": threading.Event(), "data": None, "version": None, "error": None}
+                self.loading[name] = flight
+                self.counters["misses"] += 1
+            else:
+                self.counters["shared_loads"] += 1
+
+        if leader:
+            if wait:
+                self._load(name, flight)
+            else:
+                threading.Thread(target=self._load, args=(name, flight), daemon=True).start()
+        if not wait:
+            return None
+
+        flight["done"].wait()
+        if flight["error"] is not None:
+            raise flight["error"]
+        return flight["data"], flight["version"]
+
+    def refresh(self, name):
+        """ Loads a loaded portfolio again in the background, e.g. when its exports have changed.
+        Its current data is still served until the new data is ready, then the new data (with a new version) replaces it.
+        If loading fails the current data is kept. Returns False if the portfolio is already being loaded """
+        with self.lock:
+            if name in self.loading:
+                return False
+            flight = {"done": threading.Event(), "data": None, "version": None, "error": None}
+            self.loading[name] = flight
+            self.counters["refreshes"] += 1
+        threading.Thread(target=self._load, args=(name, flight), daemon=True).start()
+        return True
+
+    def _load(self, name, flight):
+        start = time.perf_counter()
+        try:
+            flight["data"] = self.load(name)
+        except Exception as e:
+            flight["error"] = e
+        seconds = time.perf_counter() - start
+        if instrumentation.ENABLED:
+            instrumentation.REGISTRY.observe("ig_portfolio_load_seconds", name, seconds)
+
+        with self.lock:
+            self.counters["load_seconds"] += seconds
+            del self.loading[name]
+            if flight["error"] is None:
+                flight["version"] = next(self.versions)
+                self.counters["loads"] += 1
+                self.errors.pop(name, None)
+                self._put(name, flight["data"], flight["version"])
+            else:
+                self.counters["load_failures"] += 1
+                self.errors[name] = repr(flight["error"])
+        flight["done"].set()
+
+    def _put(self, name, data, version):
+        """ Adds a loaded portfolio, evicting the least recently used beyond max_portfolios. Call with the lock held """
+        self.entries[name] = (data, version)
+        self.entries.move_to_end(name)
+        while len(self.entries) > self.max_portfolios:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def peek(self, name):
+        """ (data, version) if the portfolio is loaded, otherwise None. Doesn't load it or count as a use """
+        with self.lock:
+            return self.entries.get(name)
+
+    def error(self, name):
+        """ Why the portfolio's last load failed, if it did """
+        with self.lock:
+            return self.errors.get(name)
+
+    def is_loading(self, name):
+        with self.lock:
+            return name in self.loading
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, resident=list(self.entries), loading=list(self.loading),
+                        max_portfolios=self.max_portfolios)
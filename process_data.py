@@ -1,56 +1,98 @@
 import pandas as pd
 import numpy as np
-import datetime as dt
+import os
+import re
+import tempfile
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from dash_table.Format import Format, Symbol, Scheme
 from dash_table import FormatTemplate
 
-
+import fx
+import ingest
+import instrumentation
+import lot_matching
+
+
+def to_datetime(dates):
+    """ Parses a column of day first date strings in one go. Columns that are already datetimes are left alone """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    return pd.to_datetime(dates, dayfirst=True)
+
+# Everything we want from a transaction's "MarketName", in a single regex.
+# Each field is an optional lookahead from the start of the string, so each one finds its first match
+# exactly as a separate str.extract / str.contains would.
+MARKET_NAME_PATTERN = re.compile(r"""
+    (?=(?:.*?(?<=Converted\ at\ |converted\ at\ )(?P<conversion_rate>[0-9.]*))?)   # find converted at
+    (?=(?:.*?(?P<dividend_quantity>[0-9.]*?)(?=@))?)                            # any 0-9 or . characters before the @
+    (?=(?:.*?(?<=@)(?P<dividend_price>[0-9.]*))?)                              # any 0-9 or . characters after the @
+    (?=(?:(?:Correction\s*)?(?P<share_name>\S.*?)\s*(?:\([^()]*\)|DIVIDEND|\(All|CONS|COMM|Section))?)
+    (?=(?:.*?(?P<section_31>Section\ 31\ Fee))?)
+    (?=(?:.*?(?P<custody>Custody\ Fee))?)
+    (?=(?:.*?(?P<cash_in>Cheque\ Received|Bank\ Deposit))?) # ISA transactions don't list Bank deposits as cash in
+    (?=(?:.*?(?P<bonus>Bonus))?)                               # I have no idea what the bonus is
+    """, re.VERBOSE)
+
+@lru_cache(maxsize=65536)
+def parse_market_name(market_name):
+    """ Splits a transaction "MarketName" into (conversion rate, dividend quantity, dividend price, share name, summary).
+    summary is None unless the description means the transaction's Summary should be overridden """
+    fields = MARKET_NAME_PATTERN.match(market_name).groupdict()
+
+    # Later checks take priority
+    summary = None
+    if fields["section_31"]:
+        summary = "Section 31 Fee"
+    if fields["custody"]:
+        summary = market_name
+    if fields["cash_in"]:
+        summary = "Cash In"
+    if fields["bonus"]:
+        summary = "Bonus"
+
+    return (fields["conversion_rate"], fields["dividend_quantity"], fields["dividend_price"], fields["share_name"], summary)
+
+@instrumentation.stage("clean_transactions")
 def clean_transactions(transactions_df):
     """ Expects transaction.csv DataFrame and returns a cleaned dataframe """
 
-    # Convert Dates to datetime
-    transactions_df["Date"] = transactions_df["Date"].apply(lambda x: pd.to_datetime(x, dayfirst=True)).dt.date
+    # Convert Dates to datetime (already done if read with ingest.read_transactions)
+    transactions_df["Date"] = to_datetime(transactions_df["Date"]).dt.normalize() # dates only, kept as datetime64 so tables can be binary searched
 
     # Convert Cash Amounts to floats (from strings)
-    transactions_df["PL Amount"] = transactions_df["PL Amount"].apply(lambda x: float(x.replace(",","")))
+    if transactions_df["PL Amount"].dtype == object:
+        transactions_df["PL Amount"] = transactions_df["PL Amount"].str.replace(",", "", regex=False).astype(float)
 
     # Only retain relevant columns
     drop_columns = ["Period", "ProfitAndLoss", "Transaction type", "Reference", "Open level", "Close level", "Size", "Currency", "Cash transaction", "DateUtc", "OpenDateUtc", "CurrencyIsoCode" ]
-    transactions_df.drop(drop_columns, axis=1, inplace=True)
-
-    # Split up mega confusing "MarketName" column
-    transactions_df["Conversion Rate"] = transactions_df["MarketName"].str.extract(r"((?<=Converted at\s|converted at\s)[0-9.]*)") # find converted at
-
-    # Separate Dividend Price from "MarketName"
-    transactions_df["Dividend Quantity"] = transactions_df["MarketName"].str.extract(r"([0-9.]*?(?=@))") # Look ahead, find any 0-9 or . character before the @
-    transactions_df["Dividend Price"] = transactions_df["MarketName"].str.extract(r"((?<=@)[0-9.]*)") # Same as above but with Look behind
-
-    # Separate Share Name
-    transactions_df["Share Name"] = transactions_df["MarketName"].str.extract(r"^(?:Correction\s*)?(\S.*?)\s*(?:\([^()]*\)|DIVIDEND|\(All|CONS|COMM|Section)") # Uses an optional clause and capture groups
-
-    # Section 31 Fee
-    transactions_df["Summary"] = np.where(transactions_df["MarketName"].str.contains("Section 31 Fee"),
-                                            "Section 31 Fee",
-                                            transactions_df["Summary"])
-    # Custody Fee
-    transactions_df["Summary"] = np.where(transactions_df["MarketName"].str.contains("Custody Fee"),
-                                            transactions_df["MarketName"],
-                                            transactions_df["Summary"])
-    # Cheque/Bank Deposit
-    transactions_df["Summary"] = np.where(transactions_df["MarketName"].str.contains("Cheque Received|Bank Deposit"), # ISA transactions don't list Bank deposits as cash in
-                                            "Cash In",
-                                            transactions_df["Summary"])
-    # Bonus (I have no idea what the bonus is)
-    transactions_df["Summary"] = np.where(transactions_df["MarketName"].str.contains("Bonus"), # ISA transactions don't list Bank deposits as cash in
-                                            "Bonus",
-                                            transactions_df["Summary"])
+    transactions_df.drop(drop_columns, axis=1, inplace=True, errors="ignore")
+
+    # Split up mega confusing "MarketName" column. Each distinct description is only parsed once
+    codes, market_names = pd.factorize(transactions_df["MarketName"])
+    parsed = [parse_market_name(name) for name in market_names]
+    parsed.append((None,) * 5) # row -1, used for missing MarketNames
+    parsed = pd.DataFrame(parsed, columns=["Conversion Rate", "Dividend Quantity", "Dividend Price", "Share Name", "Summary"]).take(codes)
+    parsed.index = transactions_df.index
+
+    for column in ["Conversion Rate", "Dividend Quantity", "Dividend Price", "Share Name"]:
+        transactions_df[column] = parsed[column]
+
+    # Fees, deposits and bonuses are reclassified by their description
+    transactions_df["Summary"] = parsed["Summary"].fillna(transactions_df["Summary"])
     return transactions_df
 
-def clean_trades(trades_df):
-    """ Expects trade_history.csv DataFrame and returns a cleaned dataframe """
+# Commission was charged in $ before this day
+USD_COMMISSION_UNTIL = pd.Timestamp(2020, 4, 5)
+
+@instrumentation.stage("clean_trades")
+def clean_trades(trades_df, rates=None):
+    """ Expects trade_history.csv DataFrame and returns a cleaned dataframe.
+    rates (fx.export_rates of the whole export) fills in missing conversion rates when trades_df is only part of it """
 
-    # Convert Dates to datetime
-    trades_df["Date"] = trades_df["Date"].apply(lambda x: pd.to_datetime(x, dayfirst=True)).dt.date # dt.date converts to date only
+    # Convert Dates to datetime (already done if read with ingest.read_trades)
+    trades_df["Date"] = to_datetime(trades_df["Date"]).dt.normalize() # date only, kept as datetime64
 
     # Remove "(All Sesssions)" from stock names
     trades_df["Market"] = trades_df["Market"].str.replace(" \(All Sessions\)", "")
@@ -58,25 +100,31 @@ def clean_trades(trades_df):
     # Reverse tables. Ascending dates
     trades_df = trades_df[::-1]
 
+    # Rates missing from the export are taken from the nearest earlier trade in the same currency
+    trades_df["Conversion rate"] = fx.fill_rates(trades_df, rates)
+
     # Commission fees were changed from $15 to £10. Convert to £ for consistency.
-    trades_df["Commission (£)"] = np.where(trades_df["Date"] < pd.Timestamp(2020, 4, 5),
+    trades_df["Commission (£)"] = np.where(trades_df["Date"] < USD_COMMISSION_UNTIL,
                                             trades_df["Commission"] * trades_df["Conversion rate"],
                                             trades_df["Commission"])
 
     # Add Consideration in GBP
     trades_df["Consideration (£)"] = trades_df["Consideration"] * trades_df["Conversion rate"]
 
-    # Convert from cents to dollars (IG changed it to cents recently)
-    trades_df["Price"] = trades_df["Price"]/100
+    # Convert from pence and cents to £ and dollars (IG changed it to cents recently)
+    trades_df["Price"] = trades_df["Price"] / fx.price_units(trades_df["Currency"])
 
     return trades_df
 
 # Custom Format
-gbp_format = Format(precision=2, scheme=Scheme.fixed).symbol(Symbol.yes).symbol_prefix('£ ').group(True) # FormatTemplate.money(2) does $
+def money_format(symbol):
+    return Format(precision=2, scheme=Scheme.fixed).symbol(Symbol.yes).symbol_prefix(f'{symbol} ').group(True) # FormatTemplate.money(2) does $
+
+gbp_format = money_format('£')
 
-def format_trades_columns(trades_df):
-    """ Expects a trade history df and uses this to provide a column layout for Dash """
-    column_layout = [{"name": i, "id": i} for i in trades_df.columns]
+def format_trades_columns(trades_df, symbol="£"):
+    """ Expects a trade history df and uses this to provide a column layout for Dash, with amounts in symbol's currency """
+    column_layout = [{"name": i.replace("£", symbol), "id": i} for i in trades_df.columns]
     print(column_layout)
     column_layout[0]["type"] = "datetime"
 
@@ -87,7 +135,7 @@ def format_trades_columns(trades_df):
     # Currency Columns
     for i in range(7,11):
         column_layout[i]["type"] = "numeric"
-        column_layout[i]["format"] = gbp_format
+        column_layout[i]["format"] = money_format(symbol)
 
     # Percentage format
     column_layout[11]["type"] = "numeric"
@@ -95,8 +143,9 @@ def format_trades_columns(trades_df):
 
     return column_layout
 
+@instrumentation.stage("calculate_trades_summary")
 def calculate_trades_summary(trades_df):
-    """ Takes in the sd and isa dataframes and returns totals.
+    """ Takes in an account's trade history report and returns totals.
     Required as Dash app will filter dates and need to recalculate these """
     filt1 = trades_df["Net Profit (£)"].notna()
 
@@ -111,53 +160,58 @@ def calculate_trades_summary(trades_df):
 
     return {"sold_pos": sold_pos, "fees": fees, "net_profit": net_profit, "net_profit_per": net_profit_per, "ic":initial_cons, "fc": final_cons}
 
-def format_dividends_datatable(transactions_sd, transactions_isa):
-    """ Concatenates, sorts and cleans transaction history to display all dividends """
+@instrumentation.stage("format_dividends_datatable")
+def format_dividends_datatable(transactions):
+    """ Concatenates, sorts and cleans transaction history to display all dividends.
+    Expects a dict of transaction DataFrames by account name """
 
-    filt1 = transactions_sd["Summary"] == "Dividend"
-    filt2 = transactions_isa["Summary"] == "Dividend"
-    transactions_sd["Account"] = "Share Dealing"
-    transactions_isa["Account"] = "ISA"
-
-    dividends_df = pd.concat([transactions_sd[filt1], transactions_isa[filt2]])
-    dividends_df.sort_values(by=['Date'], inplace=True, ascending=True)
+    dividends_df = pd.concat([transactions_df[transactions_df["Summary"] == "Dividend"].assign(Account=account)
+                                for account, transactions_df in transactions.items()])
+    dividends_df.sort_values(by=['Date'], inplace=True, ascending=True, kind="mergesort")
     dividends_df = dividends_df[["Date", "Account", "Share Name", "Dividend Quantity", "Dividend Price", "Conversion Rate", "PL Amount"]]
 
+    return {"df": dividends_df, "column_layout": format_dividends_columns(dividends_df)}
+
+def format_dividends_columns(dividends_df, symbol="£"):
+    """ Expects a dividends df and uses this to provide a column layout for Dash """
     column_layout = [{"name": i, "id": i} for i in dividends_df.columns]
     column_layout[6]["type"] = "numeric"
-    column_layout[6]["format"] = gbp_format
+    column_layout[6]["format"] = money_format(symbol)
 
-    return {"df": dividends_df, "column_layout": column_layout}
+    return column_layout
 
+@instrumentation.stage("calculate_dividends_summary")
 def calculate_dividends_summary(dividends_df):
-    """ Takes in a dividends dataframe and returns totals.
+    """ Takes in a dividends dataframe and returns totals by account.
     Required as Dash app will filter dates and need to recalculate these """
 
-    filt3 = dividends_df["Account"] == "Share Dealing"
-    filt4 = dividends_df["Account"] == "ISA"
-    sd_total = round(dividends_df[filt3]["PL Amount"].sum(), 2)
-    isa_total = round(dividends_df[filt4]["PL Amount"].sum(), 2)
-
-    return {"sd_total": sd_total, "isa_total": isa_total}
+    return {account: round(dividends_df[dividends_df["Account"] == account]["PL Amount"].sum(), 2)
+            for account in dividends_df["Account"].unique()}
 
-def format_fees_datatable(transactions_sd, transactions_isa):
-    """ Concatenates, sorts and cleans transaction history to display dividends """
+# Summaries of the transactions shown in the fees table
+FEE_SUMMARIES = "Share Dealing Commissions|Section 31 Fee|Custody Fee"
 
-    filt1 = transactions_sd["Summary"].str.contains("Share Dealing Commissions|Section 31 Fee|Custody Fee")
-    filt2 = transactions_isa["Summary"].str.contains("Share Dealing Commissions|Section 31 Fee|Custody Fee")
-    transactions_sd["Account"] = "Share Dealing"
-    transactions_isa["Account"] = "ISA"
+@instrumentation.stage("format_fees_datatable")
+def format_fees_datatable(transactions):
+    """ Concatenates, sorts and cleans transaction history to display fees.
+    Expects a dict of transaction DataFrames by account name """
 
-    fees_df = pd.concat([transactions_sd[filt1], transactions_isa[filt2]])
-    fees_df.sort_values(by=['Date'], inplace=True, ascending=True)
+    fees_df = pd.concat([transactions_df[transactions_df["Summary"].str.contains(FEE_SUMMARIES)].assign(Account=account)
+                            for account, transactions_df in transactions.items()])
+    fees_df.sort_values(by=['Date'], inplace=True, ascending=True, kind="mergesort")
     fees_df = fees_df[["Date", "Account", "Summary", "Share Name", "PL Amount"]]
 
+    return {"df": fees_df, "column_layout": format_fees_columns(fees_df)}
+
+def format_fees_columns(fees_df, symbol="£"):
+    """ Expects a fees df and uses this to provide a column layout for Dash """
     column_layout = [{"name": i, "id": i} for i in fees_df.columns]
     column_layout[4]["type"] = "numeric"
-    column_layout[4]["format"] = gbp_format  
+    column_layout[4]["format"] = money_format(symbol)  
 
-    return {"df": fees_df, "column_layout": column_layout}
+    return column_layout
 
+@instrumentation.stage("calculate_fees_summary")
 def calculate_fees_summary(fees_df):
     """ Takes in a fees dataframe and returns totals.
     Required as Dash app will filter dates and need to recalculate these """
@@ -171,104 +225,211 @@ def calculate_fees_summary(fees_df):
 
     return {"section_31": section_31, "custody": custody, "commission": commission}
 
-def calculate_cashflow_summary(transactions_sd, transactions_isa):
-    """ Takes in a transactions dataframes and returns totals.
-    Required as Dash app will filter dates and need to recalculate these """
-    filt1 = transactions_sd["Summary"].str.contains("Cash In")
-    filt2 = transactions_sd["Summary"].str.contains("Cash Out")
-    filt3 = transactions_sd["MarketName"].str.contains("Funds Transfer to ISA")
-
-    filt4 = transactions_isa["Summary"].str.contains("Cash In")
-    filt5 = transactions_isa["Summary"].str.contains("Cash Out")
-    filt6 = transactions_isa["MarketName"].str.contains("Funds Transfer from Share dealing")
-
-    sd_cash_in = round(abs(transactions_sd[filt1]["PL Amount"].sum()), 2)
-    sd_cash_out = round(abs(transactions_sd[filt2]["PL Amount"].sum()), 2)
-    isa_cash_in = round(abs(transactions_isa[filt4]["PL Amount"].sum()), 2)
-    isa_cash_out = round(abs(transactions_isa[filt5]["PL Amount"].sum()), 2)
-    sd_to_isa = round(abs(transactions_sd[filt3]["PL Amount"].sum()), 2)
-    verify = round(abs(transactions_isa[filt6]["PL Amount"].sum()), 2)
-
-    cash_out = sd_cash_out + isa_cash_out
-
-    if verify == sd_to_isa:
-        return {"sd_cash_in": sd_cash_in,
-            "isa_cash_in": isa_cash_in,
-            "cash_out": cash_out,
-            "sd_to_isa": sd_to_isa}
+@instrumentation.stage("calculate_cashflow_summary")
+def calculate_cashflow_summary(transactions, accounts):
+    """ Takes in a dict of transactions dataframes by account name, and the account registry, and returns totals.
+    Cash moved between our own accounts is counted separately from cash in and out """
+    cash_in = {}
+    cash_out = 0
+    transfers_out = 0
+    transfers_in = 0
+
+    for account in accounts:
+        transactions_df = transactions[account["name"]]
+        filt1 = transactions_df["Summary"].str.contains("Cash In")
+        filt2 = transactions_df["Summary"].str.contains("Cash Out")
+        cash_in[account["name"]] = round(abs(transactions_df[filt1]["PL Amount"].sum()), 2)
+        cash_out += round(abs(transactions_df[filt2]["PL Amount"].sum()), 2)
+
+        if account.get("transfer_out"):
+            filt3 = transactions_df["MarketName"].str.contains(account["transfer_out"], regex=False)
+            transfers_out += round(abs(transactions_df[filt3]["PL Amount"].sum()), 2)
+        if account.get("transfer_in"):
+            filt4 = transactions_df["MarketName"].str.contains(account["transfer_in"], regex=False)
+            transfers_in += round(abs(transactions_df[filt4]["PL Amount"].sum()), 2)
+
+    if round(transfers_in, 2) == round(transfers_out, 2):
+        return {"cash_in": cash_in,
+            "cash_out": round(cash_out, 2),
+            "transfers": round(transfers_out, 2)}
     else:
-        print("unexpected: The amount transferred from isa doesn't match the amount transferred to isa")
+        print("unexpected: The amount transferred out of our accounts doesn't match the amount transferred in")
         raise Exception
 
-def trade_history_report(trade_history):
+LEDGER_COLUMNS = ["Market", "Bought", "Opened", "Closed", "Quantity", "Price (£)"]
+
+DAY = 24 * 60 * 60 * 10**9 # in ns, dates are passed to the matching as ints
+BED_AND_BREAKFAST_DAYS = 30
+QUANTITY_TOLERANCE = 1e-9
+
+def _match_hmrc(activity, direction, quantity, price, rate, fees, dates):
+    """ UK capital gains share matching for the trades of a single market (in date order).
+    A disposal is matched with, in order: acquisitions the same day, acquisitions in the following 30 days
+    (earliest first, "bed and breakfasting"), then the Section 104 pool of everything else at its average cost.
+    All the buys (or sells) on one day count as a single acquisition (or disposal).
+    Returns the same as lot_matching.match_market does for each method. A day's sells share its allowable cost and the buy fees matched with them by quantity.
+    Quantities are matched in shares as they were before any share split, so a disposal before a split can be matched
+    with an acquisition after it (or the pool) at the split ratio """
+    n = len(quantity)
+    initial_out = np.full(n, np.nan)
+    final_out = np.full(n, np.nan)
+    fees_out = np.full(n, np.nan)
+
+    # Totals for each day with trades, in pre-split shares
+    day_dates, buy_qty, buy_cost, buy_fees, sell_qty, sell_rows = [], [], [], [], [], []
+    row_qty = [0.0] * n
+    share_split = None
+    split = 1.0 # shares now per share before any split
+    for i in range(n):
+        if not day_dates or dates[i] != day_dates[-1]:
+            day_dates.append(dates[i])
+            buy_qty.append(0.0), buy_cost.append(0.0), buy_fees.append(0.0)
+            sell_qty.append(0.0), sell_rows.append([])
+
+        if activity[i] == "CORPORATE ACTION": # Share split, shown as selling everything and buying the new number back
+            if direction[i] == "SELL":
+                share_split = abs(quantity[i])
+            else:
+                split *= abs(quantity[i]) / share_split
+            continue
+
+        row_qty[i] = abs(quantity[i]) / split
+        if direction[i] == "BUY":
+            buy_qty[-1] += row_qty[i]
+            buy_cost[-1] += quantity[i] * price[i] * rate[i]
+            buy_fees[-1] += fees[i]
+        else:
+            sell_qty[-1] += row_qty[i]
+            sell_rows[-1].append(i)
+            final_out[i] = abs(quantity[i]) * price[i] * rate[i]
+
+    # Same day rule. What's left of each day's acquisition is available to the later rules
+    days = len(day_dates)
+    available = [0.0] * days
+    matched = [] # (cost, fees, shares still to match) of each day's disposal
+    for d in range(days):
+        same_day = min(buy_qty[d], sell_qty[d])
+        unit_cost = buy_cost[d] / buy_qty[d] if buy_qty[d] else 0.0
+        unit_fees = buy_fees[d] / buy_qty[d] if buy_qty[d] else 0.0
+        available[d] = buy_qty[d] - same_day
+        matched.append([same_day * unit_cost, same_day * unit_fees, sell_qty[d] - same_day])
+
+    # One pass through the days. next_buy only moves forward: acquisitions before it are used up, or are in the past
+    # for every disposal still to come, so each day is only stepped over once
+    pool_qty = pool_cost = pool_fees = 0.0
+    next_buy = 0
+    for d in range(days):
+        cost, matched_fees, remaining = matched[d]
+
+        # 30 day rule
+        if remaining > 0:
+            next_buy = max(next_buy, d + 1)
+            last_day = day_dates[d] + BED_AND_BREAKFAST_DAYS * DAY
+            while remaining > 0 and next_buy < days and day_dates[next_buy] <= last_day:
+                take = min(remaining, available[next_buy])
+                if take:
+                    cost += take * buy_cost[next_buy] / buy_qty[next_buy]
+                    matched_fees += take * buy_fees[next_buy] / buy_qty[next_buy]
+                    available[next_buy] -= take
+                    remaining -= take
+                if available[next_buy] == 0:
+                    next_buy += 1
+
+        # Section 104 pool
+        if remaining > 0 and pool_qty > 0:
+            take = min(remaining, pool_qty)
+            cost += pool_cost * take / pool_qty
+            matched_fees += pool_fees * take / pool_qty
+            pool_cost -= pool_cost * take / pool_qty
+            pool_fees -= pool_fees * take / pool_qty
+            pool_qty -= take
+            remaining -= take
+
+        # Shares divided by a split ratio needn't add up exactly
+        if remaining < QUANTITY_TOLERANCE:
+            remaining = 0
+
+        if sell_rows[d] and remaining == 0: # otherwise more was sold than we have, like the lot methods leave it unmatched
+            for i in sell_rows[d]:
+                share = row_qty[i] / sell_qty[d]
+                initial_out[i] = cost * share
+                fees_out[i] = fees[i] + matched_fees * share
+
+        # Whatever's left of today's acquisition joins the pool
+        if available[d] > 0:
+            pool_qty += available[d]
+            pool_cost += available[d] * buy_cost[d] / buy_qty[d]
+            pool_fees += available[d] * buy_fees[d] / buy_qty[d]
+
+    final_out[np.isnan(initial_out)] = np.nan
+    return initial_out, final_out, fees_out
+
+def round_2(values):
+    """ Rounds as Python floats so the numbers match the old cell by cell version exactly """
+    return np.array([round(x, 2) for x in values.tolist()])
+
+MATCHING = list(lot_matching.METHODS) + ["hmrc"]
+MATCHING_LABELS = {"fifo": "FIFO", "lifo": "LIFO", "hifo": "HIFO", "average": "Average Cost", "hmrc": "HMRC"}
+
+def lots_for(matching):
+    """ The lot_matching class an account's open lots are kept in """
+    return lot_matching.METHODS["fifo" if matching == "hmrc" else matching]
+
+@instrumentation.stage("trade_history_report")
+def trade_history_report(trade_history, open_lots=None, ledger=None, matching="fifo"):
     """ Takes in a trade history.csv DataFrame and adds details such as profit on closed positions 
-    Returns only relevant columns in a new dataframe """
-    
-    share_names = trade_history["Market"].unique()
-    
-    for share_name in share_names: # loop through all the different shares
-        filt = trade_history["Market"] == share_name
-        positions = []
-        
-        for idx, row in trade_history[filt].iterrows():
-            
-            # Handle Share Splits
-            if row["Activity"] == "CORPORATE ACTION": # Share split
-                if row["Direction"] == "SELL":
-                    share_split = abs(row["Quantity"])
-                else:
-                    share_split = abs(row["Quantity"]) / share_split
-                    # Multiply all existing position share quantities by the split
-                    for position in positions:
-                        if position["qty"] != 0: # Don't adjust previously closed positions
-                            position["qty"] *= share_split
-                            position["price"] /= share_split
-                continue
-
-            # Add each Buy (new position) to a dictionary
-            if row["Direction"] == "BUY":
-                positions.append({"qty": row["Quantity"], "price": row["Price"] * row["Conversion rate"], "fees": abs(row["Commission (£)"] + row["Charges"])})
-            
-            # When shares are sold, calculate profit using Positions list
-            # This takes into account uneven buy/sell quantities using a FIFO model
-            else: # Direction == SELL
-                # Track these
-                initial_consideration = 0 # running total
-                fees = abs(row["Commission (£)"] + row["Charges"]) # we will add any fees of fully closed positions
-                sell_qty = abs(row["Quantity"]) # Shares to sell. Will be adjusted as we sell off positions
-                final_consideration = sell_qty * row["Price"] * row["Conversion rate"]
-
-                # We iterate through previous buy positions, selling those off first
-                for position in positions:
-                    if position["qty"] == 0: # we've already sold this position
-                        continue
-                        
-                    elif sell_qty >= position["qty"]: # we can sell this position, and may need to continue on afterwards
-                        initial_consideration += position["qty"] * position["price"]
-                        fees += position["fees"] # associate the commission fees from Buy trade with this sell when calculating profit
-
-                        # Adjust no. of shares
-                        sell_qty -= position["qty"]
-                        position["qty"] = 0
-                        
-                    else: # we are not selling enough shares to close this position.
-                        initial_consideration += sell_qty * position["price"]
-                        
-                        # Adjust no. of shares
-                        position["qty"] -= sell_qty # subtract shares from position
-                        sell_qty = 0 
-
-                    if sell_qty == 0:
-                        trade_history.loc[idx, "Initial Consideration (£)"] = round(initial_consideration, 2)
-                        trade_history.loc[idx, "Final Consideration (£)"] = round(final_consideration, 2)
-                        trade_history.loc[idx, "Gross Profit (£)"] = round(final_consideration - initial_consideration, 2)
-                        trade_history.loc[idx, "Fees (£)"] = round(fees, 2)
-                        trade_history.loc[idx, "Net Profit (£)"] = round(final_consideration - initial_consideration - fees, 2)
-                        trade_history.loc[idx, "Net Profit (%)"] = round(((final_consideration-fees)/initial_consideration)-1, 2)
-                        #print(f"Initial Consideration: £{initial_investment:.2f}\nFinal Consideration: £{initial_investment+profit:.2f}\nGross Profit: £{profit:.2f}\nFees: £{fees:.2f}\nNet Profit: £{profit-fees:.2f}\nNet Profit(%): {100*((initial_investment+profit)/initial_investment) - 100:.2f}\n")
-                        break
-                        
-    # Return only columns we want to see
+    Returns only relevant columns in a new dataframe
+    open_lots ({market: lot_matching.Lots}) carries open positions over from previously processed trades and is updated in place.
+    Closed lots are added to the ledger list, if given (see lot_ledger).
+    matching is one of MATCHING: one of lot_matching.METHODS, or "hmrc" for UK capital gains rules (see _match_hmrc).
+    HMRC matching picks what each sell is matched with by rules rather than by lot, so its lots are kept FIFO, and it has to be
+    given a market's whole history at once """
+    if matching not in MATCHING:
+        raise ValueError(f"Unknown matching {matching!r}, expected one of {MATCHING}")
+    if open_lots is None:
+        open_lots = {}
+
+    n = len(trade_history)
+    initial_cons = np.full(n, np.nan)
+    final_cons = np.full(n, np.nan)
+    fees = np.full(n, np.nan)
+
+    # Pull columns out once as plain arrays, the matching loop only works on these
+    activity = trade_history["Activity"].to_numpy()
+    direction = trade_history["Direction"].to_numpy()
+    quantity = trade_history["Quantity"].to_numpy(dtype=float)
+    price = trade_history["Price"].to_numpy(dtype=float)
+    rate = trade_history["Conversion rate"].to_numpy(dtype=float)
+    trade_fees = np.abs(trade_history["Commission (£)"].to_numpy(dtype=float) + trade_history["Charges"].to_numpy(dtype=float))
+    dates = trade_history["Date"].to_numpy(dtype="datetime64[ns]").astype(np.int64) # as ints, they're only passed through
+
+    # One pass per market. groupby keeps the original (date) order of rows within each market
+    for market, rows in trade_history.groupby("Market", sort=False).indices.items():
+        book = open_lots.setdefault(market, lots_for(matching)())
+        market_ledger = None if ledger is None else []
+        columns = (activity[rows].tolist(), direction[rows].tolist(),
+                   quantity[rows].tolist(), price[rows].tolist(),
+                   rate[rows].tolist(), trade_fees[rows].tolist(), dates[rows].tolist())
+        results = lot_matching.match_market(*columns, {matching: book}, {matching: market_ledger})[matching]
+        if matching == "hmrc":
+            results = _match_hmrc(*columns)
+        initial_cons[rows], final_cons[rows], fees[rows] = results
+        if ledger is not None:
+            ledger += [(market,) + row for row in market_ledger]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        net_profit_pct = (final_cons - fees) / initial_cons - 1
+
+    trade_history = trade_history.copy()
+    trade_history["Initial Consideration (£)"] = round_2(initial_cons)
+    trade_history["Final Consideration (£)"] = round_2(final_cons)
+    trade_history["Gross Profit (£)"] = round_2(final_cons - initial_cons)
+    trade_history["Fees (£)"] = round_2(fees)
+    trade_history["Net Profit (£)"] = round_2(final_cons - initial_cons - fees)
+    trade_history["Net Profit (%)"] = round_2(net_profit_pct)
+
+    # Return only columns we want to see, in date order (stable, so same day trades keep their order)
+    trade_history = trade_history.sort_values(by="Date", kind="mergesort")
     return trade_history[["Date", "Time",
                             "Market", "Activity", "Direction",
                             "Quantity", "Price",
@@ -277,14 +438,220 @@ def trade_history_report(trade_history):
                             #"Gross Profit (£)",
                             "Fees (£)", "Net Profit (£)", "Net Profit (%)"]]
 
+@instrumentation.stage("compare_matching")
+def compare_matching(trade_history, methods=tuple(lot_matching.METHODS)):
+    """ Profit on every sell under each of the lot_matching methods, side by side, from one pass over each market.
+    Expects a cleaned trade history (all of it) and returns the trades in date order with
+    "Initial Consideration (£)", "Fees (£)" and "Net Profit (£)" columns for each method, e.g. "Net Profit (£) LIFO" """
+    n = len(trade_history)
+    activity = trade_history["Activity"].to_numpy()
+    direction = trade_history["Direction"].to_numpy()
+    quantity = trade_history["Quantity"].to_numpy(dtype=float)
+    price = trade_history["Price"].to_numpy(dtype=float)
+    rate = trade_history["Conversion rate"].to_numpy(dtype=float)
+    trade_fees = np.abs(trade_history["Commission (£)"].to_numpy(dtype=float) + trade_history["Charges"].to_numpy(dtype=float))
+    dates = trade_history["Date"].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+
+    results = {method: (np.full(n, np.nan), np.full(n, np.nan), np.full(n, np.nan)) for method in methods}
+    for market, rows in trade_history.groupby("Market", sort=False).indices.items():
+        matched = lot_matching.match_market(activity[rows].tolist(), direction[rows].tolist(),
+                                            quantity[rows].tolist(), price[rows].tolist(),
+                                            rate[rows].tolist(), trade_fees[rows].tolist(), dates[rows].tolist(),
+                                            {method: lot_matching.METHODS[method]() for method in methods})
+        for method in methods:
+            for out, values in zip(results[method], matched[method]):
+                out[rows] = values
+
+    comparison = trade_history[["Date", "Time", "Market", "Activity", "Direction", "Quantity", "Consideration (£)"]].copy()
+    for method, (initial_cons, final_cons, fees) in results.items():
+        label = MATCHING_LABELS[method]
+        comparison[f"Initial Consideration (£) {label}"] = round_2(initial_cons)
+        comparison[f"Fees (£) {label}"] = round_2(fees)
+        comparison[f"Net Profit (£) {label}"] = round_2(final_cons - initial_cons - fees)
+    return comparison.sort_values(by="Date", kind="mergesort")
+
+def matching_summary(comparison, methods=tuple(lot_matching.METHODS)):
+    """ calculate_trades_summary for each method of a (date filtered) compare_matching, by method """
+    summaries = {}
+    for method in methods:
+        label = MATCHING_LABELS[method]
+        trades_df = comparison.rename(columns={f"{column} {label}": column
+                                               for column in ["Initial Consideration (£)", "Fees (£)", "Net Profit (£)"]})
+        summaries[method] = calculate_trades_summary(trades_df)
+    return summaries
+
+def open_lot_rows(open_lots):
+    """ Ledger rows for the lots still open, with no closing date """
+    return [(market, bought, opened, None, qty, price)
+            for market, book in open_lots.items()
+            for bought, opened, qty, price in book.open_rows()]
+
+def ledger_frame(rows):
+    """ DataFrame of lot ledger rows: (market, bought, opened, closed, quantity, price) with dates as ns since 1970 """
+    ledger = pd.DataFrame(rows, columns=LEDGER_COLUMNS)
+    for column in ["Bought", "Opened", "Closed"]:
+        ledger[column] = pd.to_datetime(ledger[column])
+    ledger["Quantity"] = ledger["Quantity"].astype(float)
+    ledger["Price (£)"] = ledger["Price (£)"].astype(float)
+    return ledger
+
+def lot_ledger(ledger, open_lots):
+    """ Every lot (or part of a lot) held, and the dates it was held from (Opened) and until (Closed, NaT if still held).
+    Quantity and Price (£ per share) are constant over that time. Expects the ledger and open_lots from trade_history_report """
+    return ledger_frame(ledger + open_lot_rows(open_lots))
+
+def date_bounds(dates, start_date=None, end_date=None):
+    """ Positions (first, last) of the rows from start_date to end_date (both days included) in a sorted datetime64 array.
+    Missing dates mean no limit on that side """
+    first = 0
+    last = len(dates)
+    if start_date is not None:
+        start = pd.Timestamp(start_date).normalize().to_datetime64()
+        first = dates.searchsorted(start, side="left")
+    if end_date is not None:
+        end = (pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)).to_datetime64() # we want to include the final day
+        last = dates.searchsorted(end, side="left")
+    return first, last
+
+def tax_year_dates(year):
+    """ First and last day of the UK tax year starting in April of year, e.g. 2020 is 6/4/2020 to 5/4/2021 """
+    return date(year, 4, 6), date(year + 1, 4, 5)
+
+def tax_year_of(day):
+    """ The year the tax year containing day started in """
+    return day.year if (day.month, day.day) >= (4, 6) else day.year - 1
+
+def tax_year_label(year):
+    """ e.g. 2020 -> "2020/21" """
+    return f"{year}/{(year + 1) % 100:02d}"
+
+@instrumentation.stage("date_filter")
 def date_filter(start_date, end_date, table):
-    # Convert str dates to datetime
-    date1 = dt.datetime.strptime(start_date, "%Y-%m-%d").date()
-    date2 = dt.datetime.strptime(end_date, "%Y-%m-%d").date()
-
-    filt1 = table["Date"] > date1
-    filt2 = table["Date"] < date2
-    return table[filt1 & filt2]
+    """ Returns the rows of a table from start_date to end_date, both days included.
+    The table must be sorted by Date, the range is found by binary search and returned as a slice """
+    first, last = date_bounds(table["Date"].to_numpy(), start_date, end_date)
+    return table.iloc[first:last]
+
+@instrumentation.stage("to_records")
+def to_records(table):
+    """ DataTable rows for a table, with dates shown without a time """
+    return table.assign(Date=table["Date"].dt.strftime("%Y-%m-%d")).to_dict("records")
+
+def used_transactions(transactions_df, account):
+    """ Mask of the cleaned transactions anything is shown or totalled from: dividends, fees, cash in/out and transfers """
+    mask = (transactions_df["Summary"] == "Dividend") | transactions_df["Summary"].str.contains(FEE_SUMMARIES + "|Cash In|Cash Out")
+    for direction in ("transfer_out", "transfer_in"):
+        if account.get(direction):
+            mask |= transactions_df["MarketName"].str.contains(account[direction], regex=False)
+    return mask.fillna(False).to_numpy(dtype=bool)
+
+@instrumentation.stage("stream_trades")
+def stream_trades(path, chunksize, matching="fifo"):
+    """ Same as trade_history_report(clean_trades(...)) on the export at path, reading chunksize rows at a time.
+    Exports are newest first, so chunks are spilled to disk and then cleaned and matched oldest first,
+    carrying the open positions from one chunk to the next. Only one chunk and the report are in memory at once.
+    Missing conversion rates are filled in from the rates of the whole export, collected as the chunks are spilled.
+    HMRC matching needs the whole history, so the cleaned chunks are matched together.
+    Returns (report, lot ledger, conversion rates) """
+    open_lots = {}
+    ledger = []
+    reports = []
+    rates = []
+    with tempfile.TemporaryDirectory() as spill_dir:
+        spills = []
+        for i, chunk in enumerate(ingest.read_trades(path, chunksize)):
+            spills.append(os.path.join(spill_dir, f"{i}.pkl"))
+            rates.append(fx.export_rates(chunk))
+            chunk.to_pickle(spills[-1])
+            del chunk
+        # The same as fx.export_rates of the whole export
+        rates = pd.concat(rates, ignore_index=True).drop_duplicates(fx.EXPORT_RATE_KEY, keep="last").reset_index(drop=True)
+
+        if matching != "hmrc":
+            for spill in reversed(spills):
+                reports.append(trade_history_report(clean_trades(pd.read_pickle(spill), rates), open_lots, ledger, matching))
+                os.remove(spill)
+        else:
+            cleaned = pd.concat([clean_trades(pd.read_pickle(spill), rates) for spill in reversed(spills)])
+            reports.append(trade_history_report(cleaned, open_lots, ledger, matching))
+
+    # Each report is in date order. A stable sort of them all gives the same order as matching the whole file at once
+    return pd.concat(reports).sort_values(by="Date", kind="mergesort"), lot_ledger(ledger, open_lots), rates
+
+@instrumentation.stage("stream_transactions")
+def stream_transactions(account, chunksize):
+    """ clean_transactions on the account's export, reading chunksize rows at a time.
+    Only the transactions in used_transactions are kept """
+    kept = []
+    for chunk in ingest.read_transactions(account["transactions"], chunksize):
+        chunk = clean_transactions(chunk)
+        kept.append(chunk[used_transactions(chunk, account)])
+        del chunk
+    return pd.concat(kept)
+
+@instrumentation.stage("process_account")
+def process_account(account, chunksize=None, compare=False):
+    """ Reads and processes one account's exports. Returns (trades, transactions, lot ledger, conversion rates) DataFrames.
+    With a chunksize, exports are streamed that many rows at a time so very large files fit in memory.
+    With compare, the profit under every lot matching method (see compare_matching) is worked out from the same
+    cleaned trades and returned as a fifth DataFrame. That needs the whole export, so can't be done with a chunksize """
+    matching = account.get("matching", "fifo")
+    if chunksize and compare:
+        raise ValueError("Comparing lot matching methods needs whole exports, not chunks")
+    if chunksize:
+        trades_df, lots_df, rates_df = stream_trades(account["trades"], chunksize, matching)
+        return trades_df, stream_transactions(account, chunksize), lots_df, rates_df
+
+    open_lots = {}
+    ledger = []
+    raw_trades = ingest.read_trades(account["trades"])
+    rates_df = fx.export_rates(raw_trades)
+    cleaned = clean_trades(raw_trades, rates_df)
+    trades_df = trade_history_report(cleaned, open_lots, ledger, matching)
+    transactions_df = clean_transactions(ingest.read_transactions(account["transactions"]))
+    if compare:
+        return trades_df, transactions_df, lot_ledger(ledger, open_lots), rates_df, compare_matching(cleaned)
+    return trades_df, transactions_df, lot_ledger(ledger, open_lots), rates_df
+
+def map_accounts(function, accounts, workers=None):
+    """ function(account) for every account, each in its own process when there's more than one.
+    Returns the results in the same order """
+    if len(accounts) <= 1 or workers == 1:
+        return [function(account) for account in accounts]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if not instrumentation.ENABLED:
+            return list(pool.map(function, accounts))
+        results = list(pool.map(partial(instrumentation.collected, function), accounts))
+
+    # Bring the workers' timings back into this process
+    for _, metrics in results:
+        instrumentation.REGISTRY.merge(metrics)
+    return [result for result, _ in results]
+
+@instrumentation.stage("process_files")
+def process_files(accounts, workers=None, chunksize=None, compare=False):
+    """ Reads every account's IG.com exports and runs them through the whole pipeline, accounts in parallel.
+    Expects the account registry and returns a dict of the processed DataFrames.
+    With compare, it also has "comparisons": each account's compare_matching """
+    return combine_accounts(accounts, map_accounts(partial(process_account, chunksize=chunksize, compare=compare), accounts, workers))
+
+def combine_accounts(accounts, results):
+    """ The dict of processed DataFrames returned by process_files, from each account's
+    (trades, transactions, lot ledger, conversion rates[, matching comparison]) in the same order as accounts """
+    trades = {account["name"]: result[0] for account, result in zip(accounts, results)}
+    transactions = {account["name"]: result[1] for account, result in zip(accounts, results)}
+    lots = {account["name"]: result[2] for account, result in zip(accounts, results)}
+
+    data = {"trades": trades,
+            "transactions": transactions,
+            "lots": lots,
+            # Every rate trades were converted to £ at, for showing amounts in other currencies (see fx)
+            "rates": pd.concat([result[3] for result in results], ignore_index=True),
+            "dividends": format_dividends_datatable(transactions)["df"],
+            "fees": format_fees_datatable(transactions)["df"]}
+    if all(len(result) > 4 for result in results):
+        data["comparisons"] = {account["name"]: result[4] for account, result in zip(accounts, results)}
+    return data
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
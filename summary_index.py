@@ -0,0 +1,229 @@
+import numpy as np
+import pandas as pd
+
+import process_data
+
+# Summary totals for any date range without touching the rows.
+# Each table is reduced once, at load time, to cumulative sums over its date sorted rows.
+# The total between two dates is then two binary searches and a subtraction.
+# Totals are also rolled up by tax month (the 6th to the 5th, so twelve make a tax year). Ranges made of
+# whole tax months, like the tax years picked in the dashboard, are answered from those without searching the rows.
+
+FEE_TYPES = {"section_31": "Section 31 Fee", "custody": "Custody Fee", "commission": "Share Dealing Commissions"}
+
+
+def tax_month_start(day):
+    """ The 6th the tax month containing day started on """
+    day = pd.Timestamp(day).normalize()
+    start = day.replace(day=6)
+    return start if day.day >= 6 else start - pd.DateOffset(months=1)
+
+
+def build_rollup(dates, sums):
+    """ Cumulative totals at the start of every tax month from the first row's to the one after the last row's.
+    Read off the prefix sums, so the rows aren't gone through again """
+    if len(dates) == 0:
+        return {"starts": np.array([], dtype="datetime64[ns]"), "sums": {name: values[:1] for name, values in sums.items()}}
+    starts = pd.date_range(tax_month_start(dates[0]), tax_month_start(dates[-1]) + pd.DateOffset(months=1),
+                           freq=pd.DateOffset(months=1)).to_numpy()
+    positions = dates.searchsorted(starts, side="left")
+    return {"starts": starts, "sums": {name: values[positions] for name, values in sums.items()}}
+
+
+def build_prefix_sums(dates, columns):
+    """ Expects a sorted datetime64 array and a dict of value arrays in the same order.
+    Returns cumulative sums of each, with a leading 0 so any range is sums[last] - sums[first],
+    and the same by tax month """
+    sums = {name: np.concatenate([[0.0], np.cumsum(values, dtype=float)]) for name, values in columns.items()}
+    return {"dates": dates, "sums": sums, "rollup": build_rollup(dates, sums)}
+
+
+def _month_bounds(rollup, start_date, end_date):
+    """ Positions (first, last) in the rollup of a range of whole tax months, or None if the range isn't one """
+    starts = rollup["starts"]
+    first, last = 0, len(starts) - 1
+    if start_date is not None:
+        start = pd.Timestamp(start_date).normalize()
+        if start.day != 6:
+            return None
+        first = starts.searchsorted(start.to_datetime64(), side="left")
+    if end_date is not None:
+        end = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+        if end.day != 6:
+            return None
+        last = starts.searchsorted(end.to_datetime64(), side="left")
+    # Months before the first row or after the last have nothing in them
+    last = min(last, len(starts) - 1)
+    return min(first, last), last
+
+
+def range_totals(prefix_sums, start_date=None, end_date=None):
+    """ Totals of every column from start_date to end_date (both included) """
+    rollup = prefix_sums["rollup"]
+    if len(rollup["starts"]):
+        bounds = _month_bounds(rollup, start_date, end_date)
+        if bounds is not None:
+            first, last = bounds
+            return {name: sums[last] - sums[first] for name, sums in rollup["sums"].items()}
+
+    first, last = process_data.date_bounds(prefix_sums["dates"], start_date, end_date)
+    return {name: sums[last] - sums[first] for name, sums in prefix_sums["sums"].items()}
+
+
+def _where(filt, values):
+    """ values where filt is true, 0 elsewhere """
+    return np.where(filt, np.nan_to_num(values.to_numpy(dtype=float)), 0.0)
+
+
+def build_trades_index(trades_df):
+    """ Prefix sums of the closed positions in a (date sorted) trade history report """
+    closed = trades_df["Net Profit (£)"].notna().to_numpy()
+    return build_prefix_sums(trades_df["Date"].to_numpy(), {
+        "consideration": _where(closed, trades_df["Consideration (£)"]),
+        "fees": _where(closed, trades_df["Fees (£)"]),
+        "net_profit": _where(closed, trades_df["Net Profit (£)"]),
+        "initial_consideration": _where(closed, trades_df["Initial Consideration (£)"]),
+    })
+
+
+def build_dividends_index(dividends_df):
+    """ Prefix sums of dividends for each account """
+    return build_prefix_sums(dividends_df["Date"].to_numpy(), {
+        account: _where(dividends_df["Account"] == account, dividends_df["PL Amount"])
+        for account in dividends_df["Account"].unique()
+    })
+
+
+def build_fees_index(fees_df):
+    """ Prefix sums of each type of fee for each account, by (account, fee type) """
+    return build_prefix_sums(fees_df["Date"].to_numpy(), {
+        (account, fee_type): _where((fees_df["Account"] == account) & fees_df["Summary"].str.contains(summary), fees_df["PL Amount"])
+        for account in fees_df["Account"].unique()
+        for fee_type, summary in FEE_TYPES.items()
+    })
+
+
+def build_cashflow_index(transactions_df, account):
+    """ Prefix sums of cash in, cash out, and transfers to/from our other accounts for one account's transactions """
+    transactions_df = transactions_df.sort_values(by="Date", kind="mergesort")
+    columns = {
+        "cash_in": _where(transactions_df["Summary"].str.contains("Cash In"), transactions_df["PL Amount"]),
+        "cash_out": _where(transactions_df["Summary"].str.contains("Cash Out"), transactions_df["PL Amount"]),
+    }
+    for direction in ("transfer_out", "transfer_in"):
+        if account.get(direction):
+            columns[direction] = _where(transactions_df["MarketName"].str.contains(account[direction], regex=False), transactions_df["PL Amount"])
+    return build_prefix_sums(transactions_df["Date"].to_numpy(), columns)
+
+
+def build_summary_index(trades, dividends_df, fees_df, transactions, accounts):
+    """ Builds everything needed for the summary tables. Done once when the data is loaded.
+    trades and transactions are dicts of DataFrames by account name """
+    index = {"trades": {account["name"]: build_trades_index(trades[account["name"]]) for account in accounts},
+             "dividends": build_dividends_index(dividends_df),
+             "fees": build_fees_index(fees_df),
+             "cash_flow": {account["name"]: build_cashflow_index(transactions[account["name"]], account) for account in accounts}}
+    index["rollups"] = rollup_table(index)
+    return index
+
+
+def trades_summary(index, account, start_date=None, end_date=None):
+    """ Same as process_data.calculate_trades_summary for one account's trades in the date range """
+    totals = range_totals(index["trades"][account], start_date, end_date)
+
+    initial_cons = totals["initial_consideration"]
+    final_cons = totals["consideration"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        net_profit_per = (final_cons/initial_cons - 1)*100
+
+    return {"sold_pos": round(final_cons, 2),
+            "fees": round(abs(totals["fees"]), 2),
+            "net_profit": round(totals["net_profit"], 2),
+            "net_profit_per": net_profit_per,
+            "ic": initial_cons,
+            "fc": final_cons}
+
+
+def dividends_summary(index, start_date=None, end_date=None):
+    """ Same as process_data.calculate_dividends_summary for the date range """
+    totals = range_totals(index["dividends"], start_date, end_date)
+    return {account: round(total, 2) for account, total in totals.items()}
+
+
+def fees_summary(index, start_date=None, end_date=None):
+    """ Same as process_data.calculate_fees_summary for the date range """
+    totals = range_totals(index["fees"], start_date, end_date)
+    return {fee_type: round(abs(sum(total for (_, kind), total in totals.items() if kind == fee_type)), 2)
+            for fee_type in FEE_TYPES}
+
+
+def cashflow_summary(index, start_date=None, end_date=None):
+    """ Same as process_data.calculate_cashflow_summary, optionally limited to a date range, but without checking
+    transfers (see check_transfers). Transfers out and in are also given separately: a transfer can leave one account
+    on the last day of a range and arrive in the other the day after """
+    cash_in = {}
+    cash_out = 0
+    transfers_out = 0
+    transfers_in = 0
+    for account, prefix_sums in index["cash_flow"].items():
+        totals = range_totals(prefix_sums, start_date, end_date)
+        cash_in[account] = round(abs(totals["cash_in"]), 2)
+        cash_out += round(abs(totals["cash_out"]), 2)
+        transfers_out += round(abs(totals.get("transfer_out", 0.0)), 2)
+        transfers_in += round(abs(totals.get("transfer_in", 0.0)), 2)
+
+    return {"cash_in": cash_in,
+            "cash_out": round(cash_out, 2),
+            "transfers": round(transfers_out, 2),
+            "transfers_out": round(transfers_out, 2),
+            "transfers_in": round(transfers_in, 2)}
+
+
+def check_transfers(transactions, accounts):
+    """ Raises ValueError if, over all time, the amount transferred out of our accounts doesn't match the amount
+    transferred in. Expects transactions in £: converted to another currency, each side of a transfer is at the rate
+    on its own day, and a transfer can arrive days after it left """
+    index = {"cash_flow": {account["name"]: build_cashflow_index(transactions[account["name"]], account)
+                           for account in accounts}}
+    totals = cashflow_summary(index)
+    if round(totals["transfers_out"], 2) != round(totals["transfers_in"], 2):
+        raise ValueError(f"£{totals['transfers_out']:,.2f} was transferred out of our accounts "
+                         f"but £{totals['transfers_in']:,.2f} was transferred in")
+
+
+def _rollup_months(prefix_sums):
+    """ (tax year, month of the tax year, {column: total that month}) for every tax month in a rollup """
+    rollup = prefix_sums["rollup"]
+    for i, start in enumerate(rollup["starts"][:-1]):
+        start = pd.Timestamp(start)
+        yield (process_data.tax_year_of(start), (start.month - 4) % 12 + 1,
+               {name: sums[i + 1] - sums[i] for name, sums in rollup["sums"].items()})
+
+
+def rollup_table(index):
+    """ Totals by account, tax year and tax month (1 is 6 April to 5 May) of trades, dividends and each type of fee """
+    rows = {}
+    def add(account, prefix_sums, names):
+        for year, month, totals in _rollup_months(prefix_sums):
+            row = rows.setdefault((account, year, month), {})
+            for column, name in names(totals):
+                row[name] = row.get(name, 0.0) + totals[column]
+
+    for account, prefix_sums in index["trades"].items():
+        add(account, prefix_sums, lambda totals: [(column, column) for column in totals])
+    for account in index["dividends"]["sums"]:
+        add(account, index["dividends"], lambda totals, account=account: [(account, "dividends")])
+    for account, fee_type in index["fees"]["sums"]:
+        add(account, index["fees"], lambda totals, key=(account, fee_type): [(key, key[1])])
+
+    table = pd.DataFrame.from_dict(rows, orient="index").fillna(0.0)
+    if len(table):
+        table.index = pd.MultiIndex.from_tuples(table.index, names=["account", "tax_year", "month"])
+        table.sort_index(inplace=True)
+    return table
+
+
+def tax_years(index):
+    """ Every tax year with any trades, dividends or fees in it """
+    table = index["rollups"]
+    return sorted(table.index.get_level_values("tax_year").unique()) if len(table) else []
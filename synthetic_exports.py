@@ -0,0 +1,207 @@
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+# Realistic fake IG.com exports, for benchmarking and trying things out without real account data.
+# The same seed always gives the same files. Rows are generated oldest first in blocks, and each block is
+# written out reversed to its own file, so even 10M row exports (newest first, like IG's) never sit in memory.
+
+TRADES_HEADER = ["Date", "Time", "Activity", "Market", "Direction", "Quantity", "Price", "Currency",
+                 "Consideration", "Commission", "Charges", "Cost/Proceeds", "Conversion rate"]
+TRANSACTIONS_HEADER = ["Date", "Summary", "MarketName", "Period", "ProfitAndLoss", "Transaction type", "Reference",
+                       "Open level", "Close level", "Size", "Currency", "PL Amount", "Cash transaction",
+                       "DateUtc", "OpenDateUtc", "CurrencyIsoCode"]
+
+# (Market as it appears in trades, price range in cents). UK shares pay stamp duty, shown in Charges
+MARKETS = [("Apple Inc (All Sessions)", (10000, 20000)),
+           ("Tesla Motors Inc (All Sessions)", (20000, 90000)),
+           ("Nvidia Corp (All Sessions)", (10000, 60000)),
+           ("Microsoft Corp (All Sessions)", (15000, 35000)),
+           ("Amazon.com Inc (All Sessions)", (150000, 350000)),
+           ("Lloyds Banking Group PLC", (30, 70)),
+           ("Vodafone Group PLC", (90, 160)),
+           ("BP PLC", (250, 550))]
+
+START_DATE = datetime(2018, 3, 1, 9, 0)
+SPAN = timedelta(days=6 * 365) # rows are spread over this long whatever the size
+BLOCK_ROWS = 100000
+COMMISSION_CHANGE = datetime(2020, 4, 5) # $15 per trade before, £10 after
+
+
+def _gaps(rnd, rows):
+    """ Random time between rows, averaging out so rows rows take SPAN """
+    most = max(2, int(2 * SPAN.total_seconds() / max(rows, 1)))
+    return lambda: timedelta(seconds=rnd.randint(1, most))
+
+
+def _share_name(market):
+    return market.replace(" (All Sessions)", "")
+
+
+def _write_reversed(path, header, blocks):
+    """ Writes the rows from blocks (lists of rows, oldest first) to path newest first.
+    Each block is reversed into its own file, then the files are joined last to first """
+    with tempfile.TemporaryDirectory() as parts_dir:
+        parts = []
+        for block in blocks:
+            parts.append(os.path.join(parts_dir, f"{len(parts)}.csv"))
+            with open(parts[-1], "w", newline="") as f:
+                csv.writer(f).writerows(reversed(block))
+
+        with open(path, "w", newline="") as out:
+            csv.writer(out).writerow(header)
+            for part in reversed(parts):
+                with open(part) as f:
+                    shutil.copyfileobj(f, out)
+
+
+def _trade_rows(rows, seed):
+    """ Blocks of TradeHistory rows, oldest first. Buys, partial and full sells, and the odd share split """
+    rnd = random.Random(seed)
+    held = {market: 0 for market, _ in MARKETS}
+    gap = _gaps(rnd, rows)
+    date = START_DATE
+    block = []
+    written = 0
+
+    while written < rows:
+        date += gap()
+        market, (low, high) = rnd.choice(MARKETS)
+        rate = round(rnd.uniform(0.7, 0.82), 4) if "PLC" not in market else 1.0
+        price = round(rnd.uniform(low, high), 2)
+        commission = -15.0 if date < COMMISSION_CHANGE else -10.0
+
+        if held[market] > 0 and rnd.random() < 0.002:
+            # Share split. IG shows it as selling everything and buying back the new number of shares
+            ratio = rnd.choice([2, 3, 4, 5, 10])
+            block.append([date, "CORPORATE ACTION", market, "SELL", -held[market], 0, 0, 0, 0, rate])
+            block.append([date + timedelta(seconds=1), "CORPORATE ACTION", market, "BUY", held[market] * ratio, 0, 0, 0, 0, rate])
+            held[market] *= ratio
+            written += 2
+        elif held[market] > 0 and rnd.random() < 0.4:
+            # Partial sells mostly, sometimes the whole position
+            quantity = held[market] if rnd.random() < 0.2 else rnd.randint(1, held[market])
+            held[market] -= quantity
+            block.append([date, "TRADE", market, "SELL", -quantity, price, round(quantity * price / 100, 2), commission, 0.0, rate])
+            written += 1
+        else:
+            quantity = rnd.randint(1, 2000) if "PLC" in market else rnd.randint(1, 100)
+            held[market] += quantity
+            consideration = round(-quantity * price / 100, 2)
+            charges = -round(abs(consideration) * 0.005, 2) if "PLC" in market else 0.0
+            block.append([date, "TRADE", market, "BUY", quantity, price, consideration, commission, charges, rate])
+            written += 1
+
+        if len(block) >= BLOCK_ROWS:
+            yield [_format_trade(row) for row in block]
+            block = []
+    if block:
+        yield [_format_trade(row) for row in block]
+
+
+def _format_trade(row):
+    date, activity, market, direction, quantity, price, consideration, commission, charges, rate = row
+    currency = "GBX" if "PLC" in market else "USD"
+    return [date.strftime("%d-%m-%Y"), date.strftime("%H:%M:%S"), activity, market, direction, quantity, price, currency,
+            consideration, commission, charges, round(consideration + commission + charges, 2), rate]
+
+
+def _transaction_rows(rows, seed, transfer_out=None, transfer_in=None):
+    """ Blocks of TransactionHistory rows, oldest first. Dividends, commissions, fees, deposits, withdrawals and transfers """
+    rnd = random.Random(seed)
+    # Transfers are every 50th row, with amounts that depend only on the number of rows.
+    # So both sides of a transfer between two generated accounts add up
+    transfer_rnd = random.Random(rows)
+    gap = _gaps(rnd, rows)
+    date = START_DATE
+    block = []
+
+    for i in range(rows):
+        date += gap()
+        share = _share_name(rnd.choice(MARKETS)[0])
+        kind = rnd.random()
+
+        if i % 50 == 49 and (transfer_out or transfer_in):
+            amount = round(transfer_rnd.uniform(100, 5000), 2)
+            if transfer_out:
+                block.append([date, "Transfers", transfer_out, -amount])
+            else:
+                block.append([date, "Transfers", transfer_in, amount])
+        elif kind < 0.35:
+            quantity = rnd.randint(1, 500)
+            price = round(rnd.uniform(0.01, 1.5), 4)
+            rate = round(rnd.uniform(0.7, 0.82), 4)
+            block.append([date, "Dividend", f"{share} DIVIDEND {quantity}@{price} converted at {rate}", round(quantity * price * rate, 2)])
+        elif kind < 0.55:
+            block.append([date, "Share Dealing Commissions", f"{share} COMM", -10.0])
+        elif kind < 0.62:
+            block.append([date, "Other", f"{share} (All Sessions) Section 31 Fee", -round(rnd.uniform(0.01, 5), 2)])
+        elif kind < 0.65:
+            block.append([date, "Other", "Custody Fee " + date.strftime("%b %Y"), -24.0])
+        elif kind < 0.88:
+            deposit = rnd.choice(["Bank Deposit", "Cheque Received"])
+            block.append([date, "Cash In", deposit, round(rnd.uniform(100, 10000), 2)])
+        else:
+            block.append([date, "Cash Out", "Withdrawal", -round(rnd.uniform(100, 5000), 2)])
+
+        if len(block) >= BLOCK_ROWS:
+            yield [_format_transaction(row) for row in block]
+            block = []
+    if block:
+        yield [_format_transaction(row) for row in block]
+
+
+def _format_transaction(row):
+    date, summary, market_name, amount = row
+    return [date.strftime("%d/%m/%Y %H:%M:%S"), summary, market_name, "-", f"£{amount:,.2f}", "DEPO", "REF", "0", "0", "-", "£",
+            f"{amount:,.2f}", "true", date.strftime("%Y-%m-%dT%H:%M:%S"), date.strftime("%Y-%m-%dT%H:%M:%S"), "GBP"]
+
+
+def generate_trades(path, rows, seed=0):
+    """ Writes a TradeHistory.csv with about rows trades """
+    _write_reversed(path, TRADES_HEADER, _trade_rows(rows, seed))
+
+
+def generate_transactions(path, rows, seed=0, transfer_out=None, transfer_in=None):
+    """ Writes a TransactionHistory.csv with rows transactions. transfer_out/transfer_in are the MarketName of
+    transfers to/from another account, as in the account registry """
+    _write_reversed(path, TRANSACTIONS_HEADER, _transaction_rows(rows, seed, transfer_out, transfer_in))
+
+
+def generate_accounts(folder, rows, seed=0):
+    """ Writes Share Dealing and ISA exports with rows trades and rows transactions each, plus an accounts.json for them.
+    Returns the account registry """
+    os.makedirs(folder, exist_ok=True)
+    accounts = [{"name": "Share Dealing",
+                 "trades": "TradeHistory (Share Dealing).csv",
+                 "transactions": "TransactionHistory (Share Dealing).csv",
+                 "transfer_out": "Funds Transfer to ISA"},
+                {"name": "ISA",
+                 "trades": "TradeHistory (ISA).csv",
+                 "transactions": "TransactionHistory (ISA).csv",
+                 "transfer_in": "Funds Transfer from Share dealing"}]
+
+    for i, account in enumerate(accounts):
+        generate_trades(os.path.join(folder, account["trades"]), rows, seed * 100 + i)
+        generate_transactions(os.path.join(folder, account["transactions"]), rows, seed * 100 + i,
+                              account.get("transfer_out"), account.get("transfer_in"))
+
+    with open(os.path.join(folder, "accounts.json"), "w") as f:
+        json.dump({"accounts": accounts}, f, indent=4)
+
+    return [dict(account, trades=os.path.join(folder, account["trades"]),
+                 transactions=os.path.join(folder, account["transactions"])) for account in accounts]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes synthetic IG.com Share Dealing and ISA exports")
+    parser.add_argument("folder")
+    parser.add_argument("--rows", type=int, default=10000, help="trades and transactions per account")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_accounts(args.folder, args.rows, args.seed)
@@ -0,0 +1,134 @@
+import math
+import re
+
+import pandas as pd
+
+import compact
+import instrumentation
+import process_data
+
+# Server side paging, sorting and filtering for DataTables using page_action/sort_action/filter_action="custom".
+# Only the page being looked at is sent to the browser.
+
+PAGE_SIZE = 50
+
+# DataTable filter query operators, in every spelling. An s prefix is case sensitive (the same as no prefix),
+# an i prefix case insensitive. Case insensitive comparisons are "i" + the comparison
+OPERATORS = {
+    ">=": "ge", "ge": "ge", "s>=": "ge", "sge": "ge", "i>=": "ige", "ige": "ige",
+    "<=": "le", "le": "le", "s<=": "le", "sle": "le", "i<=": "ile", "ile": "ile",
+    "!=": "ne", "ne": "ne", "s!=": "ne", "sne": "ne", "i!=": "ine", "ine": "ine",
+    "<": "lt", "lt": "lt", "s<": "lt", "slt": "lt", "i<": "ilt", "ilt": "ilt",
+    ">": "gt", "gt": "gt", "s>": "gt", "sgt": "gt", "i>": "igt", "igt": "igt",
+    "=": "eq", "eq": "eq", "s=": "eq", "seq": "eq", "i=": "ieq", "ieq": "ieq",
+    "contains": "contains", "scontains": "contains", "icontains": "icontains",
+    # Dates have no case
+    "datestartswith": "datestartswith", "sdatestartswith": "datestartswith", "idatestartswith": "datestartswith",
+}
+
+FILTER_TERM_PATTERN = re.compile(r"""
+    ^\s*\{(?P<column>[^}]*)\}\s*                 # {column id}
+    (?P<operator>is\ blank|is\ not\ blank|[si]?(?:>=|<=|!=|<|>|=)|[a-z]+)\s*
+    (?P<value>.*?)\s*$
+    """, re.VERBOSE)
+
+
+def parse_filter_query(filter_query):
+    """ Splits a DataTable filter_query such as '{Market} contains "Apple" && {Quantity} > 10'
+    into a list of (column, operator, value). Raises ValueError for a term it can't understand """
+    terms = []
+    if not filter_query:
+        return terms
+
+    for part in filter_query.split(" && "):
+        match = FILTER_TERM_PATTERN.match(part)
+        if match is None:
+            raise ValueError(f"Can't understand the filter {part.strip()}")
+        operator = match.group("operator")
+        value = match.group("value")
+
+        # Strip quotes from the value, whichever kind the table used
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'`":
+            value = value[1:-1]
+
+        if operator in ("is blank", "is not blank"):
+            terms.append((match.group("column"), operator, None))
+        elif operator in OPERATORS:
+            terms.append((match.group("column"), OPERATORS[operator], value))
+        else:
+            raise ValueError(f"Can't understand the filter {part.strip()}")
+    return terms
+
+
+def _filter_mask(column, operator, value):
+    """ Vectorised boolean mask for one filter term """
+    if operator == "is blank":
+        return column.isna() | (column.astype(str) == "")
+    if operator == "is not blank":
+        return column.notna() & (column.astype(str) != "")
+    if operator == "contains":
+        return column.astype(str).str.contains(value, regex=False)
+    if operator == "icontains":
+        return column.astype(str).str.lower().str.contains(value.lower(), regex=False)
+    if operator == "datestartswith":
+        return column.dt.strftime("%Y-%m-%d").str.startswith(value)
+
+    # Comparisons. Convert the value to the column's type first
+    insensitive = operator.startswith("i")
+    operator = operator[1:] if insensitive else operator
+    if pd.api.types.is_datetime64_any_dtype(column):
+        value = pd.Timestamp(value)
+    elif pd.api.types.is_numeric_dtype(column):
+        value = float(value)
+    elif insensitive:
+        column, value = column.astype(str).str.lower(), value.lower()
+    else:
+        column = column.astype(str)
+
+    return {"eq": column == value,
+            "ne": column != value,
+            "lt": column < value,
+            "le": column <= value,
+            "gt": column > value,
+            "ge": column >= value}[operator]
+
+
+def apply_filter(table, filter_query):
+    """ Rows of table matching a DataTable filter_query. Raises ValueError for a filter that can't be applied """
+    mask = None
+    for column, operator, value in parse_filter_query(filter_query):
+        if column not in table.columns:
+            raise ValueError(f"There's no {column} column to filter")
+        try:
+            term = _filter_mask(table[column], operator, value)
+        except (ValueError, TypeError):
+            raise ValueError(f"Can't filter {column} with {value}")
+        mask = term if mask is None else mask & term
+    return table if mask is None else table[mask.to_numpy()]
+
+
+def apply_sort(table, sort_by):
+    """ table sorted by a DataTable sort_by list, e.g. [{"column_id": "Date", "direction": "desc"}] """
+    sort_by = [s for s in sort_by or [] if s["column_id"] in table.columns]
+    if not sort_by:
+        return table
+    return table.sort_values(by=[s["column_id"] for s in sort_by],
+                                ascending=[s["direction"] == "asc" for s in sort_by],
+                                kind="mergesort", na_position="last")
+
+
+@instrumentation.stage("query_table")
+def query_table(table, start_date, end_date, page_current=0, page_size=PAGE_SIZE, sort_by=None, filter_query=""):
+    """ One page of a date sorted table, after date range, filter and sort.
+    Returns (DataTable records, page_count). Raises ValueError for a filter that can't be applied """
+    table = process_data.date_filter(start_date, end_date, table)
+    table = compact.expand_table(table) # filters are written in £
+    table = apply_filter(table, filter_query)
+    table = apply_sort(table, sort_by)
+
+    page_size = page_size or PAGE_SIZE
+    page_count = max(1, math.ceil(len(table) / page_size))
+    page_current = min(page_current or 0, page_count - 1)
+    first = page_current * page_size
+
+    return process_data.to_records(table.iloc[first:first + page_size]), page_count
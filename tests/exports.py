@@ -0,0 +1,42 @@
+import json
+import os
+
+# Small handwritten exports for tests
+
+TRADES_HEADER = "Date,Time,Activity,Market,Direction,Quantity,Price,Currency,Consideration,Commission,Charges,Cost/Proceeds,Conversion rate"
+TRANSACTIONS_HEADER = ("Date,Summary,MarketName,Period,ProfitAndLoss,Transaction type,Reference,Open level,Close level,Size,"
+                       "Currency,PL Amount,Cash transaction,DateUtc,OpenDateUtc,CurrencyIsoCode")
+
+
+def transaction(date, summary, market_name, amount):
+    return f"{date} 12:00:00,{summary},{market_name},-,£{amount},DEPO,REF,0,0,-,£,{amount},true,,,GBP"
+
+
+def write_portfolio(folder):
+    """ Two accounts, with £1000 sent from Share Dealing on the last day of the 2020/21 tax year
+    and arriving in the ISA on the first day of 2021/22 """
+    exports = {
+        "TradeHistory (Share Dealing).csv": [TRADES_HEADER,
+            "01-06-2020,09:00:00,TRADE,Lloyds Banking Group PLC (All Sessions),BUY,100,3000,GBX,-3000.0,-10.0,0.0,-3010.0,1.0"],
+        "TradeHistory (ISA).csv": [TRADES_HEADER,
+            "01-06-2021,09:00:00,TRADE,Lloyds Banking Group PLC (All Sessions),BUY,100,3000,GBX,-3000.0,-10.0,0.0,-3010.0,1.0"],
+        "TransactionHistory (Share Dealing).csv": [TRANSACTIONS_HEADER,
+            transaction("05/04/2021", "Transfers", "Funds Transfer to ISA", "-1000.00"),
+            transaction("01/05/2020", "Cash In", "Bank Deposit", "5000.00")],
+        "TransactionHistory (ISA).csv": [TRANSACTIONS_HEADER,
+            transaction("06/04/2021", "Transfers", "Funds Transfer from Share dealing", "1000.00"),
+            transaction("07/04/2021", "Cash In", "Bank Deposit", "3000.00")],
+    }
+    for name, lines in exports.items():
+        with open(os.path.join(folder, name), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    accounts = {"accounts": [
+        {"name": "Share Dealing", "trades": "TradeHistory (Share Dealing).csv",
+         "transactions": "TransactionHistory (Share Dealing).csv", "transfer_out": "Funds Transfer to ISA"},
+        {"name": "ISA", "trades": "TradeHistory (ISA).csv",
+         "transactions": "TransactionHistory (ISA).csv", "transfer_in": "Funds Transfer from Share dealing"}]}
+    path = os.path.join(folder, "accounts.json")
+    with open(path, "w") as f:
+        json.dump(accounts, f)
+    return path
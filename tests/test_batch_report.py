@@ -0,0 +1,44 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch_report
+from exports import write_portfolio
+
+
+def test_transfer_across_tax_years(tmp_path):
+    path = write_portfolio(tmp_path)
+    _, reports = batch_report.portfolio_reports(path, [2020, 2021])
+
+    assert reports[0]["cash_flow"]["transfers_out"] == 1000.0
+    assert reports[0]["cash_flow"]["transfers_in"] == 0.0
+    assert reports[1]["cash_flow"]["transfers_out"] == 0.0
+    assert reports[1]["cash_flow"]["transfers_in"] == 1000.0
+
+
+def test_run_writes_every_year(tmp_path):
+    folder = tmp_path / "client"
+    folder.mkdir()
+    path = write_portfolio(folder)
+    out = tmp_path / "reports"
+    out.mkdir()
+
+    results = batch_report.run([path], [2020, 2021], str(out), workers=1)
+
+    assert [report["tax_year"] for report in results["client"]] == ["2020/21", "2021/22"]
+    for stem in ["2020-21", "2021-22"]:
+        for extension in batch_report.FORMATS:
+            assert (out / "client" / f"{stem}.{extension}").exists()
+    assert (out / "summary.csv").exists()
+
+
+def test_compare_matching(tmp_path):
+    path = write_portfolio(tmp_path)
+    _, reports = batch_report.portfolio_reports(path, [2020], compare_matching=True)
+
+    # Nothing was sold, so every method shows no profit
+    assert set(reports[0]["matching"]) == {"Share Dealing", "ISA"}
+    for methods in reports[0]["matching"].values():
+        assert set(methods) == {"fifo", "lifo", "hifo", "average"}
+        assert all(totals["net_profit"] == 0.0 for totals in methods.values())
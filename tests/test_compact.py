@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compact
+
+
+def trades():
+    return pd.DataFrame({"Date": pd.to_datetime(["2021-01-04", "2021-02-01", "2021-03-01"]),
+                         "Time": ["09:00:00", "09:00:00", "14:30:00"],
+                         "Market": ["Apple Inc", "Apple Inc", "Tesla Inc"],
+                         "Consideration (£)": [-100.5, 50.25, 2_000_000.0],
+                         "Net Profit (£)": [np.nan, -12.34, 7.5]})
+
+
+def test_every_money_column_is_pence():
+    table = compact.compact_table(trades())
+    assert table["Consideration (£)"].dtype == "int32"
+    assert table["Net Profit (£)"].dtype == "Int16" # nullable, the first row has no profit
+    assert table["Time"].dtype == "category"
+
+
+def test_smaller():
+    # Categoricals only pay off once strings repeat
+    many = pd.concat([trades()] * 100, ignore_index=True)
+    assert compact.table_bytes(compact.compact_table(many)) < compact.table_bytes(many) / 2
+
+
+def test_expand_gives_pounds_back():
+    pd.testing.assert_frame_equal(compact.expand_table(compact.compact_table(trades()))[["Consideration (£)", "Net Profit (£)"]],
+                                  trades()[["Consideration (£)", "Net Profit (£)"]])
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_cache
+import process_data
+import synthetic_exports
+
+
+def add_unused_transaction(path):
+    """ Adds interest, which the dashboard doesn't show, to a transactions export """
+    transactions = pd.read_csv(path, dtype=str, keep_default_na=False)
+    interest = transactions.iloc[[0]].assign(Summary="Interest", MarketName="Interest")
+    pd.concat([interest, transactions]).to_csv(path, index=False)
+
+
+def test_chunked_and_whole_file_entries_are_kept_apart(tmp_path):
+    accounts = synthetic_exports.generate_accounts(str(tmp_path / "exports"), 2000)
+    for account in accounts:
+        add_unused_transaction(account["transactions"])
+    cache_dir = str(tmp_path / "cache")
+    expected = process_data.process_files(accounts, workers=1)
+
+    # Read in chunks, only the transactions the dashboard uses are kept. A later whole file run mustn't reuse them
+    chunked = data_cache.load_data(accounts, cache_dir, workers=1, chunksize=500)
+    whole = data_cache.load_data(accounts, cache_dir, workers=1)
+    for account in accounts:
+        name = account["name"]
+        assert len(chunked["transactions"][name]) < len(expected["transactions"][name])
+        pd.testing.assert_frame_equal(whole["transactions"][name], expected["transactions"][name])
+
+    # And the other way round
+    chunked = data_cache.load_data(accounts, cache_dir, workers=1, chunksize=500)
+    assert all(len(chunked["transactions"][a["name"]]) < len(expected["transactions"][a["name"]]) for a in accounts)
@@ -0,0 +1,90 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fx
+import incremental
+import process_data
+import synthetic_exports
+
+ROWS = 3000
+CHUNKSIZE = 500
+
+
+def blank_rates(path, skip=100):
+    """ Blanks the conversion rate of the USD trades at the end of each CHUNKSIZE rows (the oldest trades in each chunk,
+    as exports are newest first), leaving the oldest skip rows alone """
+    trades = pd.read_csv(path, dtype=str, keep_default_na=False)
+    rows = np.arange(len(trades))
+    blank = (trades["Currency"].to_numpy() == "USD") & (rows % CHUNKSIZE >= CHUNKSIZE - 30) & (rows < len(trades) - skip)
+    trades.loc[blank, "Conversion rate"] = ""
+    trades.to_csv(path, index=False)
+    return blank.sum()
+
+
+def exports_with_gaps(folder):
+    accounts = synthetic_exports.generate_accounts(str(folder), ROWS)
+    assert all(blank_rates(account["trades"]) > 10 for account in accounts)
+    return accounts
+
+
+def assert_same_trades(expected, result):
+    for name in expected["trades"]:
+        pd.testing.assert_frame_equal(result["trades"][name].reset_index(drop=True),
+                                      expected["trades"][name].reset_index(drop=True))
+
+
+def test_as_of():
+    table = pd.DataFrame({"Date": pd.to_datetime(["2020-01-02", "2020-01-05", "2020-01-03"]),
+                          "Currency": ["USD", "USD", "EUR"], "Rate": [0.8, 0.7, 0.9]})
+    dates = pd.to_datetime(["2020-01-01", "2020-01-04", "2020-01-05", "2020-01-09", "2020-01-04", "2020-01-04"])
+    rates = fx.as_of(dates, ["USD", "USD", "USD", "USD", "EUR", "GBX"], table)
+    np.testing.assert_array_equal(rates, [0.8, 0.8, 0.7, 0.7, 0.9, 1.0])
+
+
+def test_missing_rates_are_filled(tmp_path):
+    accounts = exports_with_gaps(tmp_path)
+    trades = process_data.clean_trades(pd.read_csv(accounts[0]["trades"]))
+    assert trades["Conversion rate"].notna().all()
+
+
+def test_chunked_matches_whole_file_with_rate_gaps(tmp_path):
+    accounts = exports_with_gaps(tmp_path)
+    whole = process_data.process_files(accounts, workers=1)
+    chunked = process_data.process_files(accounts, workers=1, chunksize=CHUNKSIZE)
+    assert_same_trades(whole, chunked)
+    pd.testing.assert_frame_equal(chunked["rates"], whole["rates"])
+
+
+def test_incremental_matches_whole_file_with_rate_gaps(tmp_path):
+    accounts = exports_with_gaps(tmp_path / "exports")
+    whole = process_data.process_files(accounts, workers=1)
+
+    # An older export with only the older trades, then the full one. The oldest new trades are missing their rates
+    older = []
+    for account in accounts:
+        trades = pd.read_csv(account["trades"], dtype=str, keep_default_na=False)
+        path = str(tmp_path / os.path.basename(account["trades"]))
+        trades.iloc[len(trades) // CHUNKSIZE // 2 * CHUNKSIZE:].to_csv(path, index=False)
+        older.append(dict(account, trades=path))
+    incremental_dir = str(tmp_path / "incremental")
+    incremental.load_data(older, incremental_dir, workers=1)
+
+    assert_same_trades(whole, incremental.load_data(accounts, incremental_dir, workers=1))
+
+
+def test_price_units():
+    currencies = pd.Series(["GBX", "USD", "EUR", "CHF", "GBP"])
+    np.testing.assert_array_equal(fx.price_units(currencies), [100, 100, 1, 1, 1])
+
+
+def test_whole_unit_prices_are_kept():
+    trades = pd.DataFrame({"Date": ["02-06-2021", "01-06-2021"], "Market": ["SAP SE", "Lloyds Banking Group PLC"],
+                           "Currency": ["EUR", "GBX"], "Price": [110.0, 45.0], "Consideration": [-1100.0, -45.0],
+                           "Commission": [-10.0, -10.0], "Conversion rate": [0.86, 1.0]})
+    cleaned = process_data.clean_trades(trades)
+    assert list(cleaned["Price"]) == [0.45, 110.0]
@@ -0,0 +1,97 @@
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generate_report
+from accounts import load_accounts
+from exports import transaction, write_portfolio
+
+
+def write_rates(folder):
+    """ A different USD rate on each day of the transfer in write_portfolio """
+    path = os.path.join(folder, "rates.csv")
+    with open(path, "w") as f:
+        f.write("Date,Currency,Rate\n2021-04-05,USD,0.72\n2021-04-06,USD,0.73\n")
+    return path
+
+
+def test_usd_with_transfer_across_days(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # for the cache
+    accounts = load_accounts(write_portfolio(tmp_path))
+    config = dict(generate_report.DEFAULT_CONFIG, base_currency="USD", rates_file=write_rates(tmp_path))
+
+    data = generate_report.load_dashboard_data(config, accounts)
+
+    # Each side at its own day's rate
+    assert data["cash_flow"]["transfers_out"] == round(1000 / 0.72, 2)
+    assert data["cash_flow"]["transfers_in"] == round(1000 / 0.73, 2)
+
+
+def test_transfers_that_dont_match(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    accounts = load_accounts(write_portfolio(tmp_path))
+    with open(tmp_path / "TransactionHistory (ISA).csv", "a", encoding="utf-8") as f:
+        f.write(transaction("08/04/2021", "Transfers", "Funds Transfer from Share dealing", "5.00") + "\n")
+
+    with pytest.raises(ValueError, match="transferred out"):
+        generate_report.load_dashboard_data(generate_report.DEFAULT_CONFIG, accounts)
+
+
+def callback(client, output, outputs, inputs, state):
+    """ Calls a Dash callback the way the browser does. Returns (status code, response) """
+    response = client.post("/_dash-update-component", json={"output": output, "outputs": outputs, "inputs": inputs,
+                                                              "state": state, "changedPropIds": []})
+    return response.status_code, response.get_json()
+
+
+def prop(component_id, name, value=None):
+    return {"id": component_id, "property": name, "value": value}
+
+
+def test_account_removed_while_page_is_open(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = write_portfolio(tmp_path)
+    app = generate_report.create_app({"accounts_file": path})
+    client = app.server.test_client()
+    dependencies = {d["output"]: d["output"] for d in client.get("/_dash-dependencies").get_json()}
+    store = app.dashboard["store"]
+    data, version = store.get("")
+    cells = generate_report.summary_cells(data, data["accounts"], None, None)
+
+    # The ISA is dropped from the portfolio (with the transfer to it) and it's loaded again.
+    # The page still has the ISA's cells and table
+    with open(path) as f:
+        accounts = json.load(f)
+    accounts["accounts"] = [dict(accounts["accounts"][0], transfer_out=None)]
+    with open(path, "w") as f:
+        json.dump(accounts, f)
+    store.refresh("")
+    while store.is_loading(""):
+        time.sleep(0.05)
+    assert store.error("") is None
+
+    summary = next(output for output in dependencies if "summary-cell" in output)
+    code, response = callback(client, summary,
+                              [prop(generate_report.component_id("summary-cell", cell), "children") for cell in cells],
+                              [prop("date-picker-range", "start_date"), prop("date-picker-range", "end_date"),
+                               prop("data-version", "data", version)],
+                              [prop("portfolio", "data", "")])
+    assert code == 200
+    shown = {json.loads(cell_id)["name"] for cell_id in response["response"]}
+    assert "share-dealing-positions-invested" in shown and "isa-positions-invested" not in shown
+
+    table_id = generate_report.component_id("table", generate_report.positions_table_id("ISA"))
+    error_id = generate_report.component_id("table-filter-error", table_id["name"])
+    table = next(output for output in dependencies if "MATCH" in output)
+    code, _ = callback(client, table,
+                       [prop(table_id, "data"), prop(table_id, "page_count"), prop(error_id, "children")],
+                       [prop("date-picker-range", "start_date"), prop("date-picker-range", "end_date"),
+                        prop(table_id, "page_current", 0), prop(table_id, "page_size", 50), prop(table_id, "sort_by", []),
+                        prop(table_id, "filter_query", ""), prop("data-version", "data", version)],
+                       [prop(table_id, "id", table_id), prop("portfolio", "data", "")])
+    assert code == 204 # nothing to update
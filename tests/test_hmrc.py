@@ -0,0 +1,100 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import process_data
+
+
+def trades(*rows):
+    """ A cleaned trade history for one market from (date, direction, quantity, £ price, £ fees) rows, in date order.
+    Share splits are ("2021-01-01", "SPLIT", old quantity, new quantity) """
+    records = []
+    for row in rows:
+        if row[1] == "SPLIT":
+            date, _, old, new = row
+            records += [(date, "CORPORATE ACTION", "SELL", -old, 0.0, 0.0),
+                        (date, "CORPORATE ACTION", "BUY", new, 0.0, 0.0)]
+        else:
+            date, direction, quantity, price, fees = row
+            records.append((date, "TRADE", direction, quantity if direction == "BUY" else -quantity, price, fees))
+    frame = pd.DataFrame(records, columns=["Date", "Activity", "Direction", "Quantity", "Price", "Commission (£)"])
+    frame["Date"] = pd.to_datetime(frame["Date"])
+    frame["Time"] = "09:00:00"
+    frame["Market"] = "Lloyds"
+    frame["Conversion rate"] = 1.0
+    frame["Charges"] = 0.0
+    frame["Consideration (£)"] = frame["Quantity"] * frame["Price"]
+    return frame
+
+
+def sells(*rows):
+    """ (Initial Consideration, Fees, Net Profit) of each sell, matched with HMRC rules """
+    report = process_data.trade_history_report(trades(*rows), matching="hmrc")
+    report = report[(report["Activity"] == "TRADE") & (report["Direction"] == "SELL")]
+    return list(zip(report["Initial Consideration (£)"], report["Fees (£)"], report["Net Profit (£)"]))
+
+
+def test_same_day():
+    # The 100 sold on 1 March are the 100 bought that day at £2, not the older ones at £1
+    assert sells(("2021-01-01", "BUY", 100, 1.0, 10.0),
+                 ("2021-03-01", "BUY", 100, 2.0, 10.0),
+                 ("2021-03-01", "SELL", 100, 3.0, 10.0)) == [(200.0, 20.0, 80.0)]
+
+
+def test_thirty_days():
+    # Bought back within 30 days, so matched with the buy back at £2 rather than the pool at £1
+    assert sells(("2021-01-01", "BUY", 100, 1.0, 10.0),
+                 ("2021-03-01", "SELL", 100, 3.0, 10.0),
+                 ("2021-03-20", "BUY", 100, 2.0, 10.0)) == [(200.0, 20.0, 80.0)]
+
+
+def test_after_thirty_days_is_pool():
+    # Bought back 31 days later, so from the pool
+    assert sells(("2021-01-01", "BUY", 100, 1.0, 10.0),
+                 ("2021-03-01", "SELL", 100, 3.0, 10.0),
+                 ("2021-04-01", "BUY", 100, 2.0, 10.0)) == [(100.0, 20.0, 180.0)]
+
+
+def test_pool():
+    # Pool of 200 shares costing £300 (£1.50 each) and £20 of fees. Selling 50 takes a quarter of each
+    assert sells(("2021-01-01", "BUY", 100, 1.0, 10.0),
+                 ("2021-02-01", "BUY", 100, 2.0, 10.0),
+                 ("2021-06-01", "SELL", 50, 3.0, 10.0),
+                 ("2021-09-01", "SELL", 50, 3.0, 10.0)) == [(75.0, 15.0, 60.0), (75.0, 15.0, 60.0)]
+
+
+def test_rules_in_order():
+    # 150 sold: 50 the same day, 60 bought back within 30 days, and 40 from the pool
+    assert sells(("2021-01-01", "BUY", 100, 1.0, 0.0),
+                 ("2021-03-01", "BUY", 50, 2.0, 0.0),
+                 ("2021-03-01", "SELL", 150, 4.0, 0.0),
+                 ("2021-03-10", "BUY", 60, 3.0, 0.0)) == [(100.0 + 180.0 + 40.0, 0.0, 600.0 - 320.0)]
+
+
+def test_pool_across_split():
+    # 100 bought at £2, split 10 for 1, then 500 sold at 30p: half the pool
+    assert sells(("2021-01-01", "BUY", 100, 2.0, 10.0),
+                 ("2021-02-01", "SPLIT", 100, 1000),
+                 ("2021-06-01", "SELL", 500, 0.3, 10.0)) == [(100.0, 15.0, 35.0)]
+
+
+def test_thirty_days_across_split():
+    # 100 sold at £3, split 10 for 1, then 1000 bought back at 25p within 30 days.
+    # The 1000 new shares are the 100 old ones sold, at £250
+    assert sells(("2021-01-01", "BUY", 100, 2.0, 10.0),
+                 ("2021-03-01", "SELL", 100, 3.0, 10.0),
+                 ("2021-03-05", "SPLIT", 100, 1000),
+                 ("2021-03-10", "BUY", 1000, 0.25, 10.0)) == [(250.0, 20.0, 30.0)]
+
+
+def test_split_by_three():
+    # Quantities divided by a split ratio of 3 still match exactly
+    result = sells(("2021-01-01", "BUY", 100, 3.0, 0.0),
+                   ("2021-02-01", "SPLIT", 100, 300),
+                   ("2021-03-01", "BUY", 10, 1.0, 0.0),
+                   ("2021-06-01", "SELL", 310, 2.0, 0.0))
+    assert result == [(pytest.approx(310.0), 0.0, pytest.approx(310.0))]
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import dash
+import flask
+import dash_html_components as html
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instrumentation
+
+
+@pytest.fixture
+def enabled():
+    instrumentation.enable()
+    instrumentation.REGISTRY.reset()
+    yield
+    instrumentation.enable(False)
+
+
+def test_callback_payloads(enabled):
+    @instrumentation.callback("test")
+    def update(value):
+        return [html.P(value), dash.no_update, [1, 2, 3]]
+
+    assert update("text")[1] is dash.no_update
+    assert "ig_callback_payload_bytes_count{callback=\"test\"} 1" in instrumentation.REGISTRY.exposition()
+
+
+@pytest.mark.parametrize("query, headers, profiled", [
+    ("?profile=1", {}, True),
+    ("?profile=true", {}, True),
+    ("", {"X-Profile": "1"}, True),
+    ("?profile=0", {}, False),
+    ("?profile=false", {}, False),
+    ("", {"X-Profile": "0"}, False),
+    ("", {}, False),
+])
+def test_profile_flag(enabled, tmp_path, query, headers, profiled):
+    server = flask.Flask(__name__)
+    server.route("/page")(lambda: "page")
+    instrumentation.instrument_server(server, str(tmp_path))
+
+    assert server.test_client().get("/page" + query, headers=headers).status_code == 200
+    assert bool(os.listdir(tmp_path)) == profiled
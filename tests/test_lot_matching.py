@@ -0,0 +1,77 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import incremental
+import lot_matching
+import process_data
+import synthetic_exports
+
+ROWS = 3000
+CHUNKSIZE = 500
+
+
+@pytest.fixture(scope="module")
+def account(tmp_path_factory):
+    return synthetic_exports.generate_accounts(str(tmp_path_factory.mktemp("exports")), ROWS)[0]
+
+
+def whole(account, matching):
+    return process_data.process_account(dict(account, matching=matching))
+
+
+def sorted_lots(lots_df):
+    """ A lot ledger in a set order: chunks add each market's rows a chunk at a time """
+    return lots_df.sort_values(["Market", "Bought", "Opened", "Closed"], kind="mergesort").reset_index(drop=True)
+
+
+@pytest.mark.parametrize("matching", list(lot_matching.METHODS))
+def test_only_the_accounts_method_keeps_lots(account, matching):
+    open_lots = {}
+    cleaned = process_data.clean_trades(pd.read_csv(account["trades"]))
+    process_data.trade_history_report(cleaned, open_lots, [], matching)
+    assert {type(book) for book in open_lots.values()} == {lot_matching.METHODS[matching]}
+
+
+@pytest.mark.parametrize("matching", list(lot_matching.METHODS))
+def test_profit_matches_comparison(account, matching):
+    trades_df, _, _, _, comparison = process_data.process_account(dict(account, matching=matching), compare=True)
+    label = process_data.MATCHING_LABELS[matching]
+    pd.testing.assert_series_equal(trades_df["Net Profit (£)"], comparison[f"Net Profit (£) {label}"], check_names=False)
+
+
+@pytest.mark.parametrize("matching", ["lifo", "hifo", "average"])
+def test_chunked_matches_whole_file(account, matching):
+    expected = whole(account, matching)
+    trades_df, _, lots_df, _ = process_data.process_account(dict(account, matching=matching), chunksize=CHUNKSIZE)
+    pd.testing.assert_frame_equal(trades_df, expected[0])
+    pd.testing.assert_frame_equal(sorted_lots(lots_df), sorted_lots(expected[2]))
+
+
+@pytest.mark.parametrize("matching", ["lifo", "average"])
+def test_incremental_matches_whole_file(account, matching, tmp_path):
+    expected = whole(account, matching)
+    trades = pd.read_csv(account["trades"], dtype=str, keep_default_na=False)
+    older = str(tmp_path / "older.csv")
+    trades.iloc[len(trades) // 2:].to_csv(older, index=False)
+    entry = str(tmp_path / "trades")
+    incremental.update_trades(older, entry, matching)
+
+    trades_df, lots_df, _ = incremental.update_trades(account["trades"], entry, matching)
+    pd.testing.assert_frame_equal(trades_df.reset_index(drop=True), expected[0].reset_index(drop=True))
+    pd.testing.assert_frame_equal(sorted_lots(lots_df), sorted_lots(expected[2]))
+
+
+def test_average_cost_ledger():
+    book = lot_matching.AverageCost()
+    ledger = []
+    book.buy(100, 1.0, 0.0, 1, ledger)
+    book.buy(100, 2.0, 0.0, 2, ledger)
+    book.split(2, 3, ledger)
+    book.sell(100, 0.0, 4, ledger)
+    assert ledger == [(1, 1, 2, 100, 1.0), (1, 2, 3, 200, 1.5), (1, 3, 4, 400, 0.75)]
+    assert book.open_rows() == [(1, 4, 300, 0.75)]
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compact
+import table_query
+
+
+def trades():
+    return pd.DataFrame({"Date": pd.to_datetime(["2021-01-04", "2021-02-01", "2021-03-01", "2021-04-01"]),
+                         "Market": ["Apple Inc", "APPLE INC", "Tesla Inc", "Zoom Video"],
+                         "Quantity": [10.0, 5.0, 20.0, 1.0],
+                         "Consideration (£)": [100.5, 50.25, 200.0, 10.0]})
+
+
+def markets(filter_query, table=None):
+    table = trades() if table is None else table
+    return list(table_query.apply_filter(table, filter_query)["Market"])
+
+
+@pytest.mark.parametrize("filter_query, expected", [
+    ('{Market} = "Apple Inc"', ["Apple Inc"]),
+    ('{Market} eq "Apple Inc"', ["Apple Inc"]),
+    ('{Market} s= "Apple Inc"', ["Apple Inc"]),
+    ('{Market} seq "Apple Inc"', ["Apple Inc"]),
+    ('{Market} i= "apple inc"', ["Apple Inc", "APPLE INC"]),
+    ('{Market} ieq "apple inc"', ["Apple Inc", "APPLE INC"]),
+    ('{Market} i!= "apple inc"', ["Tesla Inc", "Zoom Video"]),
+    ('{Market} contains "Inc"', ["Apple Inc", "Tesla Inc"]),
+    ('{Market} scontains "Inc"', ["Apple Inc", "Tesla Inc"]),
+    ('{Market} icontains "inc"', ["Apple Inc", "APPLE INC", "Tesla Inc"]),
+    ('{Market} i> "apple inc"', ["Tesla Inc", "Zoom Video"]),
+    ('{Market} s> "Apple Inc"', ["Tesla Inc", "Zoom Video"]),
+    ('{Quantity} > 5', ["Apple Inc", "Tesla Inc"]),
+    ('{Quantity} sgt 5', ["Apple Inc", "Tesla Inc"]),
+    ('{Quantity} i>= 5', ["Apple Inc", "APPLE INC", "Tesla Inc"]),
+    ('{Quantity} ilt 5', ["Zoom Video"]),
+    ('{Date} sdatestartswith "2021-0"', ["Apple Inc", "APPLE INC", "Tesla Inc", "Zoom Video"]),
+    ('{Date} idatestartswith "2021-02"', ["APPLE INC"]),
+    ('{Date} >= "2021-03-01" && {Market} icontains "inc"', ["Tesla Inc"]),
+])
+def test_operator_spellings(filter_query, expected):
+    assert markets(filter_query) == expected
+
+
+@pytest.mark.parametrize("filter_query", [
+    '{Market} is nil',
+    '{Market} matches "Apple"',
+    '{Market}',
+    'Apple',
+    '{Quantity} > lots',
+    '{Price} > 10',
+])
+def test_filters_that_cant_be_applied_are_rejected(filter_query):
+    with pytest.raises(ValueError):
+        table_query.apply_filter(trades(), filter_query)
+
+
+def test_compact_table_filters_in_pounds():
+    table = compact.compact_table(trades())
+    records, page_count = table_query.query_table(table, None, None, filter_query="{Consideration (£)} > 50.25")
+    assert [row["Consideration (£)"] for row in records] == [100.5, 200.0]
+    assert page_count == 1
@@ -0,0 +1,90 @@
+import numpy as np
+
+import holdings
+import process_data
+
+# Running totals over time for the dashboard's charts.
+# The cumulative arrays are the ones built for the summary tables (see summary_index), so nothing is added up again
+# when the date range changes: the range is found by binary search and sliced. Long histories are thinned out
+# with Largest-Triangle-Three-Buckets to at most MAX_POINTS points per line, so the chart stays small to send.
+
+MAX_POINTS = 500
+
+# kind: (label, whether it's a level (shown as is) rather than a running total (shown from 0 at the start of the range))
+SERIES = {"net_profit": ("Realised Net Profit", False),
+          "dividends": ("Dividends", False),
+          "fees": ("Fees", False),
+          "deposits": ("Net Deposits", False),
+          "invested": ("Holdings at Cost", True)}
+
+
+def build_series_index(summaries, lots):
+    """ {kind: {account: (sorted dates, cumulative values with a leading 0)}} for every kind in SERIES.
+    Expects the summary index and each account's lot ledger """
+    def total(prefix_sums, keys, sign=1.0):
+        return prefix_sums["dates"], sign * sum(prefix_sums["sums"][key] for key in keys)
+
+    fees = summaries["fees"]
+    return {
+        "net_profit": {account: total(prefix_sums, ["net_profit"]) for account, prefix_sums in summaries["trades"].items()},
+        "dividends": {account: total(summaries["dividends"], [account]) for account in summaries["dividends"]["sums"]},
+        # Fees are negative amounts in the exports
+        "fees": {account: total(fees, [key for key in fees["sums"] if key[0] == account], -1.0)
+                 for account in {account for account, _ in fees["sums"]}},
+        # Cash in and transfers in are positive, cash out and transfers out negative
+        "deposits": {account: total(prefix_sums, list(prefix_sums["sums"])) for account, prefix_sums in summaries["cash_flow"].items()},
+        "invested": {account: holdings.cost_over_time(ledger) for account, ledger in lots.items()},
+    }
+
+
+def lttb(x, y, threshold):
+    """ Largest-Triangle-Three-Buckets: indexes of threshold points of the line (x, y) that keep its shape.
+    The first and last points are always kept. x must be increasing """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    # Points between the first and last are split into threshold - 2 buckets, and one is kept from each:
+    # the one making the largest triangle with the point kept before it and the average of the next bucket
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = (edges[bucket + 1], edges[bucket + 2]) if bucket + 2 < len(edges) else (n - 1, n)
+        next_x, next_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        area = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(area.argmax())
+        keep[bucket + 1] = previous
+    return keep
+
+
+def series(dates, cumulative, start_date=None, end_date=None, level=False, max_points=MAX_POINTS):
+    """ (days, values) of one line from start_date to end_date, one point per day at most max_points.
+    Running totals start from 0 at the start of the range """
+    first, last = process_data.date_bounds(dates, start_date, end_date)
+    if first >= last:
+        return [], []
+    days = dates[first:last].astype("datetime64[D]")
+    values = cumulative[first + 1:last + 1] - (0.0 if level else cumulative[first])
+
+    # The total at the end of each day
+    end_of_day = np.append(days[1:] != days[:-1], True)
+    days, values = days[end_of_day], values[end_of_day]
+
+    x = (days - days[0]).astype(np.float64)
+    kept = lttb(x, values, max_points)
+    return np.datetime_as_string(days[kept]).tolist(), np.round(values[kept], 2).tolist()
+
+
+def series_figure(index, kind, start_date=None, end_date=None, max_points=MAX_POINTS, symbol="£"):
+    """ Line chart of one kind of series, a line for each account """
+    label, level = SERIES[kind]
+    lines = []
+    for account, (dates, cumulative) in index[kind].items():
+        x, y = series(dates, cumulative, start_date, end_date, level, max_points)
+        lines.append({"type": "scatter", "mode": "lines", "line": {"shape": "hv"}, "name": account, "x": x, "y": y})
+    return {"data": lines,
+            "layout": {"yaxis": {"title": f"{label} ({symbol})"}, "margin": {"t": 20}, "hovermode": "x unified"}}
@@ -0,0 +1,70 @@
+import os
+import threading
+
+# Watching input files for changes, so new exports are picked up without restarting the server.
+# Files are polled (their size and modification time), which works everywhere without extra packages.
+# A change is only acted on once the file has stopped changing for a poll, so exports still being copied aren't read.
+
+DEFAULT_INTERVAL = 2.0 # seconds
+
+
+def signature(paths):
+    """ (path, size, modification time) of each file, with None for files that don't exist """
+    result = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            result.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            result.append((path, None, None))
+    return tuple(result)
+
+
+class Watcher:
+    """ Polls groups of files in a background thread and calls on_change(name) when any file in a group has changed.
+    files() returns {name: [paths]} and is called on every poll, so groups can come and go.
+    on_change returns False if it can't deal with the change yet, and it's then reported again on the next poll """
+
+    def __init__(self, files, on_change, interval=DEFAULT_INTERVAL):
+        self.files = files
+        self.on_change = on_change
+        self.interval = interval
+        self.signatures = {} # name: signature of the files when last dealt with
+        self.pending = {} # name: signature seen on the last poll, if it had changed
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def poll(self):
+        """ Checks every group once. Returns the names of the groups on_change was called for """
+        changed = []
+        for name, paths in self.files().items():
+            current = signature(paths)
+            if name not in self.signatures or current == self.signatures[name]:
+                self.signatures.setdefault(name, current)
+                self.pending.pop(name, None)
+                continue
+            # Wait until it's the same on two polls in a row
+            if self.pending.get(name) != current:
+                self.pending[name] = current
+                continue
+            if self.on_change(name) is not False:
+                self.signatures[name] = current
+                del self.pending[name]
+                changed.append(name)
+        return changed
+
+    def start(self):
+        """ Takes note of the files as they are now, then watches them in a background thread """
+        self.poll()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Couldn't check for changed files: {e!r}")
+
+    def stop(self):
+        self.stopped.set()